@@ -7,3 +7,24 @@ from .decode import FDXDecode, DataError, FailedAssumptionError
 
 from .formats import format_signalk_delta, format_json
 from .format_nmea import format_NMEA0183
+from .sinks import fanout
+from .state import boatstate
+from .pipeline import pipeline
+from . import shm
+from . import derived
+from . import damping
+from . import deadreckoning
+from . import export
+from . import cache
+from . import store
+from . import track
+from . import polars
+from . import manoeuvre
+from . import analyze
+from . import quarantine
+from . import stats
+from . import benchmark
+from . import metrics
+from . import sinks
+from . import ratelimit
+from . import deadband
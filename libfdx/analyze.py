@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Byte statistics for working out the unknown parts of the protocol.
+
+The raw frames of a set of dump files are grouped on message type (the
+first three bytes) and length. Each group becomes an array with a row per
+frame and a column per byte, and for every byte position we compute:
+
+* min, max, number of distinct values and the most common values,
+* entropy in bits (0 is constant, 8 is noise),
+* correlation with the next byte (16 bit values show up here),
+* with fields, the best correlation with a known value (awa, sog, ..) at
+  the time of the frame,
+
+and test if a byte is a checksum (XOR or sum) of a range of the bytes
+before it. This is the cut | sort | uniq -c analysis in fdxprotocol.rst,
+for all positions and files at once. Needs numpy.
+"""
+from __future__ import print_function
+
+import os
+import unittest
+from os.path import isdir, join
+
+from .decode import FDXDecode
+from .dumpreader import dumpreader, nxbdump
+from .state import boatstate
+
+# Known values to correlate with, from boatstate.
+fieldnames = ["awa", "aws", "depth", "stw", "sog", "cog", "pressure", "temp"]
+
+
+def inputfiles(paths):
+    "The dump files in paths, with directories expanded."
+    r = []
+    for path in paths:
+        if not isdir(path):
+            r.append(path)
+            continue
+        for dirpath, dirnames, filenames in sorted(os.walk(path)):
+            r += [join(dirpath, f) for f in sorted(filenames) if f.endswith((".dump", ".nxb"))]
+    return r
+
+
+def frames(paths):
+    "All frames in the dump files."
+    for path in paths:
+        reader = nxbdump(path) if path.endswith(".nxb") else dumpreader(path)
+        for _, frame in reader:
+            yield frame
+
+
+def mtypename(mtype):
+    """
+    >>> mtypename(b"\\x01\\x04\\x05")
+    '01 04 05'
+    """
+    return " ".join(["%02x" % x for x in bytearray(mtype)])
+
+
+def _decode(frame):
+    try:
+        return FDXDecode(frame)
+    except Exception:
+        return None
+
+
+class group(object):
+    "Frames with the same message type and length."
+    def __init__(self, mtype, length):
+        self.mtype = mtype
+        self.length = length
+        self.rows = []
+        self.values = []    # Known values per frame, with fields.
+        self.mdesc = None
+        self.data = None
+        self.fields = None
+
+    def finish(self):
+        import numpy
+        self.data = numpy.frombuffer(b"".join(self.rows), dtype=numpy.uint8)
+        self.data = self.data.reshape(-1, self.length)
+        if self.values:
+            self.fields = numpy.array(self.values, dtype=numpy.float64)
+        self.rows = self.values = None
+
+
+def collect(paths, fields=False):
+    """
+    Group the frames in the dump files. Returns {(mtype, length): group}.
+
+    With fields, every frame is decoded to know the instrument values at
+    the time of each frame. This is a lot slower.
+    """
+    groups = {}
+    state = boatstate(clock=lambda: 0.0)
+    nan = float("NaN")
+    for frame in frames(paths):
+        if len(frame) < 4:
+            continue
+        key = (frame[:3], len(frame))
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = group(frame[:3], len(frame))
+        g.rows.append(frame)
+
+        if fields or (g.mdesc is None and len(g.rows) <= 5):
+            msg = _decode(frame)
+            if msg is not None:
+                g.mdesc = msg["mdesc"]
+                state.update(msg)
+        if fields:
+            g.values.append([state.get(f, nan) for f in fieldnames])
+
+    for g in groups.values():
+        g.finish()
+    return groups
+
+
+def correlation(a, b):
+    """
+    Pearson correlation of every column in a with every column in b.
+
+    a and b have the same number of rows. Constant (or all NaN) columns
+    give NaN. Rows with NaN in b are left out of the columns they are in.
+    """
+    import numpy
+    a = a.astype(numpy.float64)
+    b = b.astype(numpy.float64)
+    r = numpy.full((a.shape[1], b.shape[1]), numpy.nan)
+    for col in range(b.shape[1]):
+        ok = ~numpy.isnan(b[:, col])
+        if ok.sum() < 2:
+            continue
+        x = a[ok]
+        y = b[ok, col]
+        x = x - x.mean(axis=0)
+        y = y - y.mean()
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            r[:, col] = (x * y[:, None]).sum(axis=0) / numpy.sqrt((x * x).sum(axis=0) * (y * y).sum())
+    return r
+
+
+def bytestats(data, top=3):
+    """
+    Statistics for each column of data (frames x bytes, uint8).
+
+    Returns a dict of arrays with an entry per byte position: min, max,
+    distinct, entropy, next (correlation with the next byte), and
+    top/topcount (the most common values, most common first).
+    """
+    import numpy
+    n, length = data.shape
+    offsets = numpy.arange(length, dtype=numpy.int64) * 256
+    counts = numpy.bincount((data.astype(numpy.int64) + offsets).ravel(),
+                            minlength=length * 256).reshape(length, 256)
+    p = counts / float(n)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        logp = numpy.where(p > 0, numpy.log2(p), 0.0)
+    order = numpy.argsort(-counts, axis=1, kind="mergesort")[:, :top]
+
+    nextcorr = numpy.full(length, numpy.nan)
+    if length > 1:
+        nextcorr[:-1] = numpy.diagonal(correlation(data[:, :-1], data[:, 1:]))
+    return {
+        "min": data.min(axis=0),
+        "max": data.max(axis=0),
+        "distinct": (counts > 0).sum(axis=1),
+        "entropy": -(p * logp).sum(axis=1) + 0.0,
+        "next": nextcorr,
+        "top": order,
+        "topcount": numpy.take_along_axis(counts, order, axis=1),
+    }
+
+
+def checksums(data, threshold=0.99):
+    """
+    Bytes that are a checksum of a range of the bytes before them.
+
+    Tests XOR, sum and negated sum (mod 256) over every range [first, last]
+    before each position. Returns a list of (position, method, first, last,
+    fraction of frames matching), the best (then shortest) range for each
+    position where at least threshold of the frames match. Constant
+    positions are left out, anything matches those.
+    """
+    import numpy
+    n, length = data.shape
+    zero = numpy.zeros((n, 1), dtype=numpy.int64)
+    values = data.astype(numpy.int64)
+    # prefix[:, k] is over bytes 0..k-1, so a range is prefix[:, last+1] op prefix[:, first].
+    xors = numpy.hstack([zero, numpy.bitwise_xor.accumulate(values, axis=1)])
+    sums = numpy.hstack([zero, numpy.cumsum(values, axis=1)])
+
+    r = []
+    for pos in range(1, length):
+        target = values[:, pos:pos + 1]
+        if (target == target[0]).all():
+            continue
+        best = None
+        for last in range(pos):
+            end = last + 1
+            tests = [
+                ("xor", (xors[:, end:end + 1] ^ xors[:, :end]) == target),
+                ("sum", ((sums[:, end:end + 1] - sums[:, :end]) & 0xff) == target),
+                ("-sum", ((sums[:, :end] - sums[:, end:end + 1]) & 0xff) == target),
+            ]
+            for method, match in tests:
+                fraction = match.mean(axis=0)
+                for first in range(end):
+                    candidate = (fraction[first], first - last, method, first, last)
+                    if fraction[first] >= threshold and (best is None or candidate > best):
+                        best = candidate
+        if best is not None:
+            r.append((pos, best[2], best[3], best[4], float(best[0])))
+    return r
+
+
+def report(groups, fp, fields=False, threshold=0.99, min_count=10):
+    "Write the statistics for the groups as text."
+    import numpy
+    for key in sorted(groups, key=lambda k: (-len(groups[k].data), k)):
+        g = groups[key]
+        n = len(g.data)
+        if n < min_count:
+            continue
+        stats = bytestats(g.data)
+        fieldcorr = None
+        if fields and g.fields is not None:
+            fieldcorr = correlation(g.data, g.fields)
+
+        fp.write("%s, %i bytes, %i frames: %s\n" % (mtypename(g.mtype), g.length, n,
+                                                    g.mdesc or "unknown"))
+        fp.write("  pos min max distinct entropy   next  %-24s%s\n" %
+                 ("top values", "best field" if fieldcorr is not None else ""))
+        for pos in range(g.length):
+            top = " ".join(["%02x:%i" % (v, c) for v, c in
+                            zip(stats["top"][pos], stats["topcount"][pos]) if c > 0])
+            line = "  %3i  %02x  %02x %8i %7.2f %6s  %-24s" % (
+                pos, stats["min"][pos], stats["max"][pos], stats["distinct"][pos],
+                stats["entropy"][pos], _fmtcorr(stats["next"][pos]), top)
+            if fieldcorr is not None and not numpy.isnan(fieldcorr[pos]).all():
+                best = numpy.nanargmax(numpy.abs(fieldcorr[pos]))
+                line += "%s %s" % (fieldnames[best], _fmtcorr(fieldcorr[pos, best]))
+            fp.write(line.rstrip() + "\n")
+        for pos, method, first, last, fraction in checksums(g.data, threshold):
+            fp.write("  byte %i = %s of bytes %i-%i (%.1f%%)\n" %
+                     (pos, method, first, last, fraction * 100))
+        fp.write("\n")
+
+
+def _fmtcorr(v):
+    return "" if v != v else "%.2f" % v
+
+
+class TestAnalyze(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy is needed for analyze")
+
+    def frames(self):
+        import numpy
+        rng = numpy.random.RandomState(1)
+        body = rng.randint(0, 256, size=(500, 3)).astype(numpy.uint8)
+        check = body[:, 0] ^ body[:, 1] ^ body[:, 2]
+        header = numpy.tile(numpy.array([7, 3, 4], dtype=numpy.uint8), (500, 1))
+        tail = numpy.full((500, 1), 0x81, dtype=numpy.uint8)
+        return numpy.hstack([header, body, check[:, None], tail])
+
+    def test_bytestats(self):
+        import numpy
+        data = self.frames()
+        stats = bytestats(data)
+        self.assertEqual(stats["distinct"][0], 1)
+        self.assertEqual(stats["entropy"][0], 0.0)
+        self.assertGreater(stats["entropy"][3], 7.0)
+        self.assertEqual((stats["top"][7][0], stats["topcount"][7][0]), (0x81, 500))
+        self.assertTrue(numpy.isnan(stats["next"][0]))
+
+        data[:, 4] = data[:, 3] // 2
+        self.assertAlmostEqual(bytestats(data)["next"][3], 1.0, places=3)
+
+    def test_checksums(self):
+        data = self.frames()
+        self.assertEqual(checksums(data), [(6, "xor", 3, 5, 1.0)])
+        data[:, 1] = [4, 5] * 250
+        data[:, 2] = [3, 2] * 250
+        self.assertEqual(checksums(data)[0][:4], (2, "xor", 0, 1))
+
+    def test_report(self):
+        from io import StringIO
+        import numpy
+        g = group(b"\x07\x03\x04", 8)
+        g.data = self.frames()
+        g.mdesc = "test"
+        g.fields = numpy.full((500, len(fieldnames)), numpy.nan)
+        g.fields[:, 4] = g.data[:, 3]
+        fp = StringIO()
+        report({(g.mtype, 8): g}, fp, fields=True)
+        out = fp.getvalue()
+        self.assertIn("07 03 04, 8 bytes, 500 frames: test", out)
+        self.assertIn("sog 1.00", out)
+        self.assertIn("byte 6 = xor of bytes 3-5 (100.0%)", out)
+        self.assertEqual(mtypename(b"\x81\x15\x04"), "81 15 04")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Benchmark over recorded data, no hardware needed.
+
+Each stage is run over the whole corpus repeat times and the fastest run
+counts:
+
+    read dump       parsing text dump files into frames
+    read nxb        splitting .nxb files into frames
+    decode          FDXDecode, and per message type: decode 01 04 05
+                    (for types with at least min_frames frames)
+    format <name>   each output format, on the decoded messages
+    store           adding the decoded messages to a --store database
+                    (in memory)
+
+Bytes are what goes in for reading (file size) and decoding (frame
+length), and what comes out for formatting. None are counted for store.
+
+With scale, the corpus is scaled up by repeating the files scale times,
+to have runs long enough for stable numbers on a fast machine.
+
+The result also has a SHA-256 digest of the decoded messages of the
+(unscaled) corpus. A change to the decoder that is only meant to make it
+faster must not change the digest.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import platform
+import shutil
+import tempfile
+import unittest
+from os.path import basename, getsize, join
+
+from .analyze import inputfiles, mtypename
+from .decode import FDXDecode
+from .dumpreader import dumpreader, nxbdump
+from .sinks import make_formatter
+from .stats import clock_ns
+from .store import store
+
+default_formats = ["nmea0183", "json", "raw", "signalk"]
+
+
+def _best(func, repeat):
+    "Run func repeat times. Returns (fastest time in ns, what func returned)."
+    best = None
+    for _ in range(max(repeat, 1)):
+        t0 = clock_ns()
+        r = func()
+        ns = clock_ns() - t0
+        if best is None or ns < best:
+            best = ns
+    return best, r
+
+
+def _stage(frames, nbytes, ns):
+    seconds = max(ns / 1e9, 1e-9)
+    return {"frames": frames, "bytes": nbytes, "seconds": seconds,
+            "frames_per_s": frames / seconds, "bytes_per_s": nbytes / seconds}
+
+
+def _decode(frame):
+    try:
+        return FDXDecode(frame)
+    except Exception:
+        return None
+
+
+def digest(frames):
+    """
+    SHA-256 of what FDXDecode makes of frames, failures included.
+
+    >>> digest([b"\\x08\\x01\\x09\\x7f\\x7f\\x81"]) == digest([b"\\x08\\x01\\x09\\x7f\\x7f\\x81"])
+    True
+    """
+    h = hashlib.sha256()
+    for frame in frames:
+        try:
+            line = json.dumps(FDXDecode(frame), sort_keys=True, default=str)
+        except Exception as e:
+            line = "! %s" % type(e).__name__
+        h.update(line.encode("utf-8") + b"\n")
+    return h.hexdigest()
+
+
+def scaled(paths, scale, tmpdir):
+    "The files repeated scale times, written to tmpdir. Returns the new paths."
+    r = []
+    for i, path in enumerate(paths):
+        out = join(tmpdir, "%i-%s" % (i, basename(path)))
+        if path.endswith(".nxb"):
+            with open(path, "rb") as fp:
+                content = fp.read()
+            with open(out, "wb") as fp:
+                fp.write(content * scale)
+        else:
+            with open(path, "r") as fp:
+                lines = [l for l in fp if not l.startswith("#")]
+            with open(out, "w") as fp:
+                for _ in range(scale):
+                    fp.writelines(lines)
+        r.append(out)
+    return r
+
+
+def _read(paths, reader):
+    frames = []
+    for path in paths:
+        frames += [frame for _, frame in reader(path)]
+    return frames
+
+
+def _store(msgs):
+    "Rows written for msgs."
+    db = store(":memory:", flush_after=3600)
+    for msg in msgs:
+        db.add(0.0, msg)
+    db.close()
+    return db.n_rows
+
+
+def run(paths, scale=1, repeat=3, formats=default_formats, min_frames=100):
+    """
+    Benchmark the dump files (.dump, .nxb, or directories of them).
+
+    Returns the result as a dict, ready for json.dump().
+    """
+    paths = inputfiles(paths)
+    dumps = [p for p in paths if not p.endswith(".nxb")]
+    nxbs = [p for p in paths if p.endswith(".nxb")]
+    frames = _read(dumps, dumpreader) + _read(nxbs, nxbdump)
+    result = {
+        "python": platform.python_version(),
+        "corpus": {"files": [basename(p) for p in paths], "frames": len(frames),
+                   "bytes": sum([getsize(p) for p in paths]), "scale": scale},
+        "digest": digest(frames),
+        "stages": {},
+    }
+    stages = result["stages"]
+
+    tmpdir = None
+    if scale > 1:
+        tmpdir = tempfile.mkdtemp(prefix="fdxbench")
+        dumps = scaled(dumps, scale, tmpdir)
+        nxbs = scaled(nxbs, scale, tmpdir)
+    try:
+        for name, files, reader in [("read dump", dumps, dumpreader), ("read nxb", nxbs, nxbdump)]:
+            if files:
+                ns, r = _best(lambda: _read(files, reader), repeat)
+                stages[name] = _stage(len(r), sum([getsize(p) for p in files]), ns)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    frames = frames * scale
+    bymtype = {}
+    for frame in frames:
+        bymtype.setdefault(frame[:3], []).append(frame)
+    total = [0, 0, 0]
+    for mtype, group in bymtype.items():
+        ns, _ = _best(lambda: [_decode(f) for f in group], repeat)
+        nbytes = sum([len(f) for f in group])
+        if len(group) >= min_frames:
+            stages["decode %s" % mtypename(mtype)] = _stage(len(group), nbytes, ns)
+        total[0] += len(group)
+        total[1] += nbytes
+        total[2] += ns
+    stages["decode"] = _stage(*total)
+
+    msgs = [msg for msg in map(_decode, frames) if msg is not None]
+    for name in formats:
+        def encode():
+            formatter = make_formatter(name)
+            return sum([len(data) for data in map(formatter.encode, msgs) if data])
+        ns, nbytes = _best(encode, repeat)
+        stages["format %s" % name] = _stage(len(msgs), nbytes, ns)
+
+    ns, _ = _best(lambda: _store(msgs), repeat)
+    stages["store"] = _stage(len(msgs), 0, ns)
+    return result
+
+
+def compare(result, baseline, threshold=0.1):
+    """
+    Compare a result with a baseline result.
+
+    Returns a list of problems: stages that are more than threshold
+    (a fraction) slower in frames/s, and a changed digest. Stages only in
+    one of them are left out. Results for other input files (the scale
+    may differ) are not comparable.
+    """
+    if result["corpus"]["files"] != baseline["corpus"]["files"]:
+        return ["the baseline is for other input files"]
+    r = []
+    if result["digest"] != baseline["digest"]:
+        r.append("decoded output changed: digest %s, was %s" %
+                 (result["digest"][:16], baseline["digest"][:16]))
+    for name in sorted(result["stages"]):
+        before = baseline["stages"].get(name)
+        if before is None:
+            continue
+        now = result["stages"][name]["frames_per_s"]
+        if now < before["frames_per_s"] * (1.0 - threshold):
+            r.append("%s: %.0f frames/s, was %.0f (%+.1f%%)" % (
+                name, now, before["frames_per_s"], (now / before["frames_per_s"] - 1) * 100))
+    return r
+
+
+def write_table(fp, result, baseline=None):
+    "The result as a text table, with the change from baseline."
+    fp.write("%-22s %9s %12s %12s%s\n" % ("stage", "frames", "frames/s", "MB/s",
+                                          "  change" if baseline else ""))
+    stages = result["stages"]
+    # Read, decode, format; the per message type decoding last.
+    names = sorted(stages, key=lambda k: (k.startswith("decode "), k))
+    for name in names:
+        s = stages[name]
+        line = "%-22s %9i %12.0f %12.2f" % (name, s["frames"], s["frames_per_s"],
+                                            s["bytes_per_s"] / 1e6)
+        if baseline and name in baseline["stages"]:
+            line += "  %+5.1f%%" % ((s["frames_per_s"] / baseline["stages"][name]["frames_per_s"] - 1) * 100)
+        fp.write(line + "\n")
+    fp.write("digest %s\n" % result["digest"])
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dump = join(self.tmpdir, "test.dump")
+        with open(self.dump, "w") as fp:
+            fp.write("# comment\n")
+            fp.write("0.02 9\t01 04 05 ff ff 00 00 00 81\n")
+            fp.write("0.02 14\t08 01 09 7f 7f 81 02 03 01 ff ff 00 00 81\n")
+        self.nxb = join(self.tmpdir, "test.nxb")
+        with open(self.nxb, "wb") as fp:
+            fp.write(b"\x08\x01\x09\x7f\x7f\x81\x0d\x02\x0f\x00\x00\x81")
+
+    def test_run(self):
+        r = run([self.tmpdir], repeat=1, formats=["json"], min_frames=1)
+        self.assertEqual(r["corpus"]["frames"], 5)
+        self.assertEqual(sorted(r["stages"]), [
+            "decode", "decode 01 04 05", "decode 02 03 01", "decode 08 01 09",
+            "decode 0d 02 0f", "format json", "read dump", "read nxb", "store"])
+        self.assertEqual(r["stages"]["decode 08 01 09"]["frames"], 2)
+        self.assertEqual(r["stages"]["decode"]["bytes"], 9 + 8 + 6 + 6 + 6)
+
+        bigger = run([self.dump, self.nxb], scale=3, repeat=2, formats=["json"], min_frames=4)
+        self.assertEqual(bigger["stages"]["read dump"]["frames"], 9)
+        self.assertEqual(sorted(bigger["stages"])[:2], ["decode", "decode 08 01 09"])
+        self.assertEqual(bigger["stages"]["decode"]["frames"], 15)
+        self.assertEqual(bigger["digest"], r["digest"])
+        json.dumps(bigger)
+
+    def test_compare(self):
+        r = run([self.dump], repeat=1, formats=[])
+        baseline = json.loads(json.dumps(r))
+        self.assertEqual(compare(r, baseline), [])
+        baseline["stages"]["decode"]["frames_per_s"] *= 2
+        baseline["digest"] = "0" * 64
+        problems = compare(r, baseline, threshold=0.2)
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(problems[0].startswith("decoded output changed"))
+        self.assertIn("decode: ", problems[1])
+        self.assertIn("(-50.0%)", problems[1])
+        baseline["corpus"]["files"] = ["other.dump"]
+        self.assertEqual(compare(r, baseline), ["the baseline is for other input files"])
+
+
+if __name__ == "__main__":
+    unittest.main()
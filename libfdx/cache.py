@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+On-disk cache of decoded dump files.
+
+Decoding a regatta worth of frames takes a while, and the same files are
+read over and over when analysing them. The first time a file is read
+through HEXinterface, the decoded messages are stored in the cache
+directory; the next time they are read back from there, which is much
+faster than decoding.
+
+Entries are keyed on the SHA-256 of the file contents, the seek offset and
+libfdx.__version__, so a changed file or a new decoder never gives stale
+results. Entries from other versions are removed when a new entry is
+written, and the least recently used entries are removed when the
+directory grows past maxsize bytes.
+
+Enable it with the FDXREAD_CACHE environment variable (a directory), or
+give HEXinterface a decodecache.
+
+Entries are marshal data, not pickles, as loading a pickle can run any
+code and the directory may be shared. Only the types the decoder gives
+are stored (numbers, strings, Decimal, datetime, Latitude, Longitude).
+The directory is created readable for the owner only, and entries owned
+by someone else are not read.
+"""
+from __future__ import print_function
+
+import gzip
+import hashlib
+import logging
+import marshal
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from os.path import join, getsize
+
+from LatLon23 import Latitude, Longitude
+
+suffix = ".fdxc"
+chunksize = 1024  # Messages per chunk.
+
+# Values marshal does not handle are stored as (_tag, type name, data).
+_tag = "\x00fdx"
+_latlon = {"Latitude": Latitude, "Longitude": Longitude}
+
+
+class CacheError(Exception):
+    "A cache entry turned out to be broken while it was read."
+    pass
+
+
+def _version():
+    from . import __version__
+    return __version__
+
+
+def filehash(path):
+    "SHA-256 of the file contents, as hex."
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _pack(msg):
+    """
+    msg with the values marshal does not know about tagged.
+
+    >>> _unpack(_pack({"awa": Decimal("NaN")}))
+    {'awa': Decimal('NaN')}
+    """
+    r = {}
+    for key, value in msg.items():
+        t = type(value)
+        if t is Decimal:
+            value = (_tag, "Decimal", str(value))
+        elif t is datetime:
+            value = (_tag, "datetime", (value.year, value.month, value.day, value.hour,
+                                        value.minute, value.second, value.microsecond))
+        elif t is Latitude or t is Longitude:
+            value = (_tag, t.__name__, dict(vars(value)))
+        r[key] = value
+    return r
+
+
+def _unpack(msg):
+    "Reverse of _pack(). ValueError for anything it would not give."
+    if type(msg) is not dict:
+        raise ValueError("Not a message: %r" % (msg,))
+    for key, value in msg.items():
+        if type(value) is not tuple:
+            continue
+        if len(value) != 3 or value[0] != _tag:
+            raise ValueError("Unknown value %r" % (value,))
+        kind, data = value[1:]
+        if kind == "Decimal":
+            value = Decimal(data)
+        elif kind == "datetime":
+            value = datetime(*data)
+        elif kind in _latlon and type(data) is dict:
+            value = _latlon[kind].__new__(_latlon[kind])
+            value.__dict__.update(data)
+        else:
+            raise ValueError("Unknown value type %r" % (kind,))
+        msg[key] = value
+    return msg
+
+
+def _write(fp, obj):
+    data = marshal.dumps(obj, 2)
+    fp.write(struct.pack("<I", len(data)))
+    fp.write(data)
+
+
+def _read(fp):
+    "The next object written with _write(). EOFError at the end."
+    header = fp.read(4)
+    if not header:
+        raise EOFError("No end marker")
+    if len(header) < 4:
+        raise EOFError("Truncated")
+    size, = struct.unpack("<I", header)
+    data = fp.read(size)
+    if len(data) < size:
+        raise EOFError("Truncated")
+    return marshal.loads(data)
+
+
+def default():
+    "The cache given by $FDXREAD_CACHE, or None."
+    path = os.environ.get("FDXREAD_CACHE")
+    if not path:
+        return None
+    return decodecache(path)
+
+
+class _entrywriter(object):
+    "Collect messages for a cache entry. Only complete entries are stored."
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        fd, self.tmppath = tempfile.mkstemp(dir=cache.path, suffix=".tmp")
+        os.close(fd)
+        self.fp = gzip.open(self.tmppath, "wb", compresslevel=1)
+        self.chunk = []
+
+    def add(self, ts, msg):
+        self.chunk.append((ts, _pack(msg)))
+        if len(self.chunk) >= chunksize:
+            _write(self.fp, self.chunk)
+            self.chunk = []
+
+    def commit(self, n_errors=0, quarantined=None):
+        if self.chunk:
+            _write(self.fp, self.chunk)
+        _write(self.fp, ("end", n_errors, quarantined))
+        self.fp.close()
+        os.rename(self.tmppath, join(self.cache.path, self.name))
+        self.cache.evict()
+
+    def abort(self):
+        self.fp.close()
+        os.unlink(self.tmppath)
+
+
+class decodecache(object):
+    def __init__(self, path, maxsize=512 * 1024 * 1024):
+        self.path = path
+        self.maxsize = maxsize
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def entryname(self, inputfile, seek=0):
+        return "%s-%s-%i%s" % (_version(), filehash(inputfile), seek, suffix)
+
+    def lookup(self, name):
+        "Path of the entry, or None."
+        path = join(self.path, name)
+        if not os.path.exists(path):
+            self.n_misses += 1
+            return None
+        if hasattr(os, "getuid") and os.stat(path).st_uid != os.getuid():
+            logging.warning("Not using cache entry %s, it belongs to someone else" % path)
+            self.n_misses += 1
+            return None
+        os.utime(path, None)    # For the eviction.
+        self.n_hits += 1
+        return path
+
+    def replay(self, path):
+        """
+        Iterate over the (ts, msg) in an entry.
+
+        The number of decoding errors is in n_errors when done, and the
+        state of the quarantine (see quarantine.py) in quarantined.
+
+        A broken entry is removed, and CacheError raised. Some messages may
+        have been given already.
+        """
+        self.n_errors = 0
+        self.quarantined = None
+        with gzip.open(path, "rb") as fp:
+            while True:
+                try:
+                    chunk = _read(fp)
+                    if type(chunk) is tuple:
+                        self.n_errors = chunk[1]
+                        self.quarantined = chunk[2] if len(chunk) > 2 else None
+                        return
+                    chunk = [(ts, _unpack(msg)) for ts, msg in chunk]
+                except (EOFError, IOError, OSError, ValueError, TypeError, IndexError,
+                        zlib.error, struct.error) as e:
+                    os.unlink(path)
+                    raise CacheError("Removed broken cache entry %s: %s" % (path, str(e)))
+                for item in chunk:
+                    yield item
+
+    def writer(self, name):
+        return _entrywriter(self, name)
+
+    def entries(self):
+        return [f for f in os.listdir(self.path) if f.endswith(suffix)]
+
+    def evict(self):
+        "Remove other versions, and the least recently used down to maxsize."
+        prefix = _version() + "-"
+        entries = []
+        for name in self.entries():
+            path = join(self.path, name)
+            if not name.startswith(prefix):
+                os.unlink(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.maxsize:
+            _, size, path = entries.pop(0)
+            os.unlink(path)
+            total -= size
+
+    def clear(self):
+        for name in self.entries():
+            os.unlink(join(self.path, name))
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_roundtrip(self):
+        from decimal import Decimal
+        cache = decodecache(join(self.tmpdir, "cache"))
+        dump = join(self.tmpdir, "x.dump")
+        with open(dump, "w") as fp:
+            fp.write("0.1 9 01 04 05 b1 00 cf ae d0 81\n")
+
+        name = cache.entryname(dump)
+        self.assertIsNone(cache.lookup(name))
+        w = cache.writer(name)
+        for idx in range(chunksize + 10):
+            w.add(float(idx), {"mdesc": "wsi0", "awa": Decimal(idx)})
+        w.commit(n_errors=3)
+
+        path = cache.lookup(name)
+        items = list(cache.replay(path))
+        self.assertEqual(len(items), chunksize + 10)
+        self.assertEqual(items[-1], (chunksize + 9.0, {"mdesc": "wsi0", "awa": Decimal(chunksize + 9)}))
+        self.assertEqual(cache.n_errors, 3)
+
+        # New content, new entry.
+        with open(dump, "a") as fp:
+            fp.write("0.1 9 01 04 05 b1 00 cf ae d0 81\n")
+        self.assertNotEqual(cache.entryname(dump), name)
+
+        # Aborted entries are not stored.
+        w = cache.writer(cache.entryname(dump))
+        w.add(0.0, {"mdesc": "wsi0"})
+        w.abort()
+        self.assertEqual(os.listdir(cache.path), [name])
+
+    def test_types(self):
+        from .decode import FDXDecode
+        cache = decodecache(join(self.tmpdir, "cache"))
+        if hasattr(os, "getuid"):
+            self.assertEqual(os.stat(cache.path).st_mode & 0o777, 0o700)
+        msgs = [FDXDecode(bytes(bytearray.fromhex(frame))) for frame in [
+            "20 08 28 3b 1e cb 0a 4e b2 e0 00 f8 81",   # gpspos
+            "24 07 23 0f 05 32 18 08 18 00 30 81",      # gpstime
+            "01 04 05 ff ff 00 00 00 81"]]             # wsi0 brownout
+        name = _version() + "-types-0" + suffix
+        w = cache.writer(name)
+        for msg in msgs:
+            w.add(1.0, msg)
+        w.commit(quarantined=(1, {("070304", 5, "malformed"): 1}, {}, {"070304": ["e6"]}))
+        items = list(cache.replay(cache.lookup(name)))
+        self.assertEqual([msg["mdesc"] for _, msg in items], ["gpspos", "gpstime", "wsi0"])
+        pos, t, wind = [msg for _, msg in items]
+        self.assertEqual(type(pos["lat"]), type(msgs[0]["lat"]))
+        self.assertEqual(vars(pos["lon"]), vars(msgs[0]["lon"]))
+        self.assertEqual(t, msgs[1])
+        self.assertTrue(wind["aws_hi"].is_nan())
+        self.assertEqual(cache.quarantined[1], {("070304", 5, "malformed"): 1})
+
+    def test_untrusted(self):
+        import pickle
+        cache = decodecache(self.tmpdir)
+        path = join(self.tmpdir, "x" + suffix)
+        marker = join(self.tmpdir, "pwned")
+
+        class boom(object):
+            def __reduce__(self):
+                return (os.mkdir, (marker,))
+
+        # A pickle is not loaded, nor is anything that is not a message.
+        for content in [pickle.dumps([boom()], 2), marshal.dumps([(0.0, ("x",))]),
+                        marshal.dumps([(0.0, {"a": (_tag, "eval", "1")})])]:
+            with gzip.open(path, "wb") as fp:
+                if content.startswith(b"\x80"):
+                    fp.write(content)
+                else:
+                    fp.write(struct.pack("<I", len(content)) + content)
+            with self.assertRaises(CacheError):
+                list(cache.replay(path))
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(marker))
+
+    def test_evict(self):
+        cache = decodecache(self.tmpdir, maxsize=1)
+        with open(join(self.tmpdir, "0.0.1-abc-0" + suffix), "w") as fp:
+            fp.write("old version")
+        w = cache.writer(_version() + "-def-0" + suffix)
+        w.commit()
+        # Both the other version and the (too large) new one are gone.
+        self.assertEqual(cache.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Rolling statistics and damping of instrument values.
+
+The wind readings jump around from frame to frame. Displays on the boat
+show damped values, the mean of the last n readings. The windows here are
+preallocated ring buffers with running sums, so every update is constant
+time no matter the window size.
+
+Angles (awa, cog, twa, twd) are averaged as unit vectors, so 359 and 1
+degrees average to 0 and not 180.
+"""
+from __future__ import print_function
+
+import unittest
+from array import array
+from collections import deque
+from decimal import Decimal
+from math import atan2, cos, sin, radians, degrees, isnan
+
+from .state import brownout
+
+
+def parse_sizes(spec):
+    """
+    Parse "field=n,field=n" into a dict of window sizes (in readings).
+
+    >>> sorted(parse_sizes("awa=10, aws_lo=5").items())
+    [('awa', 10), ('aws_lo', 5)]
+    """
+    sizes = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, value = part.partition("=")
+        try:
+            sizes[name.strip()] = int(value)
+        except ValueError:
+            raise ValueError("Invalid window size for %s: %s" % (name, value))
+        if sizes[name.strip()] < 1:
+            raise ValueError("Window size for %s must be at least 1" % name)
+    return sizes
+
+
+class window(object):
+    """
+    Mean, min and max of the last size values.
+
+    Min and max are kept with monotonic queues (amortized constant time).
+    The running sum is recomputed now and then, so float rounding errors
+    do not add up over a long trip.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buf = array("d", [0.0]) * size
+        self.n = 0
+        self.sum = 0.0
+        self._min = deque()  # (n, value), increasing values
+        self._max = deque()  # (n, value), decreasing values
+
+    def __len__(self):
+        return min(self.n, self.size)
+
+    def push(self, value):
+        size = self.size
+        idx = self.n % size
+        if self.n >= size:
+            self.sum -= self.buf[idx]
+        self.buf[idx] = value
+        self.sum += value
+        self.n += 1
+        if self.n % (size * 64) == 0:
+            self.sum = sum(self.buf)
+
+        n = self.n
+        for q, better in ((self._min, value.__le__), (self._max, value.__ge__)):
+            while q and better(q[-1][1]):
+                q.pop()
+            q.append((n, value))
+            if q[0][0] <= n - size:
+                q.popleft()
+
+    def mean(self):
+        if self.n == 0:
+            return None
+        return self.sum / len(self)
+
+    def min(self):
+        return self._min[0][1] if self._min else None
+
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+
+class circularwindow(object):
+    "Mean direction of the last size angles, in degrees 0-360."
+    def __init__(self, size):
+        self.size = size
+        self.sin = array("d", [0.0]) * size
+        self.cos = array("d", [0.0]) * size
+        self.n = 0
+        self.sinsum = 0.0
+        self.cossum = 0.0
+
+    def __len__(self):
+        return min(self.n, self.size)
+
+    def push(self, angle):
+        a = radians(angle)
+        s, c = sin(a), cos(a)
+        idx = self.n % self.size
+        if self.n >= self.size:
+            self.sinsum -= self.sin[idx]
+            self.cossum -= self.cos[idx]
+        self.sin[idx] = s
+        self.cos[idx] = c
+        self.sinsum += s
+        self.cossum += c
+        self.n += 1
+        if self.n % (self.size * 64) == 0:
+            self.sinsum = sum(self.sin)
+            self.cossum = sum(self.cos)
+
+    def mean(self):
+        if self.n == 0:
+            return None
+        return degrees(atan2(self.sinsum, self.cossum)) % 360
+
+
+class damping(object):
+    """
+    Replace the values of some fields with their rolling mean.
+
+    sizes is a dict of message field (like awa, aws_lo, depth) to the
+    number of readings to average over. The output message is a copy with
+    the damped values; the boatstate before this stage still has the raw
+    readings. NaN (no data) is passed on as is and not averaged.
+    """
+    angles = frozenset(["awa", "cog", "twa", "twd"])
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.windows = {}
+        for field, size in sizes.items():
+            if field in self.angles:
+                self.windows[field] = circularwindow(size)
+            else:
+                self.windows[field] = window(size)
+
+    def handle(self, msg):
+        if brownout(msg):   # The zeroes are not readings.
+            return msg
+        r = None
+        for field, w in self.windows.items():
+            value = msg.get(field)
+            if value is None or isinstance(value, bool):
+                continue
+            value = float(value)
+            if isnan(value):
+                continue
+            w.push(value)
+            if r is None:
+                r = dict(msg)
+            r[field] = w.mean()
+        return msg if r is None else r
+
+    def stats(self, field):
+        "(mean, min, max) for field. min and max are None for angles."
+        w = self.windows[field]
+        if isinstance(w, circularwindow):
+            return (w.mean(), None, None)
+        return (w.mean(), w.min(), w.max())
+
+
+class TestDamping(unittest.TestCase):
+    def test_window(self):
+        w = window(3)
+        self.assertIsNone(w.mean())
+        for v, mean, lo, hi in [(5, 5, 5, 5), (1, 3, 1, 5), (3, 3, 1, 5),
+                                (2, 2, 1, 3), (7, 4, 2, 7), (7, 16/3., 2, 7),
+                                (6, 20/3., 6, 7)]:
+            w.push(float(v))
+            self.assertAlmostEqual(w.mean(), mean)
+            self.assertEqual((w.min(), w.max()), (lo, hi))
+
+        # Against the straightforward version, over enough values to see
+        # the running sum recomputed.
+        import random
+        rnd = random.Random(1)
+        w = window(7)
+        values = []
+        for _ in range(1000):
+            values.append(rnd.uniform(-100, 100))
+            w.push(values[-1])
+            last = values[-7:]
+            self.assertAlmostEqual(w.mean(), sum(last) / len(last))
+            self.assertEqual((w.min(), w.max()), (min(last), max(last)))
+
+    def test_circular(self):
+        w = circularwindow(2)
+        w.push(359)
+        w.push(1)
+        self.assertAlmostEqual((w.mean() + 180) % 360, 180)
+        w.push(90)
+        self.assertAlmostEqual(w.mean(), 45.5)
+
+    def test_stage(self):
+        d = damping({"awa": 2, "aws_lo": 2})
+        msg = {"mdesc": "wsi0", "awa": Decimal(350), "aws_lo": 4.0}
+        self.assertEqual(d.handle(msg)["aws_lo"], 4.0)
+        r = d.handle({"mdesc": "wsi0", "awa": Decimal(10), "aws_lo": 6.0})
+        self.assertAlmostEqual(r["awa"] % 360, 0.0)
+        self.assertEqual(r["aws_lo"], 5.0)
+        self.assertEqual(msg["awa"], Decimal(350))    # Input is left alone.
+        self.assertEqual(d.stats("aws_lo"), (5.0, 4.0, 6.0))
+
+        depth = {"mdesc": "dst200depth", "depth": 4.2}
+        self.assertIs(d.handle(depth), depth)
+        nan = {"mdesc": "wsi0", "awa": 0.0, "aws_lo": float("NaN")}
+        self.assertTrue(isnan(d.handle(nan)["aws_lo"]))
+        brownout = {"mdesc": "wsi0", "awa": 0.0, "aws_lo": 0.0, "aws_hi": float("NaN")}
+        self.assertIs(d.handle(brownout), brownout)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Change-only output.
+
+Depth at the mooring, air pressure and the GPS fix at the dock stay the
+same for hours, but are sent several times a second. On a metered link
+(cellular telemetry) that is wasted bytes. The dead-band filter sits between
+the decoder and the formatters and lets a message through only if one of
+its values moved more than the threshold for that field, or if nothing has
+been sent for that message type in a while (the heartbeat).
+"""
+from __future__ import print_function
+
+import unittest
+from decimal import Decimal
+from math import isnan
+from time import time
+
+from .formats import format_json
+
+
+def parse_thresholds(spec):
+    """
+    Parse "field=threshold,field=threshold" into a dict.
+
+    >>> sorted(parse_thresholds("depth=0.1, awa=2").items())
+    [('awa', 2.0), ('depth', 0.1)]
+    """
+    thresholds = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, value = part.partition("=")
+        try:
+            thresholds[name.strip()] = float(value)
+        except ValueError:
+            raise ValueError("Invalid threshold for %s: %s" % (name, value))
+    return thresholds
+
+
+def _number(v):
+    "Numeric value of v, or None if it is not a number."
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, (int, float, Decimal)):
+        return float(v)
+    degrees = getattr(v, "decimal_degree", None)  # Latitude/Longitude
+    if degrees is not None:
+        return float(degrees)
+    return None
+
+
+class deadband(object):
+    """
+    Suppress messages where nothing changed more than the dead-band.
+
+    thresholds is a dict of field name to the smallest change worth
+    sending. Fields not listed are sent on any change. Values are compared
+    with what was last sent for that mdesc, so a slow drift is sent once it
+    adds up to more than the threshold.
+
+    Every heartbeat seconds a message of each type is sent regardless, so
+    the receiver can tell a steady value from a dead link. Give the time
+    time of the message (reader.clock()) as clock when replaying a file.
+
+    Only the fields the output shows are compared. keep(key) tells which,
+    by default the json format rules: the raw representations (strbody)
+    and the fields not understood (unknown, maybe_*, ..) are left out.
+    """
+    def __init__(self, thresholds=None, heartbeat=10.0, clock=time, keep=None):
+        self.thresholds = thresholds or {}
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.keep = format_json().keep if keep is None else keep
+        self.kept = {}      # key -> keep(key)
+        self.sent = {}      # mdesc -> (time, msg)
+        self.n_passed = {}
+        self.n_suppressed = {}
+
+    def changed(self, key, old, new):
+        a = _number(old)
+        b = _number(new)
+        if a is None or b is None:
+            return old != new
+        if isnan(a) or isnan(b):
+            return isnan(a) != isnan(b)
+        return abs(a - b) > self.thresholds.get(key, 0.0)
+
+    def handle(self, msg):
+        "Return msg if it should be sent on, None if it is suppressed."
+        mdesc = msg["mdesc"]
+        now = self.clock()
+        last = self.sent.get(mdesc)
+
+        send = last is None or now - last[0] >= self.heartbeat
+        if not send:
+            prev = last[1]
+            kept = self.kept
+            for key, value in msg.items():
+                k = kept.get(key)
+                if k is None:
+                    k = kept[key] = self.keep(key) and key != "mdesc"
+                if not k:
+                    continue
+                if key not in prev or self.changed(key, prev[key], value):
+                    send = True
+                    break
+
+        if send:
+            self.sent[mdesc] = (now, msg)
+            self.n_passed[mdesc] = self.n_passed.get(mdesc, 0) + 1
+            return msg
+
+        self.n_suppressed[mdesc] = self.n_suppressed.get(mdesc, 0) + 1
+        return None
+
+    def summary(self):
+        "One line describing the savings."
+        passed = sum(self.n_passed.values())
+        suppressed = sum(self.n_suppressed.values())
+        total = passed + suppressed
+        per_type = ", ".join(["%s %i/%i" % (mdesc, n, n + self.n_passed.get(mdesc, 0))
+                              for mdesc, n in sorted(self.n_suppressed.items())])
+        return ("deadband: suppressed %i of %i messages (%.1f%%)%s"
+                % (suppressed, total, 100. * suppressed / max(total, 1),
+                   ": " + per_type if per_type else ""))
+
+
+class TestDeadband(unittest.TestCase):
+    def test_thresholds(self):
+        now = [0.0]
+        db = deadband({"depth": 0.1}, heartbeat=10, clock=lambda: now[0])
+        msg = {"mdesc": "dst200depth", "depth": 4.86, "stw": 0, "strbody": "e601000081"}
+        self.assertIs(db.handle(msg), msg)
+        self.assertIsNone(db.handle(dict(msg, strbody="e601000181")))
+        self.assertIsNone(db.handle(dict(msg, depth=4.9)))
+        # The drift adds up.
+        self.assertIsNotNone(db.handle(dict(msg, depth=4.97)))
+        # No threshold for stw, any change goes.
+        self.assertIsNotNone(db.handle(dict(msg, depth=4.97, stw=1)))
+
+        now[0] = 10.0
+        self.assertIsNotNone(db.handle(dict(msg, depth=4.97, stw=1)))
+        self.assertEqual(db.n_suppressed, {"dst200depth": 2})
+        self.assertIn("suppressed 2 of 6", db.summary())
+
+    def test_output_fields(self):
+        from .decode import FDXDecode
+        now = [0.0]
+        db = deadband(clock=lambda: now[0])
+        # No GPS time. The unknown field changes every time, utctime is NaN.
+        first = FDXDecode(b"\x24\x07\x23\x00\x00\x15\x1f\x0c\xfd\x00\xfb\x81")
+        again = FDXDecode(b"\x24\x07\x23\x00\x00\x16\x1f\x0c\xfd\x00\xf8\x81")
+        self.assertNotEqual(first, again)
+        self.assertIs(db.handle(first), first)
+        self.assertIsNone(db.handle(again))
+
+        raw = deadband(clock=lambda: now[0], keep=format_json(devmode=True).keep)
+        raw.handle(first)
+        self.assertIs(raw.handle(again), again)
+
+    def test_nan(self):
+        db = deadband(clock=lambda: 0.0)
+        nan = float("NaN")
+        self.assertIsNotNone(db.handle({"mdesc": "gpscog", "cog": nan, "sog": nan}))
+        self.assertIsNone(db.handle({"mdesc": "gpscog", "cog": nan, "sog": nan}))
+        self.assertIsNotNone(db.handle({"mdesc": "gpscog", "cog": 12.0, "sog": nan}))
+        self.assertIsNone(db.handle({"mdesc": "gpscog", "cog": 12.0, "sog": nan}))
+
+
+if __name__ == "__main__":
+    unittest.main()
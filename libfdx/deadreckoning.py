@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Dead reckoning between GPS fixes.
+
+The GND10 sends gpspos about once a second, while wind and COG/SOG come
+several times a second. A chart plotter showing the boat then jumps once a
+second and lags up to a second behind. The deadreckoning stage moves the
+last fix along COG at SOG and adds estimated positions to the stream:
+
+    {"mdesc": "gpsestimate", "lat": .., "lon": .., "sog": .., "cog": ..,
+     "estimated": True}
+
+When the next real fix arrives, the difference to the estimate is faded
+out over `blend` seconds instead of making the boat jump back.
+"""
+from __future__ import print_function
+
+import unittest
+from math import cos, sin, radians
+from time import time
+
+from .state import boatstate
+
+
+def extrapolate(lat, lon, sog, cog, seconds):
+    """
+    Position after going seconds at sog knots on course cog.
+
+    Flat earth, which is fine for the few metres between fixes.
+
+    >>> lat, lon = extrapolate(59.0, 10.0, 6.0, 90, 3600)
+    >>> round(lat, 6), round(lon, 4)
+    (59.0, 10.1942)
+    """
+    distance = sog * seconds / 3600.  # nm
+    course = radians(cog)
+    dlat = distance * cos(course) / 60.
+    dlon = distance * sin(course) / (60. * cos(radians(lat)))
+    return (lat + dlat, lon + dlon)
+
+
+class deadreckoning(object):
+    """
+    Add estimated positions at up to rate per second.
+
+    The stage has no timer of its own; estimates are made as other
+    messages pass through, which with the GND10 is 20-30 times a second.
+    No estimates are made when the last fix is older than maxage seconds
+    or COG/SOG is stale.
+    """
+    def __init__(self, state, rate=10.0, blend=1.0, maxage=5.0, clock=time):
+        assert isinstance(state, boatstate)
+        self.state = state
+        self.interval = 1.0 / rate
+        self.blend = blend
+        self.maxage = maxage
+        self.clock = clock
+
+        self._fix = None
+        self._offset = (0.0, 0.0)
+        self._last = None       # (time, lat, lon) of the last estimate
+        self.n_estimates = 0
+
+    def estimate(self, now):
+        "Estimated (lat, lon) at now, or None."
+        state = self.state
+        fix = state.fields.get("position")
+        if fix is None:
+            return None
+        (lat, lon), fixtime = fix
+
+        if fix is not self._fix:
+            # New fix. Fade out the error the last estimate had.
+            self._fix = fix
+            last = self._last
+            if last is not None and now - last[0] < self.maxage:
+                self._offset = (last[1] - lat, last[2] - lon)
+            else:
+                self._offset = (0.0, 0.0)
+
+        age = now - fixtime
+        if age > self.maxage or state.stale("sog") or state.stale("cog"):
+            return None
+
+        lat, lon = extrapolate(lat, lon, state.get("sog"), state.get("cog"), age)
+        fade = max(0.0, 1.0 - age / self.blend) if self.blend else 0.0
+        return (lat + self._offset[0] * fade, lon + self._offset[1] * fade)
+
+    def handle(self, msg):
+        now = self.clock()
+        if self._last is not None and now - self._last[0] < self.interval:
+            return msg
+
+        pos = self.estimate(now)
+        if pos is None:
+            return msg
+        self._last = (now, pos[0], pos[1])
+        self.n_estimates += 1
+        return [msg, {"mdesc": "gpsestimate", "lat": pos[0], "lon": pos[1],
+                      "sog": self.state.get("sog"), "cog": self.state.get("cog"),
+                      "estimated": True}]
+
+
+class TestDeadReckoning(unittest.TestCase):
+    def test_estimate(self):
+        now = [0.0]
+        state = boatstate(clock=lambda: now[0])
+        dr = deadreckoning(state, rate=10, blend=1.0, clock=lambda: now[0])
+        msg = {"mdesc": "wsi0"}
+        self.assertIs(dr.handle(msg), msg)   # Nothing to go on.
+
+        state.update({"mdesc": "gpscog", "sog": 6.0, "cog": 0.0})
+        state.update({"mdesc": "gpspos", "lat": 59.0, "lon": 10.0})
+        r = dr.handle(msg)
+        self.assertEqual(r[1]["lat"], 59.0)
+        self.assertTrue(r[1]["estimated"])
+
+        now[0] = 0.05
+        self.assertIs(dr.handle(msg), msg)   # Rate limited.
+
+        now[0] = 0.5
+        state.update({"mdesc": "gpscog", "sog": 6.0, "cog": 0.0})
+        r = dr.handle(msg)
+        # 6 knots for half a second is 1/1200 nm north.
+        self.assertAlmostEqual(r[1]["lat"], 59.0 + 1 / 1200. / 60)
+
+        # The real fix is a bit further south. Start from the estimate and
+        # converge to the fix moved along COG.
+        now[0] = 1.0
+        state.update({"mdesc": "gpspos", "lat": 58.9999, "lon": 10.0})
+        r = dr.handle(msg)
+        self.assertAlmostEqual(r[1]["lat"], 59.0 + 1 / 1200. / 60)
+        now[0] = 1.5
+        r = dr.handle(msg)
+        expected = 58.9999 + 1 / 1200. / 60
+        self.assertAlmostEqual(r[1]["lat"], expected + (59.0 + 1 / 1200. / 60 - 58.9999) / 2)
+        now[0] = 2.0
+        state.update({"mdesc": "gpscog", "sog": 6.0, "cog": 0.0})
+        r = dr.handle(msg)
+        self.assertAlmostEqual(r[1]["lat"], 58.9999 + 1 / 600. / 60)
+
+        # GPS lost.
+        now[0] = 7.0
+        self.assertIs(dr.handle(msg), msg)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -90,6 +90,51 @@ def disect(pdu):
     return intdecoder(body)
 
 
+# Message type for each mdesc FDXDecode() knows about. Used for acting on
+# frames (like rate limiting) before they are decoded.
+mtypes = {
+    "emptymsg0": 0x000202,
+    "wsi0": 0x010405,
+    "dst200temp": 0x020301,
+    "emptymsg3": 0x030102,
+    "baker_alpha": 0x050207,
+    "baker_bravo": 0x060204,
+    "dst200depth": 0x070304,
+    "static1s": 0x080109,
+    "windsignal": 0x090108,
+    "baker_echo": 0x0a040e,
+    "baker_charlie": 0x0f040b,
+    "windstale": 0x110213,
+    "wsi1": 0x120416,
+    "gpsping": 0x130211,
+    "gnd10msg2": 0x150411,
+    "static2s_two": 0x170512,
+    "environment": 0x1a041e,
+    "wind40s": 0x1c031f,
+    "baker_foxtrot": 0x1f051a,
+    "gpspos": 0x200828,
+    "gpscog": 0x210425,
+    "baker_delta": 0x220725,
+    "static2s": 0x230526,
+    "gpstime": 0x240723,
+    "baker_juliet": 0x250421,
+    "baker_hotel": 0x260127,
+    "baker_golf": 0x270225,
+    "dst200msg0": 0x2c022e,
+    "service0": 0x2d0528,
+    "baker_lima": 0x300131,
+    "conf_able": 0x32093b,
+    "windmsg7": 0x310938,
+    "windmsg8": 0x350336,
+    "baker_kilo": 0x370136,
+    "conf_easy": 0x3d122f,
+    "conf_dog": 0x3e122c,
+    "baker_indian": 0x410a4b,
+    "windmsg3": 0x700373,
+    "bootup0": 0x769e81,
+}
+
+
 def FDXDecode(pdu):
     # Hex-encode our carefully de-encoded bytes(), to avoid refactoring
     # the whole world in one sitting.
@@ -644,7 +689,8 @@ def FDXDecode(pdu):
         mdesc = "baker_juliet"
         body = checklength(pdu, 9)
         keys = intdecoder(body)
-        assert strbody[6:8] == "00"
+        if strbody[6:8] != "00":
+            raise FailedAssumptionError(mdesc, "got %s, expected 00 in the middle" % strbody)
         keys += [("xx", body[0:8].uintle),
                  ("yy", body[8:16].uintle),
                  ("zz", body[16:24].uintle),
@@ -748,7 +794,7 @@ def FDXDecode(pdu):
             pass
         else:
             raise FailedAssumptionError(mdesc, "got %s, expected %s"
-                                        % (middle, "000081"))
+                                        % (strbody, "000081"))
 
     elif mtype == 0x3d122f:
         """3d 12 2f - conf_easy (23 bytes, not periodic)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Values computed from the instrument readings: true wind, VMG and distance.
+
+The derived stage follows the boatstate stage and adds messages of its own
+to the stream:
+
+    {"mdesc": "truewind", "twa": .., "tws": .., "twd": .., "vmg": ..}
+    {"mdesc": "trip", "distance": ..}
+
+Angles are in degrees, speeds in knots and distance in nautical miles, as
+for the decoded messages. The work per update is constant.
+"""
+from __future__ import print_function
+
+import unittest
+from math import atan2, cos, sin, sqrt, radians, degrees, hypot, asin
+
+from .state import boatstate, brownout
+
+EARTH_RADIUS = 3440.065  # nautical miles
+
+
+def true_wind(awa, aws, speed):
+    """
+    True wind angle and speed from apparent wind and boat speed.
+
+    Returns (twa, tws). Angles are relative to the bow, 0-360.
+
+    >>> twa, tws = true_wind(45, 10, 5)
+    >>> round(twa, 1), round(tws, 2)
+    (73.7, 7.37)
+    """
+    a = radians(awa)
+    # Apparent wind as a vector in the boat frame, minus the headwind from
+    # our own motion.
+    x = aws * cos(a) - speed
+    y = aws * sin(a)
+    tws = hypot(x, y)
+    if tws == 0:
+        return (0.0, 0.0)
+    return (degrees(atan2(y, x)) % 360, tws)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in nautical miles.
+
+    >>> round(haversine(59.0, 10.0, 60.0, 10.0), 2)
+    60.04
+    """
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(min(a, 1.0)))
+
+
+class derived(object):
+    """
+    Compute true wind, VMG and distance sailed as data arrives.
+
+    Boat speed is the log (stw) if it is current and not zero, else speed
+    over ground.
+    The GND10 has no compass, so the true wind direction uses COG as the
+    heading; it is left out when there is no current COG.
+
+    Must come after the boatstate stage, which holds the inputs. The
+    computed values are added to the same boatstate.
+    """
+    def __init__(self, state):
+        assert isinstance(state, boatstate)
+        self.state = state
+        self.distance = 0.0
+        self._wind = None
+        self._pos = None
+
+    def boatspeed(self):
+        state = self.state
+        # The DST200 gives a speed of 0 when it has no paddle wheel.
+        if not state.stale("stw") and state.get("stw") > 0:
+            return state.get("stw")
+        if not state.stale("sog"):
+            return state.get("sog")
+        return None
+
+    def wind(self):
+        "The truewind message for the current state, or None."
+        state = self.state
+        speed = self.boatspeed()
+        awa = state.get("awa")
+        aws = state.get("aws")
+        if speed is None or awa is None or aws is None:
+            return None
+
+        twa, tws = true_wind(awa, aws, speed)
+        r = {"mdesc": "truewind", "twa": twa, "tws": tws,
+             "vmg": speed * cos(radians(twa)) + 0.0}  # No -0.0
+        if not state.stale("cog"):
+            r["twd"] = (state.get("cog") + twa) % 360
+        return r
+
+    def handle(self, msg):
+        mdesc = msg["mdesc"]
+        if mdesc == "wsi0":
+            # Brown outs do not update the state, and give no true wind.
+            if brownout(msg):
+                return msg
+            wind = self.state.fields.get("awa")
+            if wind is None or wind is self._wind:
+                return msg
+            self._wind = wind
+            r = self.wind()
+            if r is not None:
+                self.state.update(r)
+                return [msg, r]
+
+        elif mdesc == "gpspos":
+            pos = self.state.get("position")
+            if pos is None or pos is self._pos:
+                return msg
+            if self._pos is not None:
+                self.distance += haversine(self._pos[0], self._pos[1], pos[0], pos[1])
+            self._pos = pos
+            r = {"mdesc": "trip", "distance": self.distance}
+            self.state.update(r)
+            return [msg, r]
+        return msg
+
+
+class TestDerived(unittest.TestCase):
+    def test_true_wind(self):
+        # Head to wind, the boat speed is all headwind.
+        twa, tws = true_wind(0, 15, 5)
+        self.assertEqual((twa, tws), (0.0, 10.0))
+        # Running before 10 knots at 4 knots.
+        twa, tws = true_wind(180, 6, 4)
+        self.assertEqual((round(twa), tws), (180, 10.0))
+        # Port side.
+        twa, tws = true_wind(315, 10, 5)
+        self.assertAlmostEqual(twa, 360 - 73.675, places=3)
+        # Motoring in no wind.
+        self.assertEqual(true_wind(0, 5, 5), (0.0, 0.0))
+
+    def test_stage(self):
+        now = [0.0]
+        state = boatstate(clock=lambda: now[0])
+        d = derived(state)
+
+        def feed(msg):
+            state.update(msg)
+            return d.handle(msg)
+
+        wind = {"mdesc": "wsi0", "awa": 45.0, "aws_lo": 10.0, "aws_hi": 10.0}
+        self.assertIs(feed(wind), wind)   # No boat speed yet.
+        feed({"mdesc": "dst200depth", "depth": 5.0, "stw": 5.0})
+        feed({"mdesc": "gpscog", "sog": 5.2, "cog": 100.0})
+        r = feed(wind)
+        self.assertEqual(r[1]["mdesc"], "truewind")
+        self.assertAlmostEqual(r[1]["twa"], 73.675, places=3)
+        self.assertAlmostEqual(r[1]["twd"], 173.675, places=3)
+        self.assertAlmostEqual(r[1]["vmg"], 5.0 * cos(radians(r[1]["twa"])))
+        self.assertEqual(state.get("tws"), r[1]["tws"])
+
+        # No paddle wheel, the log says 0.
+        feed({"mdesc": "dst200depth", "depth": 5.0, "stw": 0.0})
+        self.assertEqual(d.boatspeed(), 5.2)
+
+        # Brown out, from the decoder. No true wind from the zeroes.
+        from .decode import FDXDecode
+        now[0] = 1.0
+        brown = FDXDecode(b"\x01\x04\x05\xff\xff\x00\x00\x00\x81")
+        self.assertIs(feed(brown), brown)
+        self.assertEqual(state.get("awa"), 45.0)
+        self.assertEqual(state.timestamp("twa"), 0.0)
+
+        r = feed({"mdesc": "gpspos", "lat": 59.0, "lon": 10.0})
+        self.assertEqual(r[1], {"mdesc": "trip", "distance": 0.0})
+        r = feed({"mdesc": "gpspos", "lat": 59.01, "lon": 10.0})
+        self.assertAlmostEqual(r[1]["distance"], 0.6, places=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
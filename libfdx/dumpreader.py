@@ -57,12 +57,12 @@ def nxbdump(nxbfile, seek=0):
 
     lastidx = seek
     while True:
-        idx = content[lastidx:].find(b'\x81')
+        idx = content.find(b'\x81', lastidx)
         if idx == -1:
             break
 
-        yield (0.0, content[lastidx:lastidx+idx+1])
-        lastidx = lastidx + idx + 1
+        yield (0.0, content[lastidx:idx+1])
+        lastidx = idx + 1
 
 
 def dumpreader(inputfile, seek=0):
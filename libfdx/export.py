@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Export decoded dump files as columns, for analysis with NumPy or pandas.
+
+Every numeric field becomes a float64 column, with NaN where there is no
+value. Two layouts:
+
+* per message type: a table for each mdesc, with a time column and one
+  column per field. In .npz files the columns are named "mdesc.field".
+* resampled: one table with a row every n seconds, holding the latest
+  value of every "mdesc.field" at that time.
+
+Columns are spooled to temporary files while reading, so memory use does
+not grow with the size of the input. The .npz files are written without
+compression and can be loaded with numpy.load() directly:
+
+    >>> data = numpy.load("race.npz")           # doctest: +SKIP
+    >>> data["wsi0.awa"].mean()                   # doctest: +SKIP
+"""
+from __future__ import print_function
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from array import array
+from calendar import timegm
+from datetime import datetime
+from decimal import Decimal
+from os.path import join
+
+from .interfaces import HEXinterface
+
+nan = float("NaN")
+
+# Raw representations and the message type, no use as columns.
+skipkeys = frozenset(["mdesc", "strbody", "ints"])
+
+_descr = "<f8" if sys.byteorder == "little" else ">f8"
+_headerlen = 128   # Room for the .npy header, written when the length is known.
+
+
+def numeric(v):
+    """
+    Value as a float for a column, or None if it is not a number.
+
+    >>> numeric(Decimal("2.5")), numeric(True), numeric("x")
+    (2.5, 1.0, None)
+    >>> numeric(datetime(2016, 8, 24, 17, 5, 53))
+    1472058353.0
+    """
+    if isinstance(v, (bool, int, float, Decimal)):
+        return float(v)
+    if isinstance(v, datetime):
+        return float(timegm(v.timetuple())) + v.microsecond / 1e6
+    degrees = getattr(v, "decimal_degree", None)  # Latitude/Longitude
+    if degrees is not None:
+        return float(degrees)
+    return None
+
+
+def npy_header(nrows):
+    "Header of a .npy (format 1.0) file with nrows float64, padded to _headerlen."
+    d = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (_descr, nrows)
+    pad = _headerlen - 10 - len(d) - 1
+    return b"\x93NUMPY\x01\x00" + bytearray([_headerlen - 10, 0]) \
+        + (d + " " * pad + "\n").encode("latin1")
+
+
+class table(object):
+    """
+    Float64 columns, spooled to disk in chunks.
+
+    Columns can be added at any time; the earlier rows get NaN.
+    """
+    chunk = 4096
+
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.columns = []       # Names, in order of appearance.
+        self.paths = {}
+        self.pending = {}       # name -> array of rows not yet on disk
+        self.nrows = 0
+
+    def _add_column(self, name):
+        path = join(self.tmpdir, "col%i" % len(os.listdir(self.tmpdir)))
+        with open(path, "wb") as fp:
+            fp.write(b"\0" * _headerlen)
+        self.columns.append(name)
+        self.paths[name] = path
+        self.pending[name] = array("d", [nan]) * (self.nrows % self.chunk)
+        # Whole chunks before this column was seen.
+        filler = array("d", [nan]) * (self.nrows - self.nrows % self.chunk)
+        with open(path, "ab") as fp:
+            filler.tofile(fp)
+
+    def append(self, row):
+        "Add a row, given as a dict of column name to float."
+        for name in row:
+            if name not in self.paths:
+                self._add_column(name)
+        for name in self.columns:
+            self.pending[name].append(row.get(name, nan))
+        self.nrows += 1
+        if self.nrows % self.chunk == 0:
+            self.flush()
+
+    def flush(self):
+        for name, values in self.pending.items():
+            with open(self.paths[name], "ab") as fp:
+                values.tofile(fp)
+            del values[:]
+
+    def finish(self):
+        "Write out what is pending and the .npy headers. Returns the column files."
+        self.flush()
+        header = npy_header(self.nrows)
+        for path in self.paths.values():
+            with open(path, "r+b") as fp:
+                fp.write(header)
+        return [(name, self.paths[name]) for name in self.columns]
+
+    def rows(self, columns):
+        "Iterate over the rows of the finished table, as lists of floats."
+        files = [open(path, "rb") for _, path in columns]
+        try:
+            for fp in files:
+                fp.seek(_headerlen)
+            left = self.nrows
+            while left > 0:
+                n = min(left, self.chunk)
+                chunk = []
+                for fp in files:
+                    values = array("d")
+                    values.fromfile(fp, n)
+                    chunk.append(values)
+                for row in zip(*chunk):
+                    yield row
+                left -= n
+        finally:
+            for fp in files:
+                fp.close()
+
+
+def _csvvalue(v):
+    return "" if v != v else repr(v)
+
+
+class columnexport(object):
+    """
+    Collect decoded messages into tables and write them as .npz or .csv.
+
+    With resample set to a number of seconds, one table is made with a row
+    every resample seconds. Values older than maxage seconds are NaN.
+    """
+    def __init__(self, resample=None, maxage=5.0):
+        self.resample = resample
+        self.maxage = maxage
+        self.tmpdir = tempfile.mkdtemp(prefix="fdxexport")
+        self.tables = {}        # mdesc (or None when resampling) -> table
+        self.latest = {}        # "mdesc.field" -> (ts, value), when resampling
+        self.next_sample = None
+        self.n_msg = 0
+
+    def _table(self, key):
+        t = self.tables.get(key)
+        if t is None:
+            tmpdir = join(self.tmpdir, "t%i" % len(self.tables))
+            os.mkdir(tmpdir)
+            t = self.tables[key] = table(tmpdir)
+        return t
+
+    def add(self, ts, msg):
+        self.n_msg += 1
+        mdesc = msg["mdesc"]
+        row = {"time": ts}
+        for key, value in msg.items():
+            if key in skipkeys:
+                continue
+            value = numeric(value)
+            if value is not None:
+                row[key] = value
+
+        if not self.resample:
+            self._table(mdesc).append(row)
+            return
+
+        if self.next_sample is None:
+            self.next_sample = ts
+        while self.next_sample <= ts:
+            self.sample(self.next_sample)
+            self.next_sample += self.resample
+        for key, value in row.items():
+            if key != "time":
+                self.latest[mdesc + "." + key] = (ts, value)
+
+    def sample(self, now):
+        row = {"time": now}
+        for name, (ts, value) in self.latest.items():
+            if now - ts <= self.maxage:
+                row[name] = value
+        self._table(None).append(row)
+
+    def columns(self):
+        "[(name, path)] for all columns, named mdesc.field unless resampling."
+        r = []
+        for key in sorted(self.tables, key=str):
+            for name, path in self.tables[key].finish():
+                r.append((name if key is None else "%s.%s" % (key, name), path))
+        return r
+
+    def write_npz(self, path):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, colpath in self.columns():
+                zf.write(colpath, name + ".npy")
+
+    def write_csv(self, path):
+        """
+        Resampled: a single CSV file at path. Per message type: a directory
+        with a CSV file for each.
+        """
+        if not self.resample and not os.path.isdir(path):
+            os.mkdir(path)
+        for key in sorted(self.tables, key=str):
+            t = self.tables[key]
+            columns = t.finish()
+            outfile = path if key is None else join(path, key + ".csv")
+            with open(outfile, "w") as fp:
+                writer = csv.writer(fp, lineterminator="\n")
+                writer.writerow([name for name, _ in columns])
+                for row in t.rows(columns):
+                    writer.writerow([_csvvalue(v) for v in row])
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def export(inputs, output, to="npz", resample=None, tolerance=5.0):
+    """
+    Decode the dump files in inputs and write them to output.
+
+    Returns the message count, or for tracks (gpx, kml) the number of
+    points in and out of the simplification.
+    """
+    if to in ("gpx", "kml"):
+        from .track import export_track
+        return export_track(inputs, output, to=to, tolerance=tolerance)
+
+    exporter = columnexport(resample=resample)
+    try:
+        for inputfile in inputs:
+            reader = HEXinterface(inputfile)
+            for msg in reader.recvmsg():
+                exporter.add(reader.ts, msg)
+        if to == "npz":
+            exporter.write_npz(output)
+        elif to == "csv":
+            exporter.write_csv(output)
+        else:
+            raise ValueError("Unknown export format %s" % to)
+    finally:
+        exporter.close()
+    return exporter.n_msg
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def feed(self, exporter):
+        exporter.add(0.0, {"mdesc": "dst200depth", "depth": 4.86, "stw": 0.0,
+                           "strbody": "e601000081"})
+        exporter.add(0.2, {"mdesc": "wsi0", "awa": Decimal("245.5"), "aws_lo": 3.2})
+        exporter.add(0.5, {"mdesc": "dst200depth", "depth": 4.9, "stw": 0.0, "new": 1})
+        exporter.add(1.1, {"mdesc": "wsi0", "awa": Decimal("250"), "aws_lo": 3.0})
+
+    def test_csv(self):
+        exporter = columnexport()
+        self.feed(exporter)
+        exporter.write_csv(join(self.tmpdir, "out"))
+        exporter.close()
+        with open(join(self.tmpdir, "out", "dst200depth.csv")) as fp:
+            rows = list(csv.reader(fp))
+        self.assertEqual(rows[0][:3], ["time", "depth", "stw"])
+        self.assertEqual(rows[1][-1], "")    # Not there yet.
+        self.assertEqual(len(rows), 3)
+
+        exporter = columnexport(resample=0.5)
+        self.feed(exporter)
+        exporter.write_csv(join(self.tmpdir, "resampled.csv"))
+        with open(join(self.tmpdir, "resampled.csv")) as fp:
+            rows = list(csv.DictReader(fp))
+        self.assertEqual([r["time"] for r in rows], ["0.0", "0.5", "1.0"])
+        self.assertEqual(rows[1]["wsi0.awa"], "245.5")
+        self.assertEqual(rows[2]["dst200depth.depth"], "4.9")
+
+    def test_npz(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy is needed to load the .npz")
+        exporter = columnexport()
+        exporter.tables["many"] = t = table(tempfile.mkdtemp(dir=exporter.tmpdir))
+        for idx in range(10000):  # More than a chunk.
+            t.append({"time": float(idx)} if idx < 5000 else {"time": float(idx), "x": 1.0})
+        self.feed(exporter)
+        path = join(self.tmpdir, "out.npz")
+        exporter.write_npz(path)
+        exporter.close()
+
+        data = numpy.load(path)
+        self.assertEqual(data["wsi0.awa"].dtype, numpy.float64)
+        self.assertEqual(list(data["wsi0.awa"]), [245.5, 250.0])
+        self.assertTrue(numpy.isnan(data["dst200depth.new"][0]))
+        self.assertEqual(data["many.time"][-1], 9999.0)
+        self.assertEqual(numpy.isnan(data["many.x"]).sum(), 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
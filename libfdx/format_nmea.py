@@ -23,7 +23,7 @@ from __future__ import print_function
 
 import logging
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import reduce
 from math import isnan
 from operator import xor
@@ -31,141 +31,209 @@ from pprint import pprint, pformat
 
 from LatLon23 import LatLon, Latitude, Longitude
 
+from .formats import knots2m
+from .state import boatstate
 
-def nmeapos(pos):
+
+_py2 = not hasattr(int, "from_bytes")
+
+
+def checksum(body):
     """
-    >>> nmeapos(LatLon("54.1024833333", "10.8079"))
-    ['5406.15', 'N', '1048.47', 'E']
+    NMEA0183 checksum, the XOR of all bytes between $ and *.
+
+    The bytes are folded onto each other as one big integer, so the loop
+    runs a handful of times instead of once per character.
+
+    >>> "%02X" % checksum(b"GPHDT,344.47,T")
+    '05'
     """
-    assert isinstance(pos, LatLon)
+    if _py2:
+        return reduce(xor, bytearray(body), 0)
+
+    n = int.from_bytes(body, "little")
+    width = len(body)
+    while width > 1:
+        half = (width + 1) // 2
+        n = (n >> (half * 8)) ^ (n & ((1 << (half * 8)) - 1))
+        width = half
+    return n
 
+# Precomputed "*hh\r\n" for every checksum value.
+# NMEA0183 uses \r\n as line separator even on Unix systems.
+_tails = [("*%02X\r\n" % i).encode("ascii") for i in range(256)]
+
+
+def nmeapos(lat, lon):
+    """
+    Format a position in decimal degrees as NMEA0183 lat,N,lon,E fields.
+
+    >>> nmeapos(54.1024833333, 10.8079)
+    '5406.15,N,1048.47,E'
+    >>> nmeapos(-33.85, -151.2)
+    '3351.00,S,15112.00,W'
+    """
     def fmt(p):
-        s = p.to_string("%d")
-        assert len(s) >= 1
-        decmin = float(p.to_string("%M"))
+        p = abs(p)
+        degrees = int(p)
+        decmin = (p - degrees) * 60.
         assert decmin / 10. <= 60
-        s += ("%.2f" % decmin).zfill(5)
-        return s
+        return "%d%s" % (degrees, ("%.2f" % decmin).zfill(5))
 
-    return [fmt(pos.lat), pos.to_string("H")[0],
-            fmt(pos.lon), pos.to_string("H")[1]]
+    return "%s,%s,%s,%s" % (fmt(lat), "S" if lat < 0 else "N",
+                            fmt(lon), "W" if lon < 0 else "E")
+
+
+def decimal_degrees(p):
+    "Latitude/Longitude objects (or plain numbers) as a float."
+    return float(getattr(p, "decimal_degree", p))
+
+
+# Sentence templates. The fields are filled in with %, and $ and the
+# checksum are added by _add().
+DBT = "SDDBT,,f,%s,m,,F"                # $--DBT,x.x,f,x.x,M,x.x,F*hh
+VHW = "SDVHW,0.0,T,0.0,M,%.2f,N,0.0,K"  # $--VHW,x.x,T,x.x,M,x.x,N,x.x,K*hh
+RMC = "GPRMC,%s,A,%s,%.2f,%.2f,%s,0.0,E"
+HDT = "GPHDT,%.2f,T"                    # $--HDT,x.x,T*hh
+MWV = "FVMWV,%.2f,R,%.2f,K,A"           # (R)elative, not (T)rue. Knots, valid.
+XDR_PRESSURE = "ZZXDR,P,%.5f,B,Barometer"
+XDR_TEMP = "ZZXDR,C,%.2f,C,TempDir"
+# Dead reckoning, see deadreckoning.py. Status V and mode E (estimated), as
+# NMEA 0183 v2.3 wants for anything that is not a real fix.
+GLL_ESTIMATED = "GPGLL,%s,%s,V,E"       # $--GLL,llll.ll,a,yyyyy.yy,a,hhmmss.ss,A,a*hh
+RMC_ESTIMATED = "GPRMC,%s,V,%s,%.2f,%.2f,%s,0.0,E,E"
+# Derived values, see derived.py.
+MWV_TRUE = "FVMWV,%.2f,T,%.2f,N,A"
+MWD = "FVMWD,%.2f,T,,M,%.2f,N,%.2f,M"   # $--MWD,x.x,T,x.x,M,x.x,N,x.x,M*hh
+VPW = "FVVPW,%.2f,N,,M"                 # $--VPW,x.x,N,x.x,M*hh
+VLW = "FVVLW,,N,%.2f,N"                 # $--VLW,x.x,N,x.x,N*hh (total, trip)
 
 
 class format_NMEA0183(object):
-    def __init__(self):
-        self.gpstime = None
-        self.gpspos = None
+    """
+    NMEA0183 sentences from decoded messages.
 
-    def handle(self, sample):
+    Time and position for RMC come from a boatstate. Give the one fed by
+    the reader loop as state; without it the formatter keeps its own.
+    """
+    handled = frozenset(["dst200depth", "gpscog", "wsi0", "environment",
+                         "truewind", "trip", "gpsestimate"])
+
+    def __init__(self, state=None):
+        self.ownstate = state is None
+        self.state = boatstate() if state is None else state
+        # Formatted once per fix, used for every sentence until the next.
+        self._time = None
+        self._timestr = None
+        self._datestr = None
+        self._pos = None
+        self._posstr = None
+        self.buf = bytearray()
+        # Depth, pressure and the (constant) VHW repeat a lot, so keep the
+        # tails of recently seen sentences around.
+        self._tailcache = {}
+
+    @property
+    def gpstime(self):
+        return self.state.get("time")
+
+    @property
+    def gpspos(self):
+        return self.state.get("position")
+
+    def _add(self, template, values):
+        body = (template % values).encode("ascii")
+        tail = self._tailcache.get(body)
+        if tail is None:
+            if len(self._tailcache) > 4096:
+                self._tailcache.clear()
+            tail = self._tailcache[body] = _tails[checksum(body)]
+        buf = self.buf
+        buf += b"$"
+        buf += body
+        buf += tail
+
+    def encode(self, sample):
+        """
+        Translate a decoded message into NMEA0183 sentences.
+
+        Returns bytes, or None if there is nothing to send for this message.
+        """
         assert type(sample) == dict
-        result = []
-
-        if sample["mdesc"] == "dst200depth":
-            # $--DBT,x.x,f,x.x,M,x.x,F*hh<CR><LF>
-            result += [("$SDDBT",
-                        "",
-                        "f",
-                        "%s" % sample["depth"],
-                        "m",
-                        "",
-                        "F")]
-            # $--VHW,x.x,T,x.x,M,x.x,N,x.x,K*hh<CR><LF>
-
-            result += [("$SDVHW",
-                        "0.0",
-                        "T",
-                        "0.0",
-                        "M",
-                        "%.2f" % sample["stw"],
-                        "N",
-                        "0.0",
-                        "K")]
-
-        elif sample["mdesc"] == "gpstime":
-            if isinstance(sample["utctime"], str):  # For the test cases.
-                sample["utctime"] = datetime.strptime(sample["utctime"],
-                                                      "%Y-%m-%dT%H:%M:%S")
-            # Will be used later on.
-            if isinstance(sample["utctime"], datetime):
-                self.gpstime = sample["utctime"]
-
-            assert self.gpstime is None or isinstance(self.gpstime, datetime)
-
-        elif sample["mdesc"] == "gpspos":
-            lat = sample["lat"]
-            lon = sample["lon"]
-
-            if isnan(lat) or isnan(lon):
-                pass
-            else:
-                self.gpspos = LatLon(lat, lon)
+        mdesc = sample["mdesc"]
+        if self.ownstate:
+            if mdesc == "gpstime" and isinstance(sample["utctime"], str):
+                # For the test cases.
+                sample = dict(sample, utctime=datetime.strptime(
+                    sample["utctime"], "%Y-%m-%dT%H:%M:%S"))
+            self.state.update(sample)
+
+        if mdesc not in self.handled:
+            return None
+        del self.buf[:]
 
-        elif sample["mdesc"] == "gpscog":
-            if self.gpstime is None or self.gpspos is None:
+        if mdesc == "dst200depth":
+            self._add(DBT, (sample["depth"],))
+            self._add(VHW, (sample["stw"],))
+
+        elif mdesc == "gpscog":
+            utctime = self.state.get("time")
+            pos = self.state.get("position")
+            if utctime is None or pos is None:
                 # Not enough data yet.
                 pass
             else:
-                rmc = ["$GPRMC",
-                       self.gpstime.strftime("%H%M%S"),
-                       "A"]
-                rmc += nmeapos(self.gpspos)
-                rmc += ["%.2f" % sample["sog"],
-                        "%.2f" % sample["cog"],
-                        self.gpstime.strftime("%d%m%y"),
-                        "0.0",  # magn var
-                        "E"]
-                result.append(tuple(rmc))
-
-                #  $--HDT,x.x,T*hh<CR><LF>
-                result.append(("$GPHDT",
-                               "%.2f" % sample["cog"],
-                               "T"))
-
-        elif sample["mdesc"] == "wsi0":
-            #  $--MWV,x.x,a,x.x,a*hh<CR><LF>
-            result += [("$FVMWV",
-                        "%.2f" % sample["awa"],
-                        "R",  # (R)elative, not (T)rue.
-                        "%.2f" % sample["aws_lo"],
-                        "K",    # knots
-                        "A")   # (valid)
-                       ]
-
-        elif sample["mdesc"] == "environment":
+                if utctime is not self._time:
+                    self._time = utctime
+                    self._timestr = utctime.strftime("%H%M%S")
+                    self._datestr = utctime.strftime("%d%m%y")
+                if pos is not self._pos:
+                    self._pos = pos
+                    self._posstr = nmeapos(*pos)
+                self._add(RMC, (self._timestr, self._posstr, sample["sog"],
+                                sample["cog"], self._datestr))
+                self._add(HDT, (sample["cog"],))
+
+        elif mdesc == "wsi0":
+            self._add(MWV, (sample["awa"], sample["aws_lo"]))
+
+        elif mdesc == "environment":
             # $IIXDR,P,1.02481,B,Barometer*0D
             # $IIXDR,C,19.52,C,TempAir*3D
-            result += [("$ZZXDR",
-                        "P",
-                        "%.5f" % sample["airpressure"],
-                        "B", "Barometer"),
-                       ("$ZZXDR",
-                        "C",
-                        "%.2f" % sample.get("temp_c", 0.0),
-                        "C",
-                        "TempDir")
-                       ]
-
-        result = [",".join(x) for x in result]  # Make it a string.
-        return self.checksum(result or None)
-
-    def checksum(self, samples):
-        if samples is None:
-            return None
+            self._add(XDR_PRESSURE, (sample["airpressure"],))
+            self._add(XDR_TEMP, (sample.get("temp_c", 0.0),))
+
+        elif mdesc == "gpsestimate":
+            posstr = nmeapos(sample["lat"], sample["lon"])
+            utctime = self.state.get("time")
+            if utctime is None:
+                self._add(GLL_ESTIMATED, (posstr, ""))
+            else:
+                # GPS time moved on by the time since it arrived.
+                utctime += timedelta(seconds=self.state.age("time"))
+                timestr = utctime.strftime("%H%M%S") + ".%02d" % (utctime.microsecond // 10000)
+                self._add(GLL_ESTIMATED, (posstr, timestr))
+                self._add(RMC_ESTIMATED, (timestr, posstr, sample["sog"], sample["cog"],
+                                          utctime.strftime("%d%m%y")))
+
+        elif mdesc == "truewind":
+            self._add(MWV_TRUE, (sample["twa"], sample["tws"]))
+            if "twd" in sample:
+                self._add(MWD, (sample["twd"], sample["tws"], knots2m(sample["tws"])))
+            self._add(VPW, (sample["vmg"],))
 
-        completed = []
-        for sentence in samples:
-            assert sentence[0] == "$"
-            cksum = reduce(xor, (ord(s) for s in sentence[1:]))
-            completed.append("%s*%02X" % (sentence, cksum))
+        elif mdesc == "trip":
+            self._add(VLW, (sample["distance"],))
 
-        if len(completed) == 0:
+        if not self.buf:
             return None
+        return bytes(self.buf)
 
-        # NMEA0183 uses \r\n as line separator even on Unix systems.
-        s = ""
-        for line in completed:
-            s = s + line + "\r\n"
-        return s
+    def handle(self, sample):
+        r = self.encode(sample)
+        if r is None:
+            return None
+        return r.decode("ascii")
 
 
 class TestNMEA0183(unittest.TestCase):
@@ -174,9 +242,10 @@ class TestNMEA0183(unittest.TestCase):
         r = formatter.handle({"mdesc": "gpspos",
                               "lat": 54.10246, "lon": 10.8079})
         assert r is None   # Should be empty.
-        r = formatter.handle({"utctime": "2017-01-12T19:16:55",
-                              "mdesc": "gpstime"})
+        msg = {"utctime": "2017-01-12T19:16:55", "mdesc": "gpstime"}
+        r = formatter.handle(msg)
         assert r is None   # Should be empty also.
+        assert msg["utctime"] == "2017-01-12T19:16:55"
 
         r = formatter.handle({"mdesc": "gpscog", "sog": 0.16,
                               "cog": 344.47058823529414})
@@ -192,6 +261,41 @@ class TestNMEA0183(unittest.TestCase):
         assert isinstance(r, str)
         assert r == "$ZZXDR,P,101.42000,B,Barometer*21\r\n$ZZXDR,C,21.00,C,TempDir*10\r\n"
 
+    def test_encode(self):
+        formatter = format_NMEA0183()
+        r = formatter.encode({"mdesc": "dst200depth", "depth": 4.86, "stw": 0})
+        assert isinstance(r, bytes)
+        self.assertEqual(r, b"$SDDBT,,f,4.86,m,,F*1C\r\n$SDVHW,0.0,T,0.0,M,0.00,N,0.0,K*72\r\n")
+        # Same again, now with the checksums cached.
+        self.assertEqual(formatter.encode({"mdesc": "dst200depth", "depth": 4.86, "stw": 0}), r)
+        self.assertIsNone(formatter.encode({"mdesc": "static1s", "xx": 21}))
+
+    def test_derived(self):
+        formatter = format_NMEA0183()
+        r = formatter.encode({"mdesc": "truewind", "twa": 73.6, "tws": 7.37,
+                              "twd": 173.6, "vmg": 1.41})
+        self.assertEqual(r.split(b"\r\n")[:3],
+                         [b"$FVMWV,73.60,T,7.37,N,A*1A", b"$FVMWD,173.60,T,,M,7.37,N,3.79,M*47",
+                          b"$FVVPW,1.41,N,,M*58"])
+        self.assertEqual(formatter.encode({"mdesc": "trip", "distance": 12.345}),
+                         b"$FVVLW,,N,12.35,N*76\r\n")
+
+    def test_estimate(self):
+        now = [100.0]
+        formatter = format_NMEA0183(state=boatstate(clock=lambda: now[0]))
+        msg = {"mdesc": "gpsestimate", "lat": 59.8, "lon": 10.6, "sog": 5.0, "cog": 90.0,
+               "estimated": True}
+        self.assertEqual(formatter.encode(msg), b"$GPGLL,5948.00,N,1036.00,E,,V,E*60\r\n")
+        formatter.state.update({"mdesc": "gpstime", "utctime": datetime(2016, 8, 24, 17, 5, 53)})
+        now[0] = 100.25
+        r = formatter.encode(msg).split(b"\r\n")
+        self.assertEqual(r[0], b"$GPGLL,5948.00,N,1036.00,E,170553.25,V,E*4C")
+        self.assertEqual(r[1], b"$GPRMC,170553.25,V,5948.00,N,1036.00,E,5.00,90.00,240816,0.0,E,E*25")
+
+    def test_checksum(self):
+        for body in [b"", b"G", b"GPHDT,344.47,T", b"x" * 101]:
+            self.assertEqual(checksum(body), reduce(xor, bytearray(body), 0))
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -31,9 +31,12 @@ from math import radians, degrees
 from pprint import pprint, pformat
 from sys import argv, stdin, stdout, stderr
 from os import linesep
+from time import time
 
 from LatLon23 import LatLon, Latitude, Longitude
 
+from .state import boatstate
+
 
 def fahr2kelvin(temp):
     assert type(temp) in [float, int]
@@ -64,16 +67,103 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
+# Encoders for the value types the decoder produces, giving the same
+# output as json.dumps(..., default=json_serial) without going through the
+# generic encoder and the isinstance() chain for every value.
+_jsonstr = json.encoder.encode_basestring_ascii
+_inf = float("inf")
+
+
+def _jsonfloat(v):
+    if v != v:
+        return "NaN"
+    elif v == _inf:
+        return "Infinity"
+    elif v == -_inf:
+        return "-Infinity"
+    return float.__repr__(v)
+
+
+def _jsonfallback(v):
+    return json.dumps(v, default=json_serial)
+
+_jsonencoders = {
+    float: _jsonfloat,
+    int: int.__repr__,
+    bool: lambda v: "true" if v else "false",
+    type(None): lambda v: "null",
+    str: _jsonstr,
+    datetime: lambda v: _jsonstr(v.isoformat()),
+    Decimal: lambda v: _jsonstr("{0:.3}".format(v)),
+    Latitude: lambda v: _jsonfloat(float(v.to_string("D"))),
+    Longitude: lambda v: _jsonfloat(float(v.to_string("D"))),
+}
+
+
+def jsonvalue(v):
+    "Serialize a single value, as json.dumps(v, default=json_serial) would."
+    return _jsonencoders.get(type(v), _jsonfallback)(v)
+
+
+def _jsonobject(keys):
+    """
+    Precompile the serializer for a dict with these keys, in this order.
+
+    Returns a function taking the dict.
+
+    >>> _jsonobject(("a", "b"))({"a": 1.5, "b": "x", "c": 3})
+    '{"a": 1.5, "b": "x"}'
+    """
+    prefixes = []
+    for idx, key in enumerate(keys):
+        prefixes.append(("{" if idx == 0 else ", ") + _jsonstr(key) + ": ")
+    fields = list(zip(prefixes, keys))
+    if not fields:
+        return lambda s: "{}"
+
+    encoders = _jsonencoders
+    fallback = _jsonfallback
+
+    def serialize(s):
+        return "".join([prefix + encoders.get(type(s[key]), fallback)(s[key])
+                        for prefix, key in fields]) + "}"
+    return serialize
+
+
 class format_signalk_delta(object):
     """
     Translation between our internal format and Signal K
     delta format.
+
+    With coalesce set to a number of seconds, values are collected for that
+    long and sent as a single delta with the latest value for each path.
+    A delta is sent when a message arrives after the window has passed, so
+    the added latency is the window plus the gap until the next message.
+
+    The delta timestamp is the GPS time from state. Without a shared
+    boatstate the formatter keeps its own.
     """
-    def __init__(self):
-        self.gpstime = None
+    def __init__(self, coalesce=0.0, clock=time, state=None):
+        self.ownstate = state is None
+        self.state = boatstate(clock=clock) if state is None else state
+        self._pathprefix = {}
+        # Once there are estimated positions, tell which positions are real.
+        self.estimating = False
 
-    def handle(self, s):
+        self.coalesce = coalesce
+        self.clock = clock
+        self.pending = {}   # path -> latest value
+        self.window_start = None
+
+    def values(self, s):
+        """
+        Translate a decoded message into a list of (path, value) tuples.
+
+        Empty list if there is nothing to report for this message.
+        """
         assert isinstance(s, dict)
+        if self.ownstate:
+            self.state.update(s)
 
         r = []
         if s["mdesc"] == "wsi0":
@@ -88,57 +178,128 @@ class format_signalk_delta(object):
         elif s["mdesc"] == "gpspos":
             r += [("navigation.position.latitude", s["lat"]),
                   ("navigation.position.longitude", s["lon"])]
+            if self.estimating:
+                r += [("navigation.gnss.methodQuality", "GNSS Fix")]
+        elif s["mdesc"] == "gpsestimate":
+            # Dead reckoning, see deadreckoning.py.
+            self.estimating = True
+            r += [("navigation.position.latitude", s["lat"]),
+                  ("navigation.position.longitude", s["lon"]),
+                  ("navigation.gnss.methodQuality", "Estimated (DR) mode")]
         elif s["mdesc"] == "gpscog":
             r += [('navigation.courseOverGroundTrue', radians(s["cog"])),
                   ('navigation.speedOverGroundTrue', knots2m(s["sog"]))]
         elif s["mdesc"] == "gpstime":
             if isinstance(s["utctime"], datetime):
                 r += [("navigation.datetime.value", s["utctime"].isoformat())]
-                self.gpstime = s["utctime"]
+        elif s["mdesc"] == "truewind":
+            twa = s["twa"] if s["twa"] <= 180 else s["twa"] - 360  # -pi..pi
+            r += [('environment.wind.angleTrueWater', radians(twa)),
+                  ('environment.wind.speedTrue', knots2m(s["tws"])),
+                  ('performance.velocityMadeGood', knots2m(s["vmg"]))]
+            if "twd" in s:
+                r += [('environment.wind.directionTrue', radians(s["twd"]))]
+        elif s["mdesc"] == "trip":
+            r += [('navigation.trip.log', s["distance"] * 1852.0)]
+        return r
 
-        if len(r) == 0:
+    @property
+    def gpstime(self):
+        return self.state.get("time")
+
+    def serialize(self, r, timestamp=None):
+        "Serialize a list of (path, value) tuples as a delta."
+        if timestamp is None:
+            timestamp = self.gpstime
+
+        values = []
+        for path, value in r:
+            prefix = self._pathprefix.get(path)
+            if prefix is None:
+                prefix = '{"path": %s, "value": ' % _jsonstr(path)
+                self._pathprefix[path] = prefix
+            values.append(prefix + jsonvalue(value) + "}")
+
+        return ('{"updates": {"timestamp": ' + jsonvalue(timestamp)
+                + ', "source": "fdxread", "values": [' + ", ".join(values)
+                + ']}}' + linesep)
+
+    def handle(self, s):
+        r = self.values(s)
+        if not self.coalesce:
+            if len(r) == 0:
+                return None
+            return self.serialize(r)
+
+        now = self.clock()
+        if r:
+            self.pending.update(r)
+            if self.window_start is None:
+                self.window_start = now
+        if self.window_start is not None and now - self.window_start >= self.coalesce:
+            return self.flush()
+        return None
+
+    def flush(self):
+        "Serialize what is pending in the coalescing window, if anything."
+        self.window_start = None
+        if not self.pending:
             return None
+        r = self.serialize(list(self.pending.items()))
+        self.pending.clear()
+        return r
 
-        return json.dumps({"updates": {"timestamp": self.gpstime,
-                                       "source": "fdxread",
-                                       "values": [{"path": k, "value": v} for k, v in r]}},
-                           default=json_serial) + linesep
+    def encode(self, s):
+        r = self.handle(s)
+        if r:
+            return r.encode("utf-8")
 
 
 class format_json(object):
+    # Internal or not understood fields, left out unless in devmode.
+    skipkeys = set(["mdesc", "ints", "strbody", "null", "xx", "yy", "u1", "u2",
+                    "fix1", "what?"])
+    skipprefixes = ("maybe", "not_", "unknown")
+
     def __init__(self, devmode=False):
         self.devmode = devmode
+        # Precompiled serializers, keyed on the keys of the input message.
+        # For a given mdesc the decoder (nearly) always gives the same keys,
+        # so this stays small.
+        self.schemas = {}
 
-    def filter(self, s):
-        assert isinstance(s, dict)
-        for key in ["mdesc", "ints", "strbody", "null", "xx", "yy", "u1", "u2",
-                    "fix1", "what?"]:
-            if key in s:
-                del s[key]
-        for key in sorted(s.keys()):
-            if key.startswith("maybe"):
-                del s[key]
-            elif key.startswith("not_"):
-                del s[key]
-            elif key.startswith("unknown"):
-                del s[key]
-
-        return s or None
+    def keep(self, key):
+        if self.devmode:
+            return key != "mdesc"
+        return key not in self.skipkeys and not key.startswith(self.skipprefixes)
+
+    def compile(self, keys):
+        "Serializer for messages with these keys, or None if nothing is kept."
+        kept = tuple(key for key in keys if self.keep(key))
+        if not kept and not self.devmode:
+            return None
+        return _jsonobject(kept)
 
     def handle(self, s):
         assert type(s) == dict
-        if not self.devmode:
-            s = self.filter(s)
+        keys = tuple(s)
+        try:
+            serialize = self.schemas[keys]
+        except KeyError:
+            serialize = self.schemas[keys] = self.compile(keys)
 
-        if s is None:
+        if serialize is None:
             return None
 
         if self.devmode:
-            mdesc = s["mdesc"]
-            del s["mdesc"]
-            return "%s\t%s" % (mdesc, json.dumps(s, default=json_serial)) + linesep
+            return "%s\t%s" % (s["mdesc"], serialize(s)) + linesep
 
-        return json.dumps(s, default=json_serial) + linesep
+        return serialize(s) + linesep
+
+    def encode(self, s):
+        r = self.handle(s)
+        if r:
+            return r.encode("utf-8")
 
 
 class TestFormatters(unittest.TestCase):
@@ -158,6 +319,42 @@ class TestFormatters(unittest.TestCase):
         msg = json.loads(r)
         self.assertAlmostEqual(msg["updates"]["values"][0]["value"], 54.102466)
 
+    def test_sk_derived(self):
+        formatter = format_signalk_delta()
+        r = formatter.values({"mdesc": "truewind", "twa": 270.0, "tws": 10.0, "vmg": 0.0})
+        self.assertEqual(r[0], ('environment.wind.angleTrueWater', radians(-90)))
+        self.assertEqual(formatter.values({"mdesc": "trip", "distance": 0.5}),
+                         [('navigation.trip.log', 926.0)])
+
+    def test_sk_estimate(self):
+        formatter = format_signalk_delta()
+        pos = {"mdesc": "gpspos", "lat": 59.8, "lon": 10.6}
+        self.assertEqual(len(formatter.values(pos)), 2)
+        r = formatter.values({"mdesc": "gpsestimate", "lat": 59.81, "lon": 10.6,
+                              "sog": 5.0, "cog": 0.0, "estimated": True})
+        self.assertEqual(r[2], ("navigation.gnss.methodQuality", "Estimated (DR) mode"))
+        self.assertEqual(formatter.values(pos)[2], ("navigation.gnss.methodQuality", "GNSS Fix"))
+
+    def test_sk_coalesce(self):
+        now = [0.0]
+        formatter = format_signalk_delta(coalesce=0.1, clock=lambda: now[0])
+        r = formatter.handle({"mdesc": "dst200depth", "depth": 4.2})
+        assert r is None
+        now[0] = 0.05
+        r = formatter.handle({"mdesc": "wsi0", "awa": Decimal(10), "aws_lo": 1.0})
+        assert r is None
+        r = formatter.handle({"mdesc": "dst200depth", "depth": 4.3})
+        assert r is None
+        now[0] = 0.1
+        r = formatter.handle({"mdesc": "static1s", "xx": 21})
+        values = json.loads(r)["updates"]["values"]
+        self.assertEqual(len(values), 3)
+        self.assertEqual(values[0], {"path": "environment.depth.belowTransducer", "value": 4.3})
+
+        assert formatter.flush() is None
+        formatter.handle({"mdesc": "dst200depth", "depth": 4.4})
+        assert "4.4" in formatter.flush()
+
     def test_json(self):
         formatter = format_json()
         msg = {"mdesc": "environment", "airpressure": 101.42, "temp_c": 21.0}
@@ -165,6 +362,33 @@ class TestFormatters(unittest.TestCase):
         assert isinstance(r, str)
         assert r.endswith("\n")
         assert json.loads(r)
+        self.assertIn("mdesc", msg)   # Input is left alone.
+
+        formatter = format_json(devmode=True)
+        r = formatter.handle(msg)
+        assert r.startswith("environment\t")
+        self.assertIn("mdesc", msg)
+
+    def test_precompiled(self):
+        # Same output as the generic json module, for every type the
+        # decoder produces.
+        msg = {"mdesc": "gpspos", "lat": Latitude(degree=59, minute=49.953),
+               "lon": Longitude(degree=10, minute=36.607), "elevation": float("NaN"),
+               "awa": Decimal(245.12345), "utctime": datetime(2016, 8, 24, 17, 5, 53),
+               "stw": 3, "fault": "xx != yy", "unknown2": 1, "none": None}
+        for devmode in [False, True]:
+            formatter = format_json(devmode=devmode)
+            expected = dict(msg)
+            del expected["mdesc"]
+            if not devmode:
+                del expected["unknown2"]
+            expected = json.dumps(expected, default=json_serial) + linesep
+            if devmode:
+                expected = "gpspos\t" + expected
+            self.assertEqual(formatter.handle(msg), expected)
+            self.assertEqual(formatter.handle(msg), expected)  # Cached.
+
+        self.assertIsNone(format_json().handle({"mdesc": "gpsping", "maybe": 1}))
 
 
 if __name__ == "__main__":
@@ -20,6 +20,7 @@ from __future__ import print_function
 
 import doctest
 import logging
+import os
 import unittest
 
 from binascii import hexlify
@@ -31,6 +32,13 @@ import serial
 
 from .decode import FDXDecode, DataError, FailedAssumptionError
 from .dumpreader import dumpreader, nxbdump
+from .ratelimit import decimator
+from . import cache as cachemod
+from .quarantine import quarantine as quarantinebox
+from .stats import clock_ns
+
+# Time stamps before this (2000-01-01) are differential, not Unix time.
+_epoch = 946684800.0
 
 
 class GND10interface(object):
@@ -45,14 +53,23 @@ class GND10interface(object):
     read_timeout = 0.3
     reset_sleep = 2
 
-    def __init__(self, serialport, send_modechange=False):
+    def __init__(self, serialport, send_modechange=False, max_rate=None, quarantine=None,
+                 stats=None):
         self.serialport = serialport
         self.send_modechange = send_modechange
+        self.decimator = decimator(max_rate) if max_rate else None
+        # Frames that could not be decoded are counted here, not logged.
+        self.quarantine = quarantinebox() if quarantine is None else quarantine
+        self.stats = stats
 
     def __del__(self):
         if self.stream is not None:
             self.stream.close()
 
+    def clock(self):
+        "Time of the current message, for stages that need one."
+        return time()
+
     def open(self):
         logging.debug("Opening serial port %s (read_timeout=%s)" % (self.serialport,
                       self.read_timeout))
@@ -72,6 +89,8 @@ class GND10interface(object):
     def recvmsg(self):
         buf = bytes()
         empty_reads = 0
+        stats = self.stats
+        read_ns = 0
 
         while True:
             while self.stream is None:
@@ -79,6 +98,8 @@ class GND10interface(object):
                     self.open()
                 except serial.serialutil.SerialException as e:
                     self.close()
+                    if stats is not None:
+                        stats.count("serial_open_errors")
                     now = time()
                     if (self.last_yield or now) < (now + self.read_timeout):
                         # Pace the iterator if nothing is working.
@@ -91,6 +112,9 @@ class GND10interface(object):
                     sleep(self.reset_sleep)
                     continue
 
+                empty_reads = 0
+                if stats is not None:
+                    stats.count("serial_opens")
                 # After successful open, send the mode change if asked to.
                 if self.send_modechange:
                     try:
@@ -99,40 +123,59 @@ class GND10interface(object):
                         logging.error(str(e))
                         self.close()
 
+            if stats is not None:
+                t = clock_ns()
             try:
                 # Inefficient but easily understood.
                 chunk = self.stream.read(1)
             except serial.serialutil.SerialException as e:
                 self.close()
+                if stats is not None:
+                    stats.count("serial_read_errors")
                 continue
+            if stats is not None:
+                read_ns += clock_ns() - t
 
             assert chunk is None or isinstance(chunk, bytes)
             if len(chunk) == 0:
                 empty_reads += 1
                 logging.info("serial read timeout after %.3f seconds" %
                              self.stream.timeout)
+                if stats is not None:
+                    stats.count("serial_read_timeouts")
                 if empty_reads > 4:  # Non-magic
                     logging.info("Excessive empty reads, resetting port")
                     self.close()
+                    if stats is not None:
+                        stats.count("serial_resets")
                 continue
-            self.empty_reads = 0
+            empty_reads = 0
 
             assert len(chunk) > 0
             buf += chunk
 
             if b'\x81' in buf:
                 # print("trying to decode %i bytes: %s" % (len(buf), buf.hex()))
+                if stats is not None:
+                    stats.frame(len(buf), read_ns)
+                    read_ns = 0
+                if self.decimator is not None and not self.decimator.accept(buf):
+                    buf = bytes()
+                    continue
+                if stats is not None:
+                    t = clock_ns()
                 try:
                     fdxmsg = FDXDecode(buf)
                 except (DataError, FailedAssumptionError,
                         NotImplementedError) as e:
-                    if "short message" in str(e):
-                        pass
-                    else:
-                        # This class concerns itself with the readable only.
-                        logging.warning("Ignoring exception: %s" % str(e))
+                    if stats is not None:
+                        stats.decoded(buf[:3], clock_ns() - t, False)
+                    # This class concerns itself with the readable only.
+                    self.quarantine.add(buf, e)
                     self.n_errors += 1
                 else:
+                    if stats is not None:
+                        stats.decoded(buf[:3], clock_ns() - t, fdxmsg)
                     if fdxmsg is not None:
                         self.n_msg += 1
                         self.last_yield = time()
@@ -152,47 +195,236 @@ class HEXinterface(object):
     last_yield = None
     n_msg = 0
     n_errors = 0
-
-    def __init__(self, inputfile, frequency=None, seek=0):
+    # Time stamp of the current message from the dump file. Absolute, or
+    # seconds from the start for files with differential time stamps.
+    # Always 0.0 for .nxb files, they have none.
+    ts = 0.0
+    # Same, for the frame being decoded. Rate limiting goes by this.
+    framets = 0.0
+
+    def __init__(self, inputfile, frequency=None, seek=0, max_rate=None, cache=None,
+                 quarantine=None, stats=None):
         self.inputfile = inputfile
         self.seek = seek
         self.frequency = frequency
+        self.timed = not inputfile.endswith(".nxb")
+        self.started = time()
+        # The file replays faster than real time, so limit on its time stamps.
+        self.decimator = None
+        if max_rate:
+            self.decimator = decimator(max_rate, clock=lambda: self._clock(self.framets))
+        # None is the cache in $FDXREAD_CACHE, if set. False for no cache.
+        self.cache = cachemod.default() if cache is None else cache
+        self.quarantine = quarantinebox() if quarantine is None else quarantine
+        self.stats = stats
         with open(self.inputfile):
             pass  # Catch permission problems early.
 
-    def recvmsg(self):
+    def _clock(self, ts):
+        """
+        ts in Unix time. Differential time stamps count from when reading
+        started, and files without time stamps go by the wall clock.
+        """
+        if not self.timed:
+            return time()
+        if ts < _epoch:
+            return self.started + ts
+        return ts
+
+    def clock(self):
+        "Time of the current message, for stages that need one."
+        return self._clock(self.ts)
+
+    def _decode(self):
+        "Decode the file, giving (ts, message) tuples."
         if self.inputfile.endswith(".nxb"):
             reader = nxbdump(self.inputfile, seek=self.seek)
         else:
             reader = dumpreader(self.inputfile, seek=self.seek)
 
+        stats = self.stats
+        ts = 0.0
+        if stats is not None:
+            t = clock_ns()
         for msg in reader:
+            if stats is not None:
+                now = clock_ns()
+                stats.frame(len(msg[1]), now - t)
+                t = now
             assert isinstance(msg, tuple)
             assert len(msg) == 2
-            ts, frame = msg
+            framets, frame = msg
+            if framets < 2.0:  # Differential, see dumpreader().
+                ts += framets
+            else:
+                ts = framets
+            self.framets = ts
 
             assert isinstance(frame, bytes)
             assert len(frame) > 0
 
+            if self.decimator is not None and not self.decimator.accept(frame):
+                continue
+
             try:
                 fdxmsg = FDXDecode(frame)
             except (DataError, FailedAssumptionError,
                     NotImplementedError) as e:
-                if "short message" in str(e):
-                    pass
-                else:
-                    logging.warning("%s" % str(e))
+                if stats is not None:
+                    stats.decoded(frame[:3], clock_ns() - t, False)
+                self.quarantine.add(frame, e, ts)
                 self.n_errors += 1
             else:
+                if stats is not None:
+                    stats.decoded(frame[:3], clock_ns() - t, fdxmsg)
                 if fdxmsg is not None:
-                    self.n_msg += 1
-                    self.last_yield = time()
                     assert isinstance(fdxmsg, dict)
-                    yield fdxmsg
+                    yield (ts, fdxmsg)
+            if stats is not None:
+                t = clock_ns()
+
+    def _replay(self, cache, entry):
+        """
+        Messages from the cache entry. If it turns out to be broken, the
+        file is decoded after all, skipping what was already given.
+        """
+        n = 0
+        try:
+            for item in cache.replay(entry):
+                n += 1
+                yield item
+            self.n_errors = cache.n_errors
+            if cache.quarantined is not None:
+                self.quarantine.merge(cache.quarantined)
+            return
+        except cachemod.CacheError as e:
+            logging.warning("%s. Decoding %s instead." % (str(e), self.inputfile))
+        for item in self._decode():
+            if n > 0:
+                n -= 1
+                continue
+            yield item
 
-                    # Pace the output.
-                    if self.frequency is not None:
-                        sleep(1.0/self.frequency)
+    def recvmsg(self):
+        # Rate limited reads depend on the rates, and are not cached.
+        # Nor are reads where the quarantined frames are to be written out,
+        # or the decoding is timed.
+        cache = self.cache
+        if self.decimator is not None or self.quarantine.spill is not None \
+                or self.stats is not None:
+            cache = None
+        entry = writer = None
+        if cache:
+            name = cache.entryname(self.inputfile, self.seek)
+            entry = cache.lookup(name)
+            if entry is None:
+                writer = cache.writer(name)
+
+        self.started = time()
+        source = self._replay(cache, entry) if entry is not None else self._decode()
+        completed = False
+        try:
+            for ts, fdxmsg in source:
+                self.ts = ts
+                if writer is not None:
+                    writer.add(ts, fdxmsg)
+                self.n_msg += 1
+                self.last_yield = time()
+                yield fdxmsg
+
+                # Pace the output.
+                if self.frequency is not None:
+                    sleep(1.0/self.frequency)
+            completed = True
+        finally:
+            if writer is not None:
+                if completed:
+                    writer.commit(self.n_errors, self.quarantine.state())
+                else:
+                    writer.abort()
+
+
+class TestHEXinterface(unittest.TestCase):
+    def test_cache(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dump = os.path.join(tmpdir, "x.dump")
+        with open(dump, "w") as fp:
+            fp.write("1472051153.703\t27\t 01 04 05 b1 00 08 bf 06 81\n"
+                     "1472051153.704\t24\t 07 03 04 e6 01 00 e7 81\n"
+                     "1472051153.705\t15\t 07 03 04 e6 81\n")
+        cache = cachemod.decodecache(os.path.join(tmpdir, "cache"))
+
+        reader = HEXinterface(dump, cache=False)
+        expected = list(reader.recvmsg())
+        self.assertEqual(len(expected), 2)
+
+        for _ in range(2):
+            reader = HEXinterface(dump, cache=cache)
+            self.assertEqual(list(reader.recvmsg()), expected)
+            self.assertEqual(reader.ts, 1472051153.704)
+            self.assertEqual(reader.n_errors, 1)
+            self.assertEqual(list(reader.quarantine.counts), [("070304", 5, "malformed")])
+        self.assertEqual((cache.n_misses, cache.n_hits), (1, 1))
+
+        # A broken entry is decoded after all, without repeating anything.
+        dump2 = os.path.join(tmpdir, "long.dump")
+        with open(dump2, "w") as fp:
+            for idx in range(3 * cachemod.chunksize):
+                fp.write("%.3f\t27\t 01 04 05 %02x 00 08 bf 06 81\n" % (1472051153.0 + idx, idx % 256))
+            fp.write("1472060000.0\t15\t 07 03 04 e6 81\n")
+        uncached = HEXinterface(dump2, cache=False)
+        expected = list(uncached.recvmsg())
+        self.assertGreater(len(expected), 2 * cachemod.chunksize)
+        list(HEXinterface(dump2, cache=cache).recvmsg())
+        path = os.path.join(cache.path, cache.entryname(dump2))
+        with open(path, "rb") as fp:
+            content = fp.read()
+        with open(path, "wb") as fp:
+            fp.write(content[:-64])    # The first chunks are still readable.
+        reader = HEXinterface(dump2, cache=cache)
+        self.assertEqual(list(reader.recvmsg()), expected)
+        self.assertEqual(reader.n_errors, uncached.n_errors)
+        self.assertEqual(reader.quarantine.counts, uncached.quarantine.counts)
+        self.assertFalse(os.path.exists(path))
+
+        # Only whole files are cached.
+        cache.clear()
+        next(HEXinterface(dump, cache=cache).recvmsg())
+        self.assertEqual(cache.entries(), [])
+
+    def test_max_rate(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dump = os.path.join(tmpdir, "x.dump")
+        # Five seconds of wind at 4 Hz, replayed in no time.
+        with open(dump, "w") as fp:
+            for idx in range(20):
+                fp.write("%.3f\t27\t 01 04 05 b1 00 08 bf 06 81\n" % (1472051153.0 + idx * 0.25))
+        reader = HEXinterface(dump, max_rate={"wsi0": 1}, cache=False)
+        self.assertEqual(len(list(reader.recvmsg())), 5)
+        self.assertEqual(reader.decimator.n_dropped, {b"\x01\x04\x05": 15})
+        self.assertEqual(reader.clock(), 1472051157.0)
+
+        # No time stamps in .nxb files, so the wall clock it is.
+        nxb = os.path.join(tmpdir, "x.nxb")
+        with open(nxb, "wb") as fp:
+            fp.write(b"\x01\x04\x05\xb1\x00\x08\xbf\x06\x81" * 4)
+        reader = HEXinterface(nxb, cache=False)
+        self.assertEqual(len(list(reader.recvmsg())), 4)
+        self.assertEqual(reader.ts, 0.0)
+        self.assertAlmostEqual(reader.clock(), time(), delta=60)
+
+        # Differential time stamps count from the start.
+        with open(dump, "w") as fp:
+            fp.write("0.5\t9\t01 04 05 b1 00 08 bf 06 81\n" * 4)
+        reader = HEXinterface(dump, cache=False)
+        list(reader.recvmsg())
+        self.assertEqual(reader.clock(), reader.started + 2.0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Tack and gybe detection.
+
+A manoeuvre starts when the apparent wind changes side. From there:
+
+* the end is the first COG reading of a straight run (COG within
+  settle_angle for settle seconds) after the wind changed side,
+* the start is the last reading of the straight run before it,
+* the manoeuvre is over when the speed made good along the wind axis is
+  back at recovered (90%) of what it was before, or recovery seconds after
+  the end.
+
+The wind axis is the mean of the course before and after. Distance lost
+is how much further along the axis the boat would have been, from start
+until it recovered, going on at the speed before the manoeuvre.
+
+The detector adds a message to the stream when a manoeuvre is over:
+
+    {"mdesc": "manoeuvre", "kind": "tack", "start": .., "end": ..,
+     "duration": .., "entry_cog": .., "exit_cog": .., "entry_sog": ..,
+     "min_sog": .., "sog_drop": .., "distance_lost": ..}
+
+Times are from clock (Unix time), speeds in knots and distance lost in
+metres. COG readings are kept in a ring buffer of history entries, which
+is only looked through once per manoeuvre.
+"""
+from __future__ import print_function
+
+import unittest
+from collections import deque
+from math import atan2, cos, sin, radians, degrees, isnan
+from time import time
+
+from .interfaces import HEXinterface
+from .state import brownout
+
+
+def anglediff(a, b):
+    """
+    Smallest difference between two angles, in degrees 0-180.
+
+    >>> anglediff(350, 10), anglediff(90, 270)
+    (20, 180)
+    """
+    d = abs(a - b) % 360
+    return 360 - d if d > 180 else d
+
+
+def meanangle(angles):
+    "Mean direction of angles, in degrees 0-360."
+    s = sum(sin(radians(a)) for a in angles)
+    c = sum(cos(radians(a)) for a in angles)
+    return degrees(atan2(s, c)) % 360
+
+
+class manoeuvres(object):
+    """
+    Find tacks and gybes in gpscog and wsi0 messages.
+
+    margin is how far (degrees) from head to wind or dead downwind the AWA
+    must be to count as being on a side. Turns of less than min_turn degrees
+    are wind shifts, not manoeuvres.
+    """
+    def __init__(self, margin=10.0, settle_angle=10.0, settle=6.0, min_turn=30.0,
+                 max_duration=60.0, recovery=30.0, recovered=0.9, history=1000,
+                 clock=time):
+        self.margin = margin
+        self.settle_angle = settle_angle
+        self.settle = settle
+        self.min_turn = min_turn
+        self.max_duration = max_duration
+        self.recovery = recovery
+        self.recovered = recovered
+        self.clock = clock
+
+        self.ring = deque(maxlen=history)   # (time, cog, sog)
+        self.side = None        # 1 is wind from starboard, -1 from port.
+        self.crossed = None     # (time, kind) when the wind changed side
+        self.anchor = None      # (time, cog) starting the current straight run
+        self.pending = None     # Settled manoeuvre waiting for the recovery.
+        self.n_tacks = 0
+        self.n_gybes = 0
+
+    def _side(self, awa):
+        margin = self.margin
+        if margin < awa < 180 - margin:
+            return 1
+        if 180 + margin < awa < 360 - margin:
+            return -1
+        return None
+
+    def wind(self, now, awa):
+        "Returns a finished manoeuvre or None."
+        side = self._side(awa)
+        if side is None or side == self.side:
+            return None
+        previous, self.side = self.side, side
+        if previous is None:
+            return None
+
+        r = None
+        if self.pending is not None:
+            r = self._finish(now)
+        if self.crossed is not None:
+            # Back on the old side before settling. Luffed up, or noise.
+            self.crossed = None
+            return r
+        self.crossed = (now, "tack" if cos(radians(awa)) > 0 else "gybe")
+        self.anchor = None
+        return r
+
+    def course(self, now, cog, sog):
+        "Returns a finished manoeuvre or None."
+        self.ring.append((now, cog, sog))
+        if self.pending is not None:
+            pending = self.pending
+            vmg = sog * cos(radians(cog - pending["axis"]))
+            if vmg >= self.recovered * pending["entry_vmg"] or now - pending["end"] >= self.recovery:
+                return self._finish(now)
+            return None
+
+        if self.crossed is None:
+            return None
+        if now - self.crossed[0] > self.max_duration:
+            self.crossed = None     # Never settled.
+            return None
+        if self.anchor is None or anglediff(cog, self.anchor[1]) > self.settle_angle:
+            self.anchor = (now, cog)
+        if now - self.anchor[0] >= self.settle:
+            self._settled(now)
+        return None
+
+    def _settled(self, now):
+        crossed, kind = self.crossed
+        end = self.anchor[0]
+        self.crossed = None
+        self.anchor = None
+
+        before = [s for s in self.ring if s[0] < crossed]
+        exit_cog = meanangle([s[1] for s in self.ring if s[0] >= end])
+
+        # Walk back from the wind shift to a straight run.
+        start = anchor = None
+        for t, cog, sog in reversed(before):
+            if crossed - t > self.max_duration:
+                break
+            if anchor is None or anglediff(cog, anchor[1]) > self.settle_angle:
+                anchor = (t, cog)
+            elif anchor[0] - t >= self.settle:
+                start = anchor[0]
+                break
+        if start is None:
+            return
+        run = [s for s in before if start - self.settle <= s[0] <= start]
+        entry_cog = meanangle([s[1] for s in run])
+        if anglediff(entry_cog, exit_cog) < self.min_turn:
+            return  # Wind shift.
+
+        entry_sog = sum(s[2] for s in run) / len(run)
+        axis = meanangle([entry_cog, exit_cog])
+        self.pending = {"kind": kind, "start": start, "end": end, "axis": axis,
+                        "entry_cog": entry_cog, "exit_cog": exit_cog, "entry_sog": entry_sog,
+                        "entry_vmg": entry_sog * cos(radians(entry_cog - axis))}
+
+    def _finish(self, now):
+        pending = self.pending
+        self.pending = None
+        start, axis = pending["start"], pending["axis"]
+
+        # Progress along the wind axis from start until now.
+        progress = 0.0
+        min_sog = pending["entry_sog"]
+        last = None
+        for t, cog, sog in self.ring:
+            if t < start:
+                continue
+            if last is not None:
+                progress += last[2] * cos(radians(last[1] - axis)) * (t - last[0])
+            min_sog = min(min_sog, sog)
+            last = (t, cog, sog)
+        expected = pending["entry_vmg"] * (now - start)
+        distance_lost = (expected - progress) / 3600. * 1852.0
+
+        if pending["kind"] == "tack":
+            self.n_tacks += 1
+        else:
+            self.n_gybes += 1
+        return {"mdesc": "manoeuvre", "kind": pending["kind"],
+                "start": start, "end": pending["end"], "duration": pending["end"] - start,
+                "entry_cog": pending["entry_cog"], "exit_cog": pending["exit_cog"],
+                "entry_sog": pending["entry_sog"], "min_sog": min_sog,
+                "sog_drop": pending["entry_sog"] - min_sog, "distance_lost": distance_lost}
+
+    def handle(self, msg):
+        mdesc = msg["mdesc"]
+        r = None
+        if mdesc == "gpscog":
+            cog, sog = float(msg["cog"]), float(msg["sog"])
+            if not (isnan(cog) or isnan(sog)):
+                r = self.course(self.clock(), cog, sog)
+        elif mdesc == "wsi0" and not brownout(msg):
+            r = self.wind(self.clock(), float(msg["awa"]))
+        return msg if r is None else [msg, r]
+
+    def summary(self):
+        return "manoeuvres: %i tacks, %i gybes" % (self.n_tacks, self.n_gybes)
+
+
+def detect(path):
+    "Manoeuvres in a dump file, as a list of manoeuvre messages."
+    reader = HEXinterface(path)
+    detector = manoeuvres(clock=reader.clock)
+    r = []
+    for msg in reader.recvmsg():
+        out = detector.handle(msg)
+        if type(out) is list:
+            r.append(out[1])
+    return r
+
+
+class TestManoeuvres(unittest.TestCase):
+    def sail(self, detector, now, seconds, cog, sog, awa):
+        r = []
+        for t in range(seconds):
+            for msg in ({"mdesc": "wsi0", "awa": awa, "aws_hi": 10.0},
+                        {"mdesc": "gpscog", "cog": cog, "sog": sog}):
+                out = detector.handle(msg)
+                if type(out) is list:
+                    r.append(out[1])
+            now[0] += 1.0
+        return r
+
+    def test_tack(self):
+        now = [1000.0]
+        d = manoeuvres(clock=lambda: now[0])
+        self.assertEqual(self.sail(d, now, 20, 45.0, 6.0, 45.0), [])
+        # Head to wind and over, slowing down.
+        self.sail(d, now, 1, 15.0, 5.0, 15.0)
+        self.sail(d, now, 1, 345.0, 4.0, 345.0)
+        self.sail(d, now, 1, 315.0, 3.0, 315.0)
+        self.assertEqual(self.sail(d, now, 10, 315.0, 4.0, 315.0), [])
+        r = self.sail(d, now, 10, 315.0, 6.0, 315.0)
+        self.assertEqual(len(r), 1)
+        m = r[0]
+        self.assertEqual((m["kind"], m["start"], m["end"], m["duration"]),
+                         ("tack", 1019.0, 1022.0, 3.0))
+        self.assertAlmostEqual(m["entry_cog"], 45.0)
+        self.assertAlmostEqual(m["exit_cog"], 315.0)
+        self.assertEqual((m["min_sog"], m["sog_drop"]), (3.0, 3.0))
+        self.assertGreater(m["distance_lost"], 0)
+        self.assertEqual(d.summary(), "manoeuvres: 1 tacks, 0 gybes")
+
+    def test_not_manoeuvres(self):
+        now = [1000.0]
+        d = manoeuvres(clock=lambda: now[0])
+        self.sail(d, now, 20, 180.0, 6.0, 150.0)
+        # Wind shift to the other side, same course.
+        self.assertEqual(self.sail(d, now, 60, 180.0, 6.0, 210.0), [])
+
+        d = manoeuvres(clock=lambda: now[0])
+        self.sail(d, now, 20, 30.0, 6.0, 20.0)
+        # Luffing up head to wind and falling back.
+        self.sail(d, now, 2, 10.0, 4.0, 355.0)
+        self.assertEqual(self.sail(d, now, 60, 30.0, 6.0, 20.0), [])
+        self.assertEqual(d.n_tacks + d.n_gybes, 0)
+
+    def test_gybe(self):
+        now = [0.0]
+        d = manoeuvres(clock=lambda: now[0])
+        self.sail(d, now, 20, 200.0, 6.0, 160.0)
+        self.sail(d, now, 2, 180.0, 6.0, 200.0)
+        r = self.sail(d, now, 60, 160.0, 6.0, 200.0)
+        self.assertEqual([m["kind"] for m in r], ["gybe"])
+        self.assertEqual(r[0]["sog_drop"], 0.0)
+        # Wind shifted back to the other side.
+        brownout = {"mdesc": "wsi0", "awa": 0.0, "aws_hi": float("NaN")}
+        self.assertIs(d.handle(brownout), brownout)
+
+
+if __name__ == "__main__":
+    unittest.main()
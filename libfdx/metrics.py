@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Counters for Prometheus, served over HTTP from a background thread.
+
+metrics is a stats (see stats.py) that also keeps a latency histogram
+for each timer. The reader thread only increments counters; the text
+format is put together when /metrics is fetched. Exported:
+
+    fdxread_frames_total, fdxread_bytes_total    frames and bytes read
+    fdxread_decoded_frames_total{mtype, mdesc}   per message type
+    fdxread_decode_errors_total{mtype}
+    fdxread_decode_seconds_total{mtype}
+    fdxread_quarantined_frames_total{kind}       unknown or malformed
+    fdxread_rate_limited_frames_total{mtype}     dropped by --max-rate
+    fdxread_serial_*_total                       opens, resets, timeouts, ..
+    fdxread_output_backlog_bytes{output}         not written/sent yet
+    fdxread_output_dropped_total{output}         chunks dropped for slow clients
+    fdxread_latency_seconds{timer}               histogram, read/decode/stage/..
+
+Rates are left to Prometheus: rate(fdxread_frames_total[1m]).
+"""
+from __future__ import print_function
+
+import logging
+import threading
+import unittest
+from bisect import bisect_left
+from time import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from .stats import stats, _name
+
+# Histogram bucket upper bounds, in seconds.
+buckets = [1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+           1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0]
+
+
+def parse_listen(spec):
+    """
+    Address to listen on from port or host:port. Only localhost by default.
+
+    >>> parse_listen("9100")
+    ('127.0.0.1', 9100)
+    >>> parse_listen("0.0.0.0:9100")
+    ('0.0.0.0', 9100)
+    """
+    host, _, port = spec.rpartition(":")
+    if not port.isdigit():
+        raise ValueError("Invalid port in %s" % spec)
+    return host or "127.0.0.1", int(port)
+
+
+def _items(d):
+    "Copy of d.items(), d being updated from another thread."
+    while True:
+        try:
+            return sorted(list(d.items()))
+        except RuntimeError:    # Changed size during iteration.
+            continue
+
+
+def _label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class metrics(stats):
+    """
+    stats with latency histograms, in Prometheus text format.
+
+    quarantine, decimator and outputs (a list of sinks.output) are looked
+    at when the metrics are fetched, set them when they are known.
+    """
+    def __init__(self, interval=0, clock=time, quarantine=None, outputs=None, decimator=None):
+        stats.__init__(self, interval=interval, clock=clock)
+        self.quarantine = quarantine
+        self.decimator = decimator
+        self.outputs = outputs or []
+        self.bounds = [int(b * 1e9) for b in buckets]
+        self.histograms = {}    # timer name -> [count per bucket, +Inf last]
+
+    def add(self, name, ns):
+        stats.add(self, name, ns)
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = [0] * (len(self.bounds) + 1)
+        h[bisect_left(self.bounds, ns)] += 1
+
+    def render(self):
+        "The metrics in Prometheus text format."
+        r = []
+
+        def metric(name, kind, helptext, samples):
+            r.append("# HELP %s %s" % (name, helptext))
+            r.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                labels = ",".join(['%s="%s"' % (k, _label(v)) for k, v in labels])
+                r.append("%s%s %r" % (name, "{%s}" % labels if labels else "", value))
+
+        metric("fdxread_start_time_seconds", "gauge", "Start time in Unix time.",
+               [((), self.started)])
+        metric("fdxread_frames_total", "counter", "Frames read.", [((), self.n_frames)])
+        metric("fdxread_bytes_total", "counter", "Bytes read.", [((), self.n_bytes)])
+
+        mtypes = _items(self.mtypes)
+        metric("fdxread_decoded_frames_total", "counter", "Frames decoded, per message type.",
+               [((("mtype", _name(m)), ("mdesc", v[3] or "")), v[0]) for m, v in mtypes])
+        metric("fdxread_decode_errors_total", "counter", "Frames that failed to decode.",
+               [((("mtype", _name(m)),), v[2]) for m, v in mtypes if v[2]])
+        metric("fdxread_decode_seconds_total", "counter", "Time spent decoding.",
+               [((("mtype", _name(m)),), v[1] / 1e9) for m, v in mtypes])
+
+        if self.quarantine is not None:
+            kinds = {"unknown": 0, "malformed": 0}
+            for (_, _, kind), count in _items(self.quarantine.counts):
+                kinds[kind] = kinds.get(kind, 0) + count
+            metric("fdxread_quarantined_frames_total", "counter",
+                   "Frames not decoded: no decoder (unknown) or bad content (malformed).",
+                   [((("kind", k),), v) for k, v in sorted(kinds.items())])
+
+        if self.decimator is not None:
+            metric("fdxread_rate_limited_frames_total", "counter", "Frames dropped by --max-rate.",
+                   [((("mtype", _name(h)),), v) for h, v in _items(self.decimator.n_dropped)])
+
+        for name, count in _items(self.counters):
+            metric("fdxread_%s_total" % name, "counter", name.replace("_", " ").capitalize() + ".",
+                   [((), count)])
+
+        backlog = []
+        dropped = []
+        for i, output in enumerate(list(self.outputs)):
+            dest = output.destination
+            labels = (("output", "%i %s" % (i, getattr(dest, "name", type(dest).__name__))),)
+            if hasattr(dest, "backlog"):
+                backlog.append((labels, dest.backlog()))
+            server = getattr(dest, "server", dest)
+            if hasattr(server, "n_dropped"):
+                dropped.append((labels, server.n_dropped))
+        metric("fdxread_output_backlog_bytes", "gauge", "Output not written or sent yet.", backlog)
+        if dropped:
+            metric("fdxread_output_dropped_total", "counter", "Chunks dropped for slow clients.",
+                   dropped)
+
+        r.append("# HELP fdxread_latency_seconds Time per frame or message, per timer.")
+        r.append("# TYPE fdxread_latency_seconds histogram")
+        timers = dict(_items(self.timers))
+        for name, h in _items(self.histograms):
+            label = _label(name)
+            total = 0
+            for bound, count in zip(buckets + ["+Inf"], list(h)):
+                total += count
+                r.append('fdxread_latency_seconds_bucket{timer="%s",le="%s"} %i' %
+                         (label, bound, total))
+            r.append('fdxread_latency_seconds_sum{timer="%s"} %r' % (label, timers.get(name, [0, 0])[1] / 1e9))
+            r.append('fdxread_latency_seconds_count{timer="%s"} %i' % (label, total))
+        return "\n".join(r) + "\n"
+
+
+class _handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("metrics: %s %s" % (self.address_string(), fmt % args))
+
+
+class exporter(object):
+    "Serve the metrics over HTTP from a daemon thread."
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        self.server = HTTPServer((host, port), _handler)
+        self.server.metrics = metrics
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fdxread-metrics")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        logging.info("Metrics on http://%s:%i/metrics" % (self.server.server_address[0], self.port))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        from io import BytesIO
+        from .quarantine import quarantine
+        from .ratelimit import decimator
+        from .sinks import output, streamsink
+
+        now = [100.0]
+        q = quarantine(report_interval=0)
+        sink = streamsink(BytesIO(), "test", flush_after=3600)
+        self.addCleanup(sink.close)
+        d = decimator({"wsi0": 0})
+        m = metrics(clock=lambda: now[0], quarantine=q, outputs=[output(None, sink)], decimator=d)
+        d.accept(b"\x01\x04\x05\xff\xff\x00\x00\x00\x81")
+        m.frame(9, 1500)
+        m.decoded(b"\x01\x04\x05", 30000, {"mdesc": "wsi0"})
+        m.frame(6, 1500)
+        m.decoded(b"\x0d\x02\x0f", 2000000, False)
+        q.add(b"\x0d\x02\x0f\x00\x00\x81", NotImplementedError("No handler"))
+        m.count("serial_resets")
+        sink.write(b"12345")
+
+        text = m.render()
+        for line in ['fdxread_frames_total 2',
+                     'fdxread_bytes_total 15',
+                     'fdxread_decoded_frames_total{mtype="01 04 05",mdesc="wsi0"} 1',
+                     'fdxread_decode_errors_total{mtype="0d 02 0f"} 1',
+                     'fdxread_quarantined_frames_total{kind="unknown"} 1',
+                     'fdxread_rate_limited_frames_total{mtype="01 04 05"} 1',
+                     'fdxread_serial_resets_total 1',
+                     'fdxread_output_backlog_bytes{output="0 test"} 5',
+                     'fdxread_latency_seconds_bucket{timer="decode",le="2.5e-05"} 0',
+                     'fdxread_latency_seconds_bucket{timer="decode",le="5e-05"} 1',
+                     'fdxread_latency_seconds_bucket{timer="decode",le="+Inf"} 2',
+                     'fdxread_latency_seconds_count{timer="read"} 2']:
+            self.assertIn(line + "\n", text)
+        self.assertEqual(m.histograms["read"][1], 2)    # 1.5 us is in the 2.5 us bucket.
+
+    def test_exporter(self):
+        try:
+            from urllib.request import urlopen
+            from urllib.error import HTTPError
+        except ImportError:
+            from urllib2 import urlopen, HTTPError
+        m = metrics()
+        m.frame(9, 1000)
+        e = exporter(m, port=0)
+        e.start()
+        self.addCleanup(e.close)
+        url = "http://127.0.0.1:%i" % e.port
+        r = urlopen(url + "/metrics", timeout=5)
+        self.assertTrue(r.headers["Content-Type"].startswith("text/plain"))
+        self.assertIn(b"\nfdxread_frames_total 1\n", r.read())
+        with self.assertRaises(HTTPError):
+            urlopen(url + "/other", timeout=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Processing stages between the decoder and the outputs.
+
+A stage is an object with a handle(msg) method. It returns the message to
+pass on (changed or not), None to drop it, or a list of messages when it
+adds some of its own (like computed true wind). Messages from a list go
+through the remaining stages one by one.
+
+With stats (see stats.py), the time spent in each stage is recorded.
+"""
+from __future__ import print_function
+
+import unittest
+
+from .stats import clock_ns
+
+
+class pipeline(object):
+    def __init__(self, stages=None, stats=None):
+        self.stages = list(stages or [])
+        self.stats = stats
+        if stats is not None:
+            self.timers = ["stage %s" % type(stage).__name__ for stage in self.stages]
+            self._run = self._timed_run
+
+    def process(self, msg):
+        "Run msg through all stages. Returns a list of messages to output."
+        return self._run(msg, 0)
+
+    def _run(self, msg, start):
+        stages = self.stages
+        for idx in range(start, len(stages)):
+            msg = stages[idx].handle(msg)
+            if msg is None:
+                return []
+            if type(msg) is list:
+                r = []
+                for m in msg:
+                    r += self._run(m, idx + 1)
+                return r
+        return [msg]
+
+    def _timed_run(self, msg, start):
+        stages = self.stages
+        add = self.stats.add
+        for idx in range(start, len(stages)):
+            t = clock_ns()
+            msg = stages[idx].handle(msg)
+            add(self.timers[idx], clock_ns() - t)
+            if msg is None:
+                return []
+            if type(msg) is list:
+                r = []
+                for m in msg:
+                    r += self._run(m, idx + 1)
+                return r
+        return [msg]
+
+    def summary(self):
+        "Summary lines from the stages that have one."
+        return [stage.summary() for stage in self.stages if hasattr(stage, "summary")]
+
+
+class TestPipeline(unittest.TestCase):
+    def test_process(self):
+        class double(object):
+            def handle(self, msg):
+                return [msg, dict(msg, mdesc=msg["mdesc"] + "2")]
+
+        class dropper(object):
+            def handle(self, msg):
+                return None if msg["mdesc"] == "drop" else msg
+
+            def summary(self):
+                return "dropper"
+
+        p = pipeline([dropper(), double(), double()])
+        r = p.process({"mdesc": "a"})
+        self.assertEqual([m["mdesc"] for m in r], ["a", "a2", "a2", "a22"])
+        self.assertEqual(p.process({"mdesc": "drop"}), [])
+        self.assertEqual(pipeline().process({"mdesc": "a"}), [{"mdesc": "a"}])
+        self.assertEqual(p.summary(), ["dropper"])
+
+        from .stats import stats
+        s = stats()
+        p = pipeline([dropper(), double()], stats=s)
+        self.assertEqual(len(p.process({"mdesc": "a"})), 2)
+        self.assertEqual(sorted(s.timers), ["stage double", "stage dropper"])
+        self.assertEqual(s.timers["stage dropper"][0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
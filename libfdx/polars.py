@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Polar diagrams from recorded sailing.
+
+Each dump file is replayed through boatstate and the derived stage to get
+true wind and boat speed. Only steady sailing is used: the last readings
+must all be on the same tack, with little change in wind angle and boat
+speed. The samples from all files are binned on TWA and TWS, and the
+boat speed for each bin is a high percentile of what was sailed there.
+
+Files are read in parallel, one process per file. The binning needs numpy.
+
+The output is the semicolon separated polar format most navigation
+programs read:
+
+    twa/tws;4;6;8;10
+    40;2.10;3.05;3.80;4.10
+    ...
+"""
+from __future__ import print_function
+
+import logging
+import unittest
+from math import hypot
+from os.path import dirname, exists, join
+from multiprocessing import Pool
+
+from .damping import window, circularwindow
+from .derived import derived
+from .interfaces import HEXinterface
+from .state import boatstate, brownout
+
+default_tws = [4, 6, 8, 10, 12, 14, 16, 20, 25]
+
+
+class steady(object):
+    """
+    Tell if the last size readings were steady sailing.
+
+    Steady is: all on the same tack, TWA spread (1 - mean resultant
+    length of the angles) below max_spread, and boat speed within
+    max_speed_range knots. Boat speeds over max_speed and TWS over max_tws
+    are not sailing; the GPS gives 655.35 knots SOG before it has a fix.
+    """
+    def __init__(self, size=10, max_spread=0.01, max_speed_range=0.5, min_speed=0.5,
+                 max_speed=40.0, max_tws=60.0):
+        self.size = size
+        self.max_spread = max_spread
+        self.max_speed_range = max_speed_range
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.max_tws = max_tws
+        self.twa = circularwindow(size)
+        self.speed = window(size)
+        self.side = window(size)
+
+    def add(self, twa, speed, tws=0.0):
+        "Add a reading. Returns True if the window is steady."
+        self.twa.push(twa)
+        self.speed.push(speed)
+        self.side.push(1.0 if twa < 180 else -1.0)
+        if len(self.speed) < self.size:
+            return False
+        if self.speed.max() > self.max_speed or tws > self.max_tws:
+            return False
+        if self.side.min() != self.side.max():
+            return False  # Tacked or gybed.
+        if self.speed.min() < self.min_speed:
+            return False
+        if self.speed.max() - self.speed.min() > self.max_speed_range:
+            return False
+        resultant = hypot(self.twa.sinsum, self.twa.cossum) / self.size
+        return 1.0 - resultant <= self.max_spread
+
+
+def samples(path):
+    """
+    Steady (twa, tws, boat speed) samples from a dump file.
+
+    TWA is folded to 0-180, port and starboard are the same in a polar.
+    Wind from brownout wsi0 frames (zeroes) is never used.
+    """
+    reader = HEXinterface(path)
+    state = boatstate(clock=lambda: reader.ts)
+    d = derived(state)
+    filt = steady()
+    r = []
+    for msg in reader.recvmsg():
+        if brownout(msg):
+            continue
+        state.update(msg)
+        out = d.handle(msg)
+        if type(out) is not list:
+            continue
+        for m in out:
+            if m["mdesc"] != "truewind":
+                continue
+            speed = d.boatspeed()
+            if filt.add(m["twa"], speed, m["tws"]):
+                twa = m["twa"] if m["twa"] <= 180 else 360 - m["twa"]
+                r.append((twa, m["tws"], speed))
+    return r
+
+
+def _samples(path):
+    # Pool worker. Keep going if a single file is broken.
+    try:
+        return samples(path)
+    except Exception as e:
+        logging.error("%s: %s" % (path, str(e)))
+        return []
+
+
+def collect(paths, processes=None):
+    "Samples from all files, as a numpy array with columns twa, tws, speed."
+    import numpy
+    if processes == 1 or len(paths) == 1:
+        parts = [_samples(p) for p in paths]
+    else:
+        pool = Pool(processes)
+        try:
+            parts = pool.map(_samples, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    rows = [row for part in parts for row in part]
+    return numpy.array(rows, dtype=numpy.float64).reshape(-1, 3)
+
+
+def build(data, twa_step=5, tws=default_tws, percentile=90, min_count=5):
+    """
+    Bin the samples. Returns (twa bin centres, tws, speeds, counts).
+
+    speeds and counts are arrays with a row per TWA and a column per TWS.
+    A TWS column covers half way to its neighbours. Bins with fewer than
+    min_count samples have NaN speed.
+    """
+    import numpy
+    twa_centres = numpy.arange(twa_step / 2.0, 180, twa_step)
+    tws = numpy.asarray(tws, dtype=numpy.float64)
+    tws_edges = numpy.concatenate([[tws[0] - (tws[1] - tws[0]) / 2.0],
+                                   (tws[1:] + tws[:-1]) / 2.0,
+                                   [tws[-1] + (tws[-1] - tws[-2]) / 2.0]])
+
+    speeds = numpy.full((len(twa_centres), len(tws)), numpy.nan)
+    counts = numpy.zeros((len(twa_centres), len(tws)), dtype=numpy.int64)
+    if len(data) == 0:
+        return twa_centres, tws, speeds, counts
+
+    twa_bin = numpy.minimum((data[:, 0] // twa_step).astype(numpy.int64), len(twa_centres) - 1)
+    tws_bin = numpy.searchsorted(tws_edges, data[:, 1], side="right") - 1
+    ok = (tws_bin >= 0) & (tws_bin < len(tws))
+    key = twa_bin[ok] * len(tws) + tws_bin[ok]
+    speed = data[ok, 2]
+
+    # Sort on bin, then every bin is a slice.
+    order = numpy.argsort(key, kind="mergesort")
+    key = key[order]
+    speed = speed[order]
+    uniq, start, n = numpy.unique(key, return_index=True, return_counts=True)
+    counts.flat[uniq] = n
+    for k, s, c in zip(uniq, start, n):
+        if c >= min_count:
+            speeds.flat[k] = numpy.percentile(speed[s:s + c], percentile)
+    return twa_centres, tws, speeds, counts
+
+
+def write_csv(fp, twa_centres, tws, speeds):
+    "Write the polar table. Empty bins are left empty; TWA rows without data are left out."
+    fp.write("twa/tws;" + ";".join(["%g" % t for t in tws]) + "\n")
+    for twa, row in zip(twa_centres, speeds):
+        if all(v != v for v in row):
+            continue
+        fp.write("%g;" % twa + ";".join(["" if v != v else "%.2f" % v for v in row]) + "\n")
+
+
+class TestPolars(unittest.TestCase):
+    def test_steady(self):
+        s = steady(size=3)
+        self.assertFalse(s.add(45, 5.0))
+        self.assertFalse(s.add(46, 5.1))
+        self.assertTrue(s.add(44, 5.0))
+        self.assertFalse(s.add(315, 5.0))    # Tacked.
+        self.assertFalse(s.add(316, 5.0))
+        self.assertTrue(s.add(314, 5.2))
+        self.assertFalse(s.add(314, 4.0))    # Slowing down.
+        s = steady(size=2)
+        s.add(30, 5.0)
+        self.assertFalse(s.add(60, 5.0))     # Wind shift.
+        # No GPS fix, and a wind transducer gone mad.
+        s = steady(size=1)
+        self.assertFalse(s.add(180, 655.35, 655.0))
+        self.assertFalse(s.add(90, 6.0, 300.0))
+        self.assertTrue(s.add(90, 6.0, 12.0))
+
+    def test_samples(self):
+        # Brownout zeroes and 655 knot SOG before the GPS fix are left out.
+        for name in ["set1-2.2kn-cog180-nowind_or_dst200.dump", "gnd10-and-displays.dump"]:
+            path = join(dirname(__file__), "..", "dumps", name)
+            if not exists(path):
+                raise unittest.SkipTest("dumps/ not found")
+            self.assertEqual(samples(path), [])
+
+    def test_build(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy is needed for polars")
+        rows = [(42.0, 6.2, 5.0 + i / 10.) for i in range(10)] + [(43, 10.5, 6.0)] * 5 \
+            + [(178, 50.0, 9.0)] * 10
+        twa, tws, speeds, counts = build(numpy.array(rows), twa_step=5, tws=[6, 8, 10],
+                                         percentile=50, min_count=5)
+        self.assertEqual(counts[8].tolist(), [10, 0, 5])
+        self.assertAlmostEqual(speeds[8, 0], 5.45)
+        self.assertTrue(numpy.isnan(speeds[8, 1]))
+        self.assertEqual(counts.sum(), 15)   # Too much wind for the table.
+
+        from io import StringIO
+        fp = StringIO()
+        write_csv(fp, twa, tws, speeds)
+        self.assertEqual(fp.getvalue(), "twa/tws;6;8;10\n42.5;5.45;;6.00\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
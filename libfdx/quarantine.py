@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Bookkeeping for frames that could not be decoded.
+
+Unknown message types are common (the .nxb sample has thousands), and
+logging each of them floods the log. Instead they are counted per message
+type, length and kind:
+
+* unknown: no decoder for the message type (NotImplementedError),
+* malformed: wrong length or unexpected content (DataError,
+  FailedAssumptionError).
+
+A few distinct frames are kept per message type as examples, and the
+counts are logged every report_interval seconds and at exit. With spill,
+every frame is also written to a dump file that fdxread and fdxread
+analyze can read.
+"""
+from __future__ import print_function
+
+import logging
+import unittest
+from datetime import datetime
+from time import time
+
+from .decode import FailedAssumptionError
+
+# Distinct keys counted on their own, the rest are summed up as "other".
+max_keys = 1000
+
+
+def _hex(frame):
+    return "".join(["%02x" % x for x in bytearray(frame)])
+
+
+class quarantine(object):
+    def __init__(self, samples=3, spill=None, report_interval=60.0, clock=time):
+        self.samples = samples
+        self.report_interval = report_interval
+        self.clock = clock
+        self.counts = {}    # (mtype, length, kind) -> count
+        self.errors = {}    # (mtype, length, kind) -> first error message
+        self.examples = {}  # mtype -> [hex frame]
+        self.total = 0
+        self.last_report = clock()
+        self.reported = 0   # total at the last report
+
+        self.spill = None
+        if spill is not None:
+            self.spill = open(spill, "a")
+            self.spill.write("# source: fdxread quarantine\n# starttime: %s\n" % datetime.now())
+
+    def add(self, frame, error, ts=None):
+        "Count a frame that could not be decoded. error is the exception."
+        kind = "unknown" if isinstance(error, NotImplementedError) else "malformed"
+        mtype = _hex(frame[:3])
+        key = (mtype, len(frame), kind)
+        if key not in self.counts and len(self.counts) >= max_keys:
+            key = ("other", 0, kind)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        self.total += 1
+        if count == 0:
+            self.errors[key] = str(error)
+            logging.debug("quarantine: new %s frame: %s" % (kind, str(error)))
+
+        examples = self.examples.setdefault(mtype, [])
+        if len(examples) < self.samples:
+            body = _hex(frame)
+            if body not in examples:
+                examples.append(body)
+
+        if self.spill is not None:
+            pdu = "".join([" %02x" % x for x in bytearray(frame)])
+            self.spill.write("%.3f\t%i\t%s\n" % (self.clock() if ts is None else ts, len(pdu), pdu))
+
+        if self.report_interval and self.clock() - self.last_report >= self.report_interval:
+            self.report()
+
+    def report(self):
+        "Log the summary, if anything was added since the last time."
+        self.last_report = self.clock()
+        if self.total == self.reported:
+            return
+        self.reported = self.total
+        for line in self.summary():
+            logging.info(line)
+
+    def summary(self, top=10):
+        "Summary lines, the top most common kinds of frames first."
+        if self.total == 0:
+            return ["quarantine: all frames decoded"]
+        kinds = {}
+        for (_, _, kind), count in self.counts.items():
+            kinds[kind] = kinds.get(kind, 0) + count
+        r = ["quarantine: %i frames not decoded (%s)" %
+             (self.total, ", ".join(["%i %s" % (kinds[k], k) for k in sorted(kinds)]))]
+        keys = sorted(self.counts, key=lambda k: (-self.counts[k], k))
+        for key in keys[:top]:
+            mtype, length, kind = key
+            line = "  0x%s %i bytes %s: %i" % (mtype, length, kind, self.counts[key])
+            if kind == "malformed":
+                line += " (%s)" % self.errors[key]
+            elif self.examples.get(mtype):
+                line += ", e.g. %s" % ", ".join(self.examples[mtype])
+            r.append(line)
+        if len(keys) > top:
+            r.append("  and %i more" % (len(keys) - top))
+        return r
+
+    def state(self):
+        "The counts and examples, for the decode cache."
+        return (self.total, dict(self.counts), dict(self.errors), dict(self.examples))
+
+    def merge(self, state):
+        total, counts, errors, examples = state
+        self.total += total
+        for key, count in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+            self.errors.setdefault(key, errors.get(key, ""))
+        for mtype, bodies in examples.items():
+            mine = self.examples.setdefault(mtype, [])
+            mine += [b for b in bodies if b not in mine][:self.samples - len(mine)]
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class TestQuarantine(unittest.TestCase):
+    def test_counts(self):
+        import os
+        import shutil
+        import tempfile
+        from .dumpreader import dumpreader
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        spill = os.path.join(tmpdir, "q.dump")
+
+        now = [0.0]
+        q = quarantine(samples=2, spill=spill, report_interval=10, clock=lambda: now[0])
+        for body in [b"\x00\x00\x81", b"\x00\x00\x81", b"\x01\x00\x81", b"\x02\x00\x81"]:
+            q.add(b"\x0d\x02\x0f" + body, NotImplementedError("No handler"))
+        q.add(b"\x07\x03\x04\x81", FailedAssumptionError("Incorrect length"), ts=12.5)
+        self.assertEqual(q.counts, {("0d020f", 6, "unknown"): 4, ("070304", 4, "malformed"): 1})
+        self.assertEqual(q.examples["0d020f"], ["0d020f000081", "0d020f010081"])
+        lines = q.summary()
+        self.assertEqual(lines[0], "quarantine: 5 frames not decoded (1 malformed, 4 unknown)")
+        self.assertEqual(lines[1], "  0x0d020f 6 bytes unknown: 4, e.g. 0d020f000081, 0d020f010081")
+        self.assertIn("(Incorrect length)", lines[2])
+
+        now[0] = 11.0
+        q.add(b"\x0d\x02\x0f\x00\x00\x81", NotImplementedError("No handler"))
+        self.assertEqual((q.last_report, q.reported), (11.0, 6))
+        q.close()
+
+        frames = list(dumpreader(spill))
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(frames[4], (12.5, b"\x07\x03\x04\x81"))
+
+        other = quarantine()
+        other.merge(q.state())
+        other.merge(q.state())
+        self.assertEqual(other.total, 12)
+        self.assertEqual(other.examples["0d020f"], ["0d020f000081", "0d020f010081"])
+        self.assertEqual(quarantine().summary(), ["quarantine: all frames decoded"])
+
+
+if __name__ == "__main__":
+    unittest.main()
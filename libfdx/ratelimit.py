@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Per message type rate limiting, applied to frames before decoding.
+
+On battery powered loggers there is no need for wind and depth at the full
+3-5 Hz. Frames over the budget for their type are dropped before any
+decoding or formatting is done, so the CPU time saved is proportional.
+"""
+from __future__ import print_function
+
+import unittest
+from binascii import unhexlify
+from time import time
+
+from .decode import mtypes
+
+
+def parse_rates(spec):
+    """
+    Parse "mdesc=rate,mdesc=rate" into a dict. Rates are per second.
+
+    The raw message type, 0x and three bytes in hex, can be used instead of
+    the name.
+
+    >>> sorted(parse_rates("wsi0=1,dst200depth=0.5").items())
+    [('dst200depth', 0.5), ('wsi0', 1.0)]
+    >>> parse_rates("0x010405=2")
+    {'0x010405': 2.0}
+    """
+    rates = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, rate = part.partition("=")
+        name = name.strip()
+        if name not in mtypes and not _ishex(name):
+            raise ValueError("Unknown message type %s" % name)
+        try:
+            rates[name] = float(rate)
+        except ValueError:
+            raise ValueError("Invalid rate for %s: %s" % (name, rate))
+        if rates[name] < 0:
+            raise ValueError("Negative rate for %s" % name)
+    return rates
+
+
+def _ishex(name):
+    """
+    >>> _ishex("0x010405"), _ishex("0xzz"), _ishex("0x0104")
+    (True, False, False)
+    """
+    return name.startswith("0x") and len(name) == 8 \
+        and all(c in "0123456789abcdefABCDEF" for c in name[2:])
+
+
+class decimator(object):
+    """
+    Drop frames arriving faster than the configured rate for their type.
+
+    rates is a dict of mdesc (or "0x..." mtype) to max frames per second.
+    A rate of 0 drops all frames of that type. Types not mentioned are not
+    limited.
+
+    The first frame after the interval has passed is let through, which is
+    also the most recent value at that point. Averaging would mean decoding
+    every frame, which is what we want to avoid here.
+    """
+    def __init__(self, rates, clock=time):
+        self.clock = clock
+        self.interval = {}  # 3 byte frame header -> min seconds between frames
+        self.names = {}     # 3 byte frame header -> name as given
+        for name, rate in rates.items():
+            mtype = mtypes.get(name)
+            if mtype is None:
+                mtype = int(name, 16)
+            header = unhexlify("%06x" % mtype)
+            self.interval[header] = 1.0 / rate if rate > 0 else None
+            self.names[header] = name
+        self.last = {}
+        self.n_dropped = {}
+
+    def accept(self, frame):
+        "True if the frame should be decoded, False if it is over budget."
+        header = frame[:3]
+        if header not in self.interval:
+            return True
+
+        interval = self.interval[header]
+        now = self.clock()
+        if interval is not None:
+            last = self.last.get(header)
+            if last is None or now - last >= interval:
+                self.last[header] = now
+                return True
+
+        self.n_dropped[header] = self.n_dropped.get(header, 0) + 1
+        return False
+
+    def summary(self):
+        "One line with the frames dropped per type."
+        if not self.n_dropped:
+            return "max-rate: no frames dropped"
+        return "max-rate: %i frames dropped (%s)" % (
+            sum(self.n_dropped.values()),
+            ", ".join(["%i %s" % (self.n_dropped[h], self.names[h])
+                       for h in sorted(self.n_dropped, key=lambda h: self.names[h])]))
+
+
+class TestDecimator(unittest.TestCase):
+    def test_rates(self):
+        now = [0.0]
+        d = decimator({"wsi0": 2, "dst200depth": 0}, clock=lambda: now[0])
+        wsi0 = unhexlify("010405b100cfaed081")
+        depth = unhexlify("0703040602000481")
+        gpscog = unhexlify("2104250a0054faa481")
+
+        self.assertTrue(d.accept(wsi0))
+        self.assertFalse(d.accept(wsi0))
+        self.assertFalse(d.accept(depth))
+        self.assertTrue(d.accept(gpscog))
+        now[0] = 0.5
+        self.assertTrue(d.accept(wsi0))
+        self.assertFalse(d.accept(wsi0))
+        self.assertEqual(sum(d.n_dropped.values()), 3)
+        self.assertEqual(d.summary(), "max-rate: 3 frames dropped (1 dst200depth, 2 wsi0)")
+        self.assertEqual(decimator({"wsi0": 1}).summary(), "max-rate: no frames dropped")
+
+    def test_parse(self):
+        with self.assertRaises(ValueError):
+            parse_rates("nosuchthing=1")
+        with self.assertRaises(ValueError):
+            parse_rates("wsi0=fast")
+        for name in ["0xzz", "0x01040", "0x0104050", "0x-10405"]:
+            with self.assertRaises(ValueError):
+                parse_rates("%s=1" % name)
+
+
+if __name__ == "__main__":
+    unittest.main()
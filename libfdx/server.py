@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Network server for sharing the output with other programs.
+
+Chart plotters, tablets and loggers connect over TCP and get a copy of
+the output stream, without needing socat/kplex in between.
+
+The server runs an asyncio event loop in a background thread. The reader
+loop in fdxread hands over already encoded bytes with send(), so each
+sentence is encoded once no matter how many clients are connected.
+"""
+from __future__ import print_function
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+import unittest
+from collections import deque
+from fnmatch import fnmatchcase
+
+from . import __version__
+from .formats import format_signalk_delta
+
+
+def parse_serve_url(url):
+    """
+    Split a tcp://host:port string into its parts.
+
+    >>> parse_serve_url("tcp://0.0.0.0:10110")
+    ('tcp', '0.0.0.0', 10110)
+    >>> parse_serve_url("tcp://:10110")
+    ('tcp', '', 10110)
+    """
+    if "://" not in url:
+        raise ValueError("Expected scheme://host:port, got %s" % url)
+    scheme, rest = url.split("://", 1)
+    host, _, port = rest.rpartition(":")
+    if not port.isdigit():
+        raise ValueError("Missing or invalid port in %s" % url)
+    return scheme.lower(), host, int(port)
+
+
+class _client(object):
+    """
+    Per-client send buffer.
+
+    Chunks are queued whole, so a dropped chunk never leaves half a
+    sentence on the wire.
+    """
+    def __init__(self, writer, maxbuf):
+        self.writer = writer
+        self.maxbuf = maxbuf
+        self.chunks = deque()
+        self.queued = 0
+        self.n_dropped = 0
+        self.wakeup = asyncio.Event()
+        self.closing = False
+
+    def push(self, data):
+        "Queue data for sending. Returns False if the buffer is full."
+        if self.queued + len(data) > self.maxbuf:
+            self.n_dropped += 1
+            return False
+        self.chunks.append(data)
+        self.queued += len(data)
+        self.wakeup.set()
+        return True
+
+    def pop_all(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.queued = 0
+        self.wakeup.clear()
+        return data
+
+
+class TCPserver(object):
+    """
+    Fan out byte chunks to any number of TCP clients.
+
+    Each client has its own bounded send buffer of maxbuf bytes. When a
+    client does not keep up, policy decides what happens: "drop" discards
+    the chunks that do not fit, "disconnect" closes the connection. Either
+    way the other clients and the caller of send() are never held up.
+    """
+    policies = ["drop", "disconnect"]
+
+    def __init__(self, host, port, maxbuf=64*1024, policy="drop"):
+        if policy not in self.policies:
+            raise ValueError("Unknown slow client policy %s" % policy)
+        self.host = host
+        self.port = port
+        self.maxbuf = maxbuf
+        self.policy = policy
+
+        self.clients = set()
+        self.n_clients = 0
+        self.n_sent = 0
+        self.n_dropped = 0
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self._started = threading.Event()
+        self._error = None
+
+    def start(self):
+        "Start listening. Raises socket.error if the port can not be bound."
+        self.thread = threading.Thread(target=self._run, name="fdxread-server")
+        self.thread.daemon = True
+        self.thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+        logging.info("Listening on %s:%i (%s slow clients)"
+                     % (self.host or "*", self.port, self.policy))
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host or None, self.port))
+        except (OSError, socket.error) as e:
+            self._error = e
+            self._started.set()
+            return
+
+        # If port 0 was asked for, tell the caller what we got.
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def send(self, data):
+        """
+        Queue data for all connected clients.
+
+        Called from the reader thread. Never blocks.
+        """
+        assert isinstance(data, bytes)
+        if self.loop is None or not self.clients:
+            return
+        self.loop.call_soon_threadsafe(self._fanout, data)
+
+    def _fanout(self, data):
+        self._deliver(self.clients, data)
+
+    def _deliver(self, clients, data):
+        for client in list(clients):
+            if client.push(data):
+                continue
+            self.n_dropped += 1
+            if self.policy == "disconnect":
+                logging.info("Disconnecting slow client %s" % self._peer(client))
+                self._drop(client)
+
+    def _drop(self, client):
+        if client in self.clients:
+            self.on_disconnect(client)
+        self.clients.discard(client)
+        client.closing = True
+        client.wakeup.set()
+        client.writer.close()
+
+    @staticmethod
+    def _peer(client):
+        peer = client.writer.get_extra_info("peername")
+        if isinstance(peer, tuple):
+            return "%s:%s" % peer[:2]
+        return str(peer)
+
+    def backlog(self):
+        "Bytes queued for the clients and not sent yet."
+        return sum([client.queued for client in list(self.clients)])
+
+    def on_connect(self, client):
+        "Hook for subclasses. Runs in the event loop thread."
+        pass
+
+    def on_line(self, client, line):
+        "Hook for subclasses. Input from clients is ignored by default."
+        pass
+
+    def on_disconnect(self, client):
+        "Hook for subclasses. Runs in the event loop thread."
+        pass
+
+    async def _handle(self, reader, writer):
+        client = _client(writer, self.maxbuf)
+        self.clients.add(client)
+        self.n_clients += 1
+        logging.debug("Client %s connected" % self._peer(client))
+        self.on_connect(client)
+
+        # Reading is also how we learn that the client went away.
+        async def watch():
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # Line too long.
+                    break
+                if not line:
+                    break
+                self.on_line(client, line)
+            if client in self.clients:
+                self._drop(client)
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            while not client.closing:
+                await client.wakeup.wait()
+                data = client.pop_all()
+                if not data:
+                    continue
+                writer.write(data)
+                await writer.drain()
+                self.n_sent += len(data)
+        except (ConnectionError, OSError) as e:
+            logging.debug("Client %s: %s" % (self._peer(client), str(e)))
+        finally:
+            watcher.cancel()
+            if client in self.clients:
+                self._drop(client)
+            logging.debug("Client %s disconnected (%i chunks dropped)"
+                          % (self._peer(client), client.n_dropped))
+
+    def close(self):
+        if self.loop is None or self.server is None:
+            return
+
+        def shutdown():
+            self.server.close()
+            for client in list(self.clients):
+                self._drop(client)
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(shutdown)
+        self.thread.join(timeout=2)
+
+
+class _subscription(object):
+    """
+    A set of path patterns and a minimum period between deltas.
+
+    Clients with the same subscription share one of these, so a delta is
+    filtered and serialized once per subscription and not once per client.
+    """
+    def __init__(self, patterns, minperiod):
+        self.patterns = patterns
+        self.minperiod = minperiod
+        self.clients = set()
+        self.matches = {}   # path -> bool, patterns are evaluated once.
+        self.pending = {}   # path -> value, waiting for minperiod to pass.
+        self.timestamp = None
+        self.last_sent = 0.0
+        self.flush_scheduled = False
+
+    def match(self, path):
+        try:
+            return self.matches[path]
+        except KeyError:
+            hit = any(fnmatchcase(path, p) for p in self.patterns)
+            self.matches[path] = hit
+            return hit
+
+
+def _requests(msg, kind):
+    """
+    The (path, minPeriod or None) in a subscribe or unsubscribe message.
+    Raises ValueError if it is not a list of objects with a string path and
+    a non-negative number for minPeriod.
+
+    >>> _requests({"subscribe": [{"path": "navigation.*", "minPeriod": 1000}]}, "subscribe")
+    [('navigation.*', 1000.0)]
+    >>> _requests({"subscribe": [{"minPeriod": "abc"}]}, "subscribe")
+    Traceback (most recent call last):
+    ...
+    ValueError: minPeriod must be a number, got 'abc'
+    """
+    requests = msg.get(kind, [])
+    if not isinstance(requests, list):
+        raise ValueError("%s must be a list" % kind)
+    r = []
+    for sub in requests:
+        if not isinstance(sub, dict):
+            raise ValueError("%s entries must be objects, got %r" % (kind, sub))
+        path = sub.get("path", "*")
+        if not isinstance(path, (str, type(u""))):
+            raise ValueError("path must be a string, got %r" % (path,))
+        period = sub.get("minPeriod")
+        if period is not None:
+            if isinstance(period, bool) or not isinstance(period, (int, float)) \
+                    or not 0 <= period < float("inf"):
+                raise ValueError("minPeriod must be a number, got %r" % (period,))
+            period = float(period)
+        r.append((path, period))
+    return r
+
+
+class SignalKserver(TCPserver):
+    """
+    Stream Signal K deltas to TCP clients.
+
+    Clients can narrow down what they get by sending a subscribe message:
+
+        {"context": "vessels.self",
+         "subscribe": [{"path": "environment.wind.*", "minPeriod": 1000}]}
+
+    "unsubscribe" with path "*" stops the stream. A new client gets
+    everything until it says otherwise.
+
+    maxrate limits how many deltas per second any client gets. Values
+    arriving faster than that are coalesced, keeping the latest value per
+    path, so no path goes missing.
+    """
+    def __init__(self, host, port, formatter, maxrate=0, **kwargs):
+        TCPserver.__init__(self, host, port, **kwargs)
+        self.formatter = formatter
+        self.minperiod = 1.0 / maxrate if maxrate else 0.0
+        self.subscriptions = {}   # (patterns, minperiod) -> _subscription
+        self.subscribed = {}      # client -> _subscription
+
+    def hello(self):
+        return (json.dumps({"name": "fdxread", "version": __version__,
+                            "self": "vessels.self", "roles": ["master"]})
+                + "\r\n").encode("utf-8")
+
+    def on_connect(self, client):
+        client.push(self.hello())
+        self._subscribe(client, ("*",), 0.0)
+
+    def on_disconnect(self, client):
+        self._subscribe(client, None, None)
+
+    def on_line(self, client, line):
+        try:
+            msg = json.loads(line.decode("utf-8"))
+            assert isinstance(msg, dict)
+        except (ValueError, AssertionError):
+            logging.debug("Ignoring garbage from %s" % self._peer(client))
+            return
+        try:
+            unsubscribe = [path for path, _ in _requests(msg, "unsubscribe")]
+            subscribe = _requests(msg, "subscribe")
+        except ValueError as e:
+            logging.info("Ignoring subscription from %s: %s" % (self._peer(client), str(e)))
+            return
+
+        current = self.subscribed.get(client)
+        patterns = set(current.patterns if current else [])
+        minperiod = current.minperiod if current else 0.0
+
+        for path in unsubscribe:
+            if path == "*":
+                patterns = set()
+            patterns.discard(path)
+
+        if subscribe and patterns == set(["*"]):
+            # Narrowing down from the default everything.
+            patterns = set()
+        for path, period in subscribe:
+            patterns.add(path)
+            if period is not None:
+                minperiod = max(minperiod, period / 1000.)
+
+        if patterns:
+            self._subscribe(client, tuple(sorted(patterns)), minperiod)
+        else:
+            self._subscribe(client, None, None)
+
+    def _subscribe(self, client, patterns, minperiod):
+        old = self.subscribed.pop(client, None)
+        if old is not None:
+            old.clients.discard(client)
+            if not old.clients:
+                del self.subscriptions[(old.patterns, old.minperiod)]
+
+        if patterns is None:
+            return
+        minperiod = max(minperiod, self.minperiod)
+        key = (patterns, minperiod)
+        if key not in self.subscriptions:
+            self.subscriptions[key] = _subscription(patterns, minperiod)
+        sub = self.subscriptions[key]
+        sub.clients.add(client)
+        self.subscribed[client] = sub
+
+    def send_values(self, values, timestamp=None):
+        """
+        Queue a list of (path, value) tuples for the subscribed clients.
+
+        Called from the reader thread. Never blocks.
+        """
+        if self.loop is None or not self.clients:
+            return
+        self.loop.call_soon_threadsafe(self._fanout_values, values, timestamp)
+
+    def _fanout_values(self, values, timestamp):
+        now = self.loop.time()
+        for sub in list(self.subscriptions.values()):
+            matched = [(k, v) for k, v in values if sub.match(k)]
+            if not matched:
+                continue
+
+            if sub.minperiod == 0.0:
+                self._push(sub, matched, timestamp)
+                continue
+
+            sub.pending.update(matched)
+            sub.timestamp = timestamp
+            if now - sub.last_sent >= sub.minperiod:
+                self._flush(sub)
+            elif not sub.flush_scheduled:
+                sub.flush_scheduled = True
+                self.loop.call_at(sub.last_sent + sub.minperiod,
+                                  self._flush, sub)
+
+    def _flush(self, sub):
+        sub.flush_scheduled = False
+        if not sub.pending or not sub.clients:
+            return
+        self._push(sub, list(sub.pending.items()), sub.timestamp)
+        sub.pending.clear()
+        sub.last_sent = self.loop.time()
+
+    def _push(self, sub, values, timestamp):
+        data = self.formatter.serialize(values, timestamp).encode("utf-8")
+        self._deliver(sub.clients, data)
+
+
+class TestTCPserver(unittest.TestCase):
+    def _connect(self, server):
+        sock = socket.create_connection(("127.0.0.1", server.port), timeout=2)
+        return sock
+
+    def _wait_clients(self, server, n):
+        for _ in range(100):
+            if len(server.clients) == n:
+                return
+            threading.Event().wait(0.01)
+        self.fail("expected %i clients, got %i" % (n, len(server.clients)))
+
+    def test_fanout(self):
+        server = TCPserver("127.0.0.1", 0)
+        server.start()
+        try:
+            clients = [self._connect(server) for _ in range(3)]
+            self._wait_clients(server, 3)
+
+            line = b"$FVMWV,268.64,R,0.06,K,A*20\r\n"
+            server.send(line)
+            for sock in clients:
+                self.assertEqual(sock.recv(1024), line)
+                sock.close()
+            self._wait_clients(server, 0)
+        finally:
+            server.close()
+
+    def test_bounded_buffer(self):
+        client = _client(writer=_stubwriter(), maxbuf=10)
+        self.assertTrue(client.push(b"12345"))
+        self.assertTrue(client.push(b"12345"))
+        self.assertFalse(client.push(b"1"))
+        self.assertEqual(client.n_dropped, 1)
+        self.assertEqual(client.pop_all(), b"1234512345")
+        self.assertTrue(client.push(b"1"))
+
+    def test_policy(self):
+        with self.assertRaises(ValueError):
+            TCPserver("", 10110, policy="block")
+
+
+class _stubwriter(object):
+    "What the servers use of asyncio.StreamWriter, without a socket."
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 3000) if name == "peername" else None
+
+    def close(self):
+        pass
+
+
+class TestSignalKserver(unittest.TestCase):
+    def _server(self, **kwargs):
+        # Exercise the subscription logic without sockets.
+        server = SignalKserver("127.0.0.1", 0, format_signalk_delta(), **kwargs)
+        server.loop = asyncio.new_event_loop()
+        self.addCleanup(server.loop.close)
+        return server
+
+    def _client(self, server):
+        client = _client(writer=_stubwriter(), maxbuf=64*1024)
+        server.clients.add(client)
+        server.on_connect(client)
+        client.pop_all()  # hello
+        return client
+
+    def test_subscriptions(self):
+        server = self._server()
+        everything = self._client(server)
+        wind = self._client(server)
+        wind2 = self._client(server)
+        for c in (wind, wind2):
+            server.on_line(c, b'{"context": "vessels.self", "subscribe": '
+                              b'[{"path": "environment.wind.*"}]}\n')
+        self.assertEqual(len(server.subscriptions), 2)
+
+        server._fanout_values([("environment.wind.angleApparent", 1.0),
+                               ("environment.depth.belowTransducer", 4.2)], None)
+        self.assertIn(b"belowTransducer", everything.pop_all())
+        r = wind.pop_all()
+        self.assertIn(b"angleApparent", r)
+        self.assertNotIn(b"belowTransducer", r)
+        self.assertEqual(r, wind2.pop_all())
+
+        server.on_line(wind, b'{"unsubscribe": [{"path": "*"}]}\n')
+        server._fanout_values([("environment.wind.angleApparent", 1.0)], None)
+        self.assertEqual(wind.pop_all(), b"")
+
+    def test_bad_subscriptions(self):
+        server = self._server()
+        client = self._client(server)
+        server.on_line(client, b'{"subscribe": [{"path": "environment.wind.*", "minPeriod": 100}]}\n')
+        before = server.subscribed[client]
+        for line in [b'{"subscribe": 5}', b'{"subscribe": ["x"]}',
+                     b'{"subscribe": [{"path": "x", "minPeriod": "abc"}]}',
+                     b'{"subscribe": [{"path": 5}]}', b'{"unsubscribe": {"path": "*"}}',
+                     b'{"subscribe": [{"path": "x", "minPeriod": -1}]}', b'[1, 2]', b'\xff']:
+            server.on_line(client, line + b"\n")
+            self.assertIs(server.subscribed[client], before)
+        self.assertEqual(before.patterns, ("environment.wind.*",))
+
+    def test_rate(self):
+        server = self._server(maxrate=1)
+        client = self._client(server)
+        server._fanout_values([("environment.wind.angleApparent", 1.0)], None)
+        server._fanout_values([("environment.wind.angleApparent", 2.0)], None)
+        server._fanout_values([("environment.depth.belowTransducer", 4.2)], None)
+        self.assertEqual(client.pop_all().count(b"\n"), 1)
+
+        # The rest is coalesced into one delta with the latest values.
+        server._flush(list(server.subscriptions.values())[0])
+        msg = json.loads(client.pop_all().decode("utf-8"))
+        self.assertEqual(sorted((v["path"], v["value"]) for v in msg["updates"]["values"]),
+                         [("environment.depth.belowTransducer", 4.2),
+                          ("environment.wind.angleApparent", 2.0)])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
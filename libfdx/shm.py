@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Publish the current instrument values in shared memory.
+
+There is only one serial port, but on the boat PC several programs want
+the current wind, depth and position. fdxread writes the latest values into
+a small memory mapped file, and any number of local readers can map the
+same file and read them without sockets or parsing.
+
+Layout (little endian):
+
+    0   8s   magic "FDXSHM1\\0"
+    8   I    number of fields
+    12  I    reserved
+    16  Q    sequence counter (odd while an update is in progress)
+    24  dd   value, timestamp for each field in `fields` order
+
+Units are as decoded: awa and cog in degrees, aws, stw and sog in knots,
+depth in metres, lat and lon in decimal degrees, time in Unix time,
+pressure in kPa and temp in degrees Fahrenheit (temp_f, see decode.py).
+
+A timestamp of 0 means the field has not been seen yet. Readers retry if
+the sequence counter was odd or changed while they read (a seqlock), so
+they never see half an update.
+
+    >>> reader = shmreader("/dev/shm/fdxread")    # doctest: +SKIP
+    >>> reader.read()["depth"]                    # doctest: +SKIP
+    (4.86, 1472051153.703)
+"""
+from __future__ import print_function
+
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from calendar import timegm
+from os.path import exists, join
+
+from .state import boatstate
+
+magic = b"FDXSHM1\0"
+
+# Position is split in two, and GPS time is stored as Unix time.
+fields = ["awa", "aws", "depth", "stw", "sog", "cog", "lat", "lon", "time",
+          "pressure", "temp"]
+
+_header = struct.Struct("<8sII")
+_seq = struct.Struct("<Q")
+_body = struct.Struct("<" + "dd" * len(fields))
+_seqoffset = _header.size
+_bodyoffset = _header.size + _seq.size
+size = _bodyoffset + _body.size
+
+
+def default_path():
+    "/dev/shm on Linux, the temporary directory elsewhere."
+    if exists("/dev/shm"):
+        return "/dev/shm/fdxread"
+    return join(tempfile.gettempdir(), "fdxread.shm")
+
+
+def _flatten(snapshot):
+    "boatstate snapshot to the flat list of values and timestamps."
+    r = []
+    for field in fields:
+        if field in ("lat", "lon"):
+            entry = snapshot.get("position")
+            if entry is not None:
+                entry = (entry[0][0 if field == "lat" else 1], entry[1])
+        elif field == "time":
+            entry = snapshot.get("time")
+            if entry is not None:
+                entry = (timegm(entry[0].timetuple()), entry[1])
+        else:
+            entry = snapshot.get(field)
+        if entry is None:
+            r += [0.0, 0.0]
+        else:
+            r += [float(entry[0]), float(entry[1])]
+    return r
+
+
+class shmwriter(object):
+    """
+    Publish a boatstate to a memory mapped file.
+
+    Used as a pipeline stage after the boatstate has been updated; every
+    message results in a new copy of the state in shared memory.
+    """
+    def __init__(self, path, state):
+        assert isinstance(state, boatstate)
+        self.path = path
+        self.state = state
+        self.seq = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.mm[:size] = b"\0" * size
+        _header.pack_into(self.mm, 0, magic, len(fields), 0)
+
+    def publish(self):
+        values = _flatten(self.state.fields)
+        mm = self.mm
+        self.seq += 1
+        _seq.pack_into(mm, _seqoffset, self.seq)     # odd: writing
+        _body.pack_into(mm, _bodyoffset, *values)
+        self.seq += 1
+        _seq.pack_into(mm, _seqoffset, self.seq)     # even: done
+
+    def handle(self, msg):
+        self.publish()
+        return msg
+
+    def close(self, remove=False):
+        "Unmap the file. With remove, also delete it so no one reads stale values."
+        self.mm.close()
+        if remove:
+            os.unlink(self.path)
+
+
+class shmreader(object):
+    "Read the values published by shmwriter, from any process."
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        with open(self.path, "rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        head, nfields, _ = _header.unpack_from(self.mm, 0)
+        if head != magic or nfields != len(fields):
+            raise ValueError("%s is not an fdxread shared memory file" % self.path)
+
+    def read_raw(self, retries=1000):
+        "Flat tuple of value, timestamp pairs, in `fields` order."
+        mm = self.mm
+        for _ in range(retries):
+            before = _seq.unpack_from(mm, _seqoffset)[0]
+            if before & 1:
+                continue
+            values = _body.unpack_from(mm, _bodyoffset)
+            if _seq.unpack_from(mm, _seqoffset)[0] == before:
+                return values
+        raise RuntimeError("Unable to get a consistent read of %s" % self.path)
+
+    def read(self):
+        """
+        All fields as a dict of field -> (value, timestamp).
+
+        Fields not seen yet are None.
+        """
+        values = self.read_raw()
+        r = {}
+        for idx, field in enumerate(fields):
+            ts = values[idx * 2 + 1]
+            r[field] = (values[idx * 2], ts) if ts else None
+        return r
+
+    def get(self, field):
+        "Latest value of one field, or None."
+        idx = fields.index(field)
+        values = self.read_raw()
+        if not values[idx * 2 + 1]:
+            return None
+        return values[idx * 2]
+
+    def close(self):
+        self.mm.close()
+
+
+class TestSharedMemory(unittest.TestCase):
+    def test_roundtrip(self):
+        from datetime import datetime
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+
+        state = boatstate(clock=lambda: 100.0)
+        writer = shmwriter(path, state)
+        reader = shmreader(path)
+        self.assertIsNone(reader.get("depth"))
+
+        for msg in [{"mdesc": "dst200depth", "depth": 4.86, "stw": 0},
+                    {"mdesc": "gpspos", "lat": 59.8, "lon": 10.6},
+                    {"mdesc": "gpstime", "utctime": datetime(2016, 8, 24, 17, 5, 53)}]:
+            state.update(msg)
+            writer.handle(msg)
+
+        r = reader.read()
+        self.assertEqual(r["depth"], (4.86, 100.0))
+        self.assertEqual(r["lat"], (59.8, 100.0))
+        self.assertEqual(r["time"], (1472058353.0, 100.0))
+        self.assertIsNone(r["awa"])
+        self.assertEqual(reader.get("lon"), 10.6)
+        reader.close()
+        writer.close()
+
+        writer = shmwriter(path, state)
+        writer.close(remove=True)
+        self.assertFalse(exists(path))
+        open(path, "w").close()     # For the cleanup.
+
+    def test_torn_read(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        writer = shmwriter(path, boatstate())
+        reader = shmreader(path)
+        _seq.pack_into(writer.mm, _seqoffset, 1)   # Writer died half way.
+        with self.assertRaises(RuntimeError):
+            reader.read_raw(retries=10)
+
+    def test_not_ours(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b"x" * size)
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with self.assertRaises(ValueError):
+            shmreader(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
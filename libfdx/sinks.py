@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Output sinks.
+
+A sink is a formatter paired with a destination. Several sinks can be
+attached to the same decoded stream with fanout(), so a message is decoded
+once and every sink gets the same dict.
+
+Sinks are configured with "format:destination" strings:
+
+    nmea0183                         (stdout)
+    json:file:/var/log/boat.json
+    nmea0183:tcp://0.0.0.0:10110
+    signalk:udp://192.168.1.255:55555
+"""
+from __future__ import print_function
+
+import logging
+import socket
+import threading
+import unittest
+from io import BytesIO
+from sys import stdout
+from time import time, sleep
+
+from .formats import format_json, format_signalk_delta
+from .format_nmea import format_NMEA0183
+from .stats import clock_ns
+
+formats = ["nmea0183", "json", "raw", "signalk", "none"]
+
+
+def make_formatter(name, coalesce=0.0, state=None):
+    """
+    Formatter instance for an output format name. None for 'none'.
+
+    coalesce is the Signal K delta coalescing window in seconds. state is
+    a boatstate kept up to date by the caller, shared between formatters.
+    """
+    name = name.lower()
+    if name == "nmea0183":
+        return format_NMEA0183(state=state)
+    elif name == "json":
+        return format_json(devmode=False)
+    elif name == "raw":
+        return format_json(devmode=True)
+    elif name == "signalk":
+        return format_signalk_delta(coalesce=coalesce, state=state)
+    elif name == "none":
+        return None
+    raise ValueError("Unknown output format %s" % name)
+
+
+def parse_sink(spec):
+    """
+    Split a sink specification into format and destination.
+
+    >>> parse_sink("json")
+    ('json', 'stdout')
+    >>> parse_sink("json:file:/tmp/out.json")
+    ('json', 'file:/tmp/out.json')
+    >>> parse_sink("nmea0183:tcp://0.0.0.0:10110")
+    ('nmea0183', 'tcp://0.0.0.0:10110')
+    """
+    fmt, _, dest = spec.partition(":")
+    fmt = fmt.lower()
+    if fmt not in formats:
+        raise ValueError("Unknown output format %s" % fmt)
+    return fmt, dest or "stdout"
+
+
+class streamsink(object):
+    """
+    Write output to a file-like object.
+
+    With flush_after=0 every chunk is written and flushed right away. With
+    flush_after set, chunks are collected and written in one go when there
+    are maxbytes of them, or when the oldest has waited flush_after seconds.
+    A background thread takes care of the latter when the input goes quiet.
+    """
+    def __init__(self, stream, name, flush_after=0.0, maxbytes=64*1024):
+        self.stream = stream
+        self.name = name
+        self.flush_after = flush_after
+        self.maxbytes = maxbytes
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.oldest = None
+
+        self.started = time()
+        self.n_bytes = 0
+        self.n_writes = 0
+
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        if flush_after:
+            t = threading.Thread(target=self._flusher, name="fdxread-flush-%s" % name)
+            t.daemon = True
+            t.start()
+
+    def write(self, data):
+        if not self.flush_after:
+            self._write(data)
+            return
+
+        with self.lock:
+            if not self.pending:
+                self.oldest = time()
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= self.maxbytes:
+                self._flush()
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+        self.n_bytes += len(data)
+        self.n_writes += 1
+
+    def _flush(self):
+        "Write out what is pending. Lock must be held."
+        if self.pending:
+            self._write(b"".join(self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flusher(self):
+        while not self.closed.wait(self.flush_after / 2.):
+            with self.lock:
+                if self.pending and time() - self.oldest >= self.flush_after:
+                    self._flush()
+
+    def backlog(self):
+        "Bytes waiting to be written."
+        return self.pending_bytes
+
+    def stats(self):
+        "Bytes and writes per second since start."
+        elapsed = max(time() - self.started, 1e-9)
+        return self.n_bytes / elapsed, self.n_writes / elapsed
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+        if self.flush_after:
+            bps, wps = self.stats()
+            logging.info("%s: %i bytes in %i writes (%.0f bytes/s, %.1f writes/s)"
+                         % (self.name, self.n_bytes, self.n_writes, bps, wps))
+
+
+class stdoutsink(streamsink):
+    def __init__(self, flush_after=0.0):
+        # Python 3 has a separate binary layer, Python 2 takes bytes directly.
+        streamsink.__init__(self, getattr(stdout, "buffer", stdout), "stdout",
+                            flush_after=flush_after)
+
+
+class filesink(streamsink):
+    def __init__(self, path, flush_after=0.0):
+        self.path = path
+        streamsink.__init__(self, open(path, "ab"), path,
+                            flush_after=flush_after)
+
+    def close(self):
+        streamsink.close(self)
+        self.stream.close()
+
+
+class udpsink(object):
+    """
+    Send each output chunk as a UDP datagram.
+
+    Broadcast addresses are allowed, which is how most chart plotters
+    expect to get NMEA0183 over UDP.
+    """
+    def __init__(self, host, port):
+        self.addr = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def write(self, data):
+        try:
+            self.sock.sendto(data, self.addr)
+        except (OSError, socket.error) as e:
+            # No route to host and similar. Not our problem to fix.
+            logging.debug("udp send to %s:%s failed: %s"
+                          % (self.addr[0], self.addr[1], str(e)))
+
+    def close(self):
+        self.sock.close()
+
+
+class tcpsink(object):
+    "Wrapper giving a TCPserver the sink interface."
+    def __init__(self, server):
+        self.server = server
+
+    def write(self, data):
+        self.server.send(data)
+
+    def backlog(self):
+        return self.server.backlog()
+
+    def close(self):
+        self.server.close()
+
+
+def make_destination(dest, formatter=None, maxbuf=64*1024, policy="drop",
+                     maxrate=0, flush_after=0.0):
+    """
+    Open an output destination.
+
+    For Signal K over TCP the subscription-aware SignalKserver is returned,
+    as it needs the values before they are serialized.
+
+    flush_after is the max latency in seconds when batching writes to
+    stdout and files. 0 writes every chunk as it comes.
+    """
+    if dest in ["stdout", "-"]:
+        return stdoutsink(flush_after=flush_after)
+    elif dest.startswith("file:"):
+        path = dest[len("file:"):]
+        if path.startswith("//"):
+            path = path[2:]
+        return filesink(path, flush_after=flush_after)
+
+    # Imported here since the server is Python 3 only.
+    from .server import TCPserver, SignalKserver, parse_serve_url
+    scheme, host, port = parse_serve_url(dest)
+    if scheme == "udp":
+        return udpsink(host or "127.0.0.1", port)
+    elif scheme == "tcp":
+        if isinstance(formatter, format_signalk_delta):
+            server = SignalKserver(host, port, formatter, maxrate=maxrate,
+                                   maxbuf=maxbuf, policy=policy)
+        else:
+            server = TCPserver(host, port, maxbuf=maxbuf, policy=policy)
+        server.start()
+        if isinstance(server, SignalKserver):
+            return server
+        return tcpsink(server)
+    raise ValueError("Unknown destination %s" % dest)
+
+
+class output(object):
+    "A formatter and a destination. With stats, both are timed."
+    def __init__(self, formatter, destination, stats=None):
+        self.formatter = formatter
+        self.destination = destination
+        # Signal K servers filter on paths, so they get the values instead.
+        self.values = hasattr(destination, "send_values")
+        self.stats = stats
+        if stats is not None:
+            self.timers = ("format %s" % type(formatter).__name__,
+                           "write %s" % type(destination).__name__)
+            self.handle = self._timed_handle
+
+    def handle(self, msg):
+        if self.values:
+            r = self.formatter.values(msg)
+            if r:
+                self.destination.send_values(r, self.formatter.gpstime)
+            return
+
+        data = self.formatter.encode(msg)
+        if data:
+            self.destination.write(data)
+
+    def _timed_handle(self, msg):
+        t0 = clock_ns()
+        if self.values:
+            r = self.formatter.values(msg)
+            t1 = clock_ns()
+            if r:
+                self.destination.send_values(r, self.formatter.gpstime)
+        else:
+            data = self.formatter.encode(msg)
+            t1 = clock_ns()
+            if data:
+                self.destination.write(data)
+        self.stats.add(self.timers[0], t1 - t0)
+        self.stats.add(self.timers[1], clock_ns() - t1)
+
+    def close(self):
+        # Whatever a formatter is holding back goes out before closing.
+        flush = getattr(self.formatter, "flush", None)
+        if flush is not None and not self.values:
+            r = flush()
+            if r:
+                self.destination.write(r.encode("utf-8"))
+        self.destination.close()
+
+
+class fanout(object):
+    """
+    Hand each decoded message to every output.
+
+    Formatters do not modify the message, so the same dict is given to all.
+    """
+    def __init__(self, outputs=None, stats=None):
+        self.outputs = outputs or []
+        self.stats = stats
+
+    def add(self, formatter, destination):
+        if formatter is None:   # --format none
+            return
+        self.outputs.append(output(formatter, destination, stats=self.stats))
+
+    def handle(self, msg):
+        for o in self.outputs:
+            o.handle(msg)
+
+    def close(self):
+        for o in self.outputs:
+            o.close()
+
+
+class _memorysink(object):
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        pass
+
+
+class TestSinks(unittest.TestCase):
+    def test_fanout(self):
+        nmea = _memorysink()
+        js = _memorysink()
+        out = fanout()
+        out.add(make_formatter("nmea0183"), nmea)
+        out.add(make_formatter("json"), js)
+        out.add(make_formatter("raw"), _memorysink())
+        out.add(make_formatter("none"), _memorysink())
+        self.assertEqual(len(out.outputs), 3)
+
+        msg = {"mdesc": "environment", "airpressure": 101.42, "temp_c": 21.0,
+               "strbody": "b3279e00c481"}
+        orig = dict(msg)
+        out.handle(msg)
+        self.assertEqual(msg, orig)  # Untouched by the formatters.
+        self.assertIn(b"$ZZXDR", nmea.data)
+        self.assertEqual(js.data.strip(), b'{"airpressure": 101.42, "temp_c": 21.0}')
+
+    def test_stats(self):
+        from .stats import stats
+        s = stats()
+        nmea = _memorysink()
+        out = fanout(stats=s)
+        out.add(make_formatter("nmea0183"), nmea)
+        out.handle({"mdesc": "environment", "airpressure": 101.42, "temp_c": 21.0})
+        self.assertIn(b"$ZZXDR", nmea.data)
+        self.assertEqual(sorted(s.timers), ["format format_NMEA0183", "write _memorysink"])
+
+    def test_parse(self):
+        with self.assertRaises(ValueError):
+            parse_sink("xml:stdout")
+        with self.assertRaises(ValueError):
+            make_destination("carrierpigeon://coop:1")
+
+    def test_batching(self):
+        out = BytesIO()
+        sink = streamsink(out, "test", flush_after=0.05, maxbytes=10)
+        sink.write(b"12345")
+        self.assertEqual(out.getvalue(), b"")
+        sink.write(b"67890")   # maxbytes reached.
+        self.assertEqual(out.getvalue(), b"1234567890")
+        self.assertEqual(sink.n_writes, 1)
+
+        sink.write(b"abc")
+        for _ in range(50):    # Latency bound.
+            if out.getvalue().endswith(b"abc"):
+                break
+            sleep(0.01)
+        self.assertEqual(out.getvalue(), b"1234567890abc")
+
+        sink.write(b"def")
+        sink.close()
+        self.assertEqual(out.getvalue(), b"1234567890abcdef")
+        self.assertEqual(sink.n_writes, 3)
+
+        sink = streamsink(BytesIO(), "test")
+        sink.write(b"abc")
+        sink.write(b"def")
+        self.assertEqual(sink.n_writes, 2)
+
+    def test_udp(self):
+        rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rx.bind(("127.0.0.1", 0))
+        rx.settimeout(2)
+        self.addCleanup(rx.close)
+        sink = make_destination("udp://127.0.0.1:%i" % rx.getsockname()[1])
+        sink.write(b"$SDDBT,,f,4.86,m,,F*1C\r\n")
+        self.assertEqual(rx.recv(1024), b"$SDDBT,,f,4.86,m,,F*1C\r\n")
+        sink.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
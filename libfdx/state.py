@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Current boat state: the latest value of each instrument reading.
+
+The decoded stream is a sequence of partial updates (wind in one message,
+depth in the next). boatstate keeps the latest value and when it arrived
+for each field, so formatters and other consumers can ask "what is the
+depth now" without tracking it themselves.
+
+There is a single writer (the reader loop). Each field is stored as one
+(value, timestamp) tuple, which is replaced as a whole, so readers in other
+threads always see a consistent pair without any locking.
+"""
+from __future__ import print_function
+
+import unittest
+from datetime import datetime
+from decimal import Decimal
+from math import isnan
+from time import time
+
+
+def _float(v):
+    "Decimal, Latitude/Longitude and plain numbers as float."
+    return float(getattr(v, "decimal_degree", v))
+
+
+def _valid(v):
+    """
+    NaN is what the decoder gives for missing data (no lock, no sensor).
+
+    Both float and Decimal NaN, which is not equal to itself.
+
+    >>> _valid(Decimal("NaN")), _valid(float("NaN")), _valid(Decimal(0))
+    (False, False, True)
+    """
+    return v == v
+
+
+def brownout(msg):
+    """
+    True for the wsi0 the wind transducer sends when it has nothing. The
+    aws_hi is NaN, and awa and aws_lo are zeroes, not readings.
+    """
+    return msg["mdesc"] == "wsi0" and not _valid(msg.get("aws_hi"))
+
+
+class boatstate(object):
+    """
+    Latest value, timestamp and age for each known field.
+
+    Fields: awa, aws, depth, stw, sog, cog, position (lat, lon), time
+    (GPS UTC time), pressure, temp, and with the derived stage twa, tws,
+    twd, vmg and distance.
+
+    NaN values are not stored. When a sensor stops reporting, or reports
+    that it has nothing (like the wind transducer brown out, where wsi0
+    comes with a body of ffff00000081), the field keeps its old value and
+    grows older until stale() says so.
+    """
+    # mdesc -> [(field, message key, converter)]
+    sources = {
+        "wsi0": [("awa", "awa", float), ("aws", "aws_lo", float)],
+        "dst200depth": [("depth", "depth", float), ("stw", "stw", float)],
+        "gpscog": [("sog", "sog", float), ("cog", "cog", float)],
+        "environment": [("pressure", "airpressure", float), ("temp", "temp_f", float)],
+        # Computed by the derived stage.
+        "truewind": [("twa", "twa", float), ("tws", "tws", float), ("twd", "twd", float),
+                     ("vmg", "vmg", float)],
+        "trip": [("distance", "distance", float)],
+    }
+
+    # Seconds without an update before a field is stale.
+    maxage = {
+        "awa": 3.0, "aws": 3.0,
+        "depth": 3.0, "stw": 3.0,
+        "sog": 5.0, "cog": 5.0, "position": 5.0, "time": 5.0,
+        "pressure": 10.0, "temp": 10.0,
+        "twa": 3.0, "tws": 3.0, "twd": 5.0, "vmg": 3.0,
+    }
+
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.fields = {}  # field -> (value, timestamp)
+        self.n_updates = 0
+
+    def update(self, msg):
+        mdesc = msg["mdesc"]
+        now = self.clock()
+        fields = self.fields
+
+        if brownout(msg):
+            return
+
+        for field, key, convert in self.sources.get(mdesc, ()):
+            value = msg.get(key)
+            if value is None or not _valid(value):
+                continue
+            fields[field] = (convert(value), now)
+
+        if mdesc == "gpspos":
+            lat = _float(msg["lat"])
+            lon = _float(msg["lon"])
+            if not (isnan(lat) or isnan(lon)):
+                fields["position"] = ((lat, lon), now)
+        elif mdesc == "gpstime":
+            utctime = msg["utctime"]
+            if isinstance(utctime, datetime):
+                fields["time"] = (utctime, now)
+        self.n_updates += 1
+
+    def handle(self, msg):
+        "Pipeline stage interface. Updates the state and passes msg on."
+        self.update(msg)
+        return msg
+
+    def get(self, field, default=None):
+        "Latest value of field, or default if it has never been seen."
+        try:
+            return self.fields[field][0]
+        except KeyError:
+            return default
+
+    def timestamp(self, field):
+        "When field was last updated, or None."
+        try:
+            return self.fields[field][1]
+        except KeyError:
+            return None
+
+    def age(self, field):
+        "Seconds since the field was last updated, or None."
+        try:
+            return self.clock() - self.fields[field][1]
+        except KeyError:
+            return None
+
+    def stale(self, field, maxage=None):
+        "True if the field is missing or older than maxage seconds."
+        age = self.age(field)
+        if age is None:
+            return True
+        if maxage is None:
+            maxage = self.maxage.get(field, 10.0)
+        return age > maxage
+
+    def snapshot(self):
+        "All fields as a dict of field -> (value, timestamp)."
+        return dict(self.fields)
+
+
+class TestBoatState(unittest.TestCase):
+    def test_update(self):
+        from .decode import FDXDecode
+        now = [100.0]
+        state = boatstate(clock=lambda: now[0])
+        self.assertIsNone(state.get("awa"))
+        self.assertTrue(state.stale("awa"))
+
+        state.update({"mdesc": "wsi0", "awa": Decimal(245.5), "aws_lo": 3.2,
+                      "aws_hi": Decimal(3.2)})
+        state.update({"mdesc": "gpspos", "lat": 59.8, "lon": 10.6})
+        state.update({"mdesc": "gpstime", "utctime": datetime(2016, 8, 24, 17, 5, 53)})
+        self.assertEqual(state.get("awa"), 245.5)
+        self.assertEqual(state.get("position"), (59.8, 10.6))
+        self.assertFalse(state.stale("awa"))
+
+        # Wind transducer brown out, as the decoder gives it.
+        now[0] = 102.0
+        state.update(FDXDecode(b"\x01\x04\x05\xff\xff\x00\x00\x00\x81"))
+        self.assertEqual(state.get("awa"), 245.5)
+        self.assertEqual(state.get("aws"), 3.2)
+        self.assertEqual(state.age("aws"), 2.0)
+        now[0] = 104.0
+        self.assertTrue(state.stale("aws"))
+
+        # No GPS lock.
+        state.update({"mdesc": "gpscog", "cog": float("NaN"), "sog": float("NaN")})
+        self.assertIsNone(state.get("sog"))
+        state.update({"mdesc": "gpstime", "utctime": float("NaN")})
+        self.assertEqual(state.get("time"), datetime(2016, 8, 24, 17, 5, 53))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Where the time goes: counters and timers for each part of fdxread.
+
+Given a stats instance, the interfaces time reading and decoding of each
+frame (per message type), the pipeline times each stage and the outputs
+time formatting and writing:
+
+    read            serial reads (GND10), or reading and framing (dump files)
+    decode          FDXDecode, per message type
+    stage <name>    each pipeline stage
+    format <name>   each formatter
+    write <name>    each destination
+
+Rare events, like the GND10 serial port being reopened, are counted with
+count(). Without stats nothing is timed. Timers are integer nanoseconds from
+perf_counter_ns() where available.
+"""
+from __future__ import print_function
+
+import logging
+import unittest
+from time import time
+
+try:
+    from time import perf_counter_ns as clock_ns
+except ImportError:  # Before Python 3.7
+    def clock_ns():
+        return int(time() * 1e9)
+
+
+def _name(mtype):
+    return " ".join(["%02x" % x for x in bytearray(mtype)])
+
+
+class stats(object):
+    def __init__(self, interval=10.0, clock=time):
+        self.interval = interval
+        self.clock = clock
+        self.started = clock()
+        self.last_report = self.started
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.n_errors = 0
+        self.timers = {}    # name -> [count, ns]
+        self.counters = {}  # name -> count, for rare events like serial port resets
+        self.mtypes = {}    # mtype -> [count, ns, errors, mdesc]
+
+    def add(self, name, ns):
+        t = self.timers.get(name)
+        if t is None:
+            t = self.timers[name] = [0, 0]
+        t[0] += 1
+        t[1] += ns
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def frame(self, nbytes, ns):
+        "A frame of nbytes was read in ns nanoseconds."
+        self.n_frames += 1
+        self.n_bytes += nbytes
+        self.add("read", ns)
+        if self.interval and self.n_frames % 256 == 0 \
+                and self.clock() - self.last_report >= self.interval:
+            self.report()
+
+    def decoded(self, mtype, ns, msg):
+        "A frame of mtype was decoded in ns. msg is False if decoding failed."
+        m = self.mtypes.get(mtype)
+        if m is None:
+            m = self.mtypes[mtype] = [0, 0, 0, None]
+        m[0] += 1
+        m[1] += ns
+        if msg is False:
+            m[2] += 1
+            self.n_errors += 1
+        elif msg is not None and m[3] is None:
+            m[3] = msg["mdesc"]
+        self.add("decode", ns)
+
+    def report(self):
+        self.last_report = self.clock()
+        for line in self.summary():
+            logging.info(line)
+
+    def summary(self, top=15):
+        elapsed = max(self.clock() - self.started, 1e-9)
+        r = ["stats: %i frames (%.1f/s), %i bytes (%.1f/s), %i errors in %.1f s" %
+             (self.n_frames, self.n_frames / elapsed, self.n_bytes, self.n_bytes / elapsed,
+              self.n_errors, elapsed)]
+        if self.counters:
+            r.append("  " + ", ".join(["%s %i" % (k, self.counters[k]) for k in sorted(self.counters)]))
+        for name in sorted(self.timers, key=lambda k: -self.timers[k][1]):
+            count, ns = self.timers[name]
+            r.append("  %-28s %8i x %8.1f us = %7.2f s" % (name, count, ns / 1e3 / count, ns / 1e9))
+        if self.mtypes:
+            r.append("stats: decode per message type")
+            keys = sorted(self.mtypes, key=lambda k: -self.mtypes[k][1])
+            for mtype in keys[:top]:
+                count, ns, errors, mdesc = self.mtypes[mtype]
+                line = "  %s %-19s %8i x %8.1f us = %7.2f s" % (
+                    _name(mtype), mdesc or "", count, ns / 1e3 / count, ns / 1e9)
+                if errors:
+                    line += ", %i errors" % errors
+                r.append(line)
+            if len(keys) > top:
+                r.append("  and %i more" % (len(keys) - top))
+        return r
+
+
+class TestStats(unittest.TestCase):
+    def test_summary(self):
+        now = [100.0]
+        s = stats(interval=10, clock=lambda: now[0])
+        for _ in range(255):
+            s.frame(9, 1000)
+            s.decoded(b"\x01\x04\x05", 20000, {"mdesc": "wsi0"})
+        s.decoded(b"\x0d\x02\x0f", 5000, False)
+        s.add("stage boatstate", 3000)
+        s.count("serial_resets")
+        now[0] = 110.0
+        s.frame(9, 1000)    # The 256th, time for a report.
+        self.assertEqual(s.last_report, 110.0)
+
+        lines = s.summary()
+        self.assertEqual(lines[0], "stats: 256 frames (25.6/s), 2304 bytes (230.4/s), 1 errors in 10.0 s")
+        self.assertEqual(lines[1], "  serial_resets 1")
+        self.assertEqual(lines[2].split(), ["decode", "256", "x", "19.9", "us", "=", "0.01", "s"])
+        self.assertIn("01 04 05 wsi0", lines[6])
+        self.assertTrue(lines[7].endswith(", 1 errors"))
+        self.assertGreater(clock_ns(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
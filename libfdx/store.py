@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+Store instrument values in an SQLite database.
+
+Tables:
+
+    fields(id, mdesc, field)         One row per stored message field.
+    samples(ts, field, value)        ts is Unix time, field is fields.id.
+
+samples has an index on (field, ts), so "wind between 14:00 and 14:30" and
+per-minute averages only read the rows they need. Angles (awa, cog, twa,
+twd) are averaged as directions, so 350 and 10 give 0, not 180. Rows are inserted in
+batches, one transaction per batch, with the database in WAL mode so
+queries can run while fdxread is writing.
+"""
+from __future__ import print_function
+
+import sqlite3
+import unittest
+from calendar import timegm
+from datetime import datetime
+from decimal import Decimal
+from math import atan2, cos, degrees, radians, sin
+from time import time
+
+from .damping import damping
+from .state import brownout
+
+# What is stored, per message type.
+stored = {
+    "wsi0": ("awa", "aws_lo"),
+    "dst200depth": ("depth", "stw"),
+    "gpspos": ("lat", "lon"),
+    "gpscog": ("sog", "cog"),
+    "environment": ("airpressure", "temp_f"),
+    "truewind": ("twa", "tws", "twd", "vmg"),
+    "trip": ("distance",),
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS fields (
+    id INTEGER PRIMARY KEY,
+    mdesc TEXT NOT NULL,
+    field TEXT NOT NULL,
+    UNIQUE (mdesc, field)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    ts REAL NOT NULL,
+    field INTEGER NOT NULL REFERENCES fields(id),
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_field_ts ON samples (field, ts);
+"""
+
+
+def parse_time(s, reference=None):
+    """
+    Parse a time given on the command line, as Unix time (UTC).
+
+    Accepts Unix time, "YYYY-MM-DD HH:MM[:SS]" and "HH:MM[:SS]". The last
+    is on the same (UTC) day as reference.
+
+    >>> parse_time("2016-08-24 14:30")
+    1472049000.0
+    >>> parse_time("14:00", reference=1472051153.7)
+    1472047200.0
+    """
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S"]:
+        try:
+            return float(timegm(datetime.strptime(s, fmt).timetuple()))
+        except ValueError:
+            pass
+    for fmt in ["%H:%M:%S", "%H:%M"]:
+        try:
+            t = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        if reference is None:
+            raise ValueError("No date for %s" % s)
+        day = datetime.utcfromtimestamp(reference)
+        t = t.replace(year=day.year, month=day.month, day=day.day)
+        return float(timegm(t.timetuple()))
+    raise ValueError("Unknown time format: %s" % s)
+
+
+# For SQL, the angle fields in damping.
+angles = ", ".join(["'%s'" % field for field in sorted(damping.angles)])
+
+
+class store(object):
+    """
+    Write decoded messages to an SQLite database, and query them.
+
+    Used as a pipeline stage, with clock giving the time stamp of each
+    message. Rows are written when batchsize of them are pending, or
+    flush_after seconds (on the wall clock) after the last write.
+    """
+    def __init__(self, path, batchsize=10000, flush_after=1.0, clock=time):
+        self.path = path
+        self.batchsize = batchsize
+        self.flush_after = flush_after
+        self.clock = clock
+
+        # Transactions are handled here, not by the sqlite3 module.
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(schema)
+        self.db.create_function("sind", 1, lambda v: sin(radians(v)))
+        self.db.create_function("cosd", 1, lambda v: cos(radians(v)))
+
+        self.fieldids = {}
+        for fieldid, mdesc, field in self.db.execute("SELECT id, mdesc, field FROM fields"):
+            self.fieldids[(mdesc, field)] = fieldid
+        # mdesc -> [(key, field id)]
+        self.layout = {}
+        for mdesc, keys in stored.items():
+            self.layout[mdesc] = [(key, self.fieldid(mdesc, key)) for key in keys]
+
+        self.pending = []
+        self.last_flush = time()
+        self.n_rows = 0
+
+    def fieldid(self, mdesc, field):
+        fieldid = self.fieldids.get((mdesc, field))
+        if fieldid is None:
+            cur = self.db.execute("INSERT INTO fields (mdesc, field) VALUES (?, ?)",
+                                  (mdesc, field))
+            fieldid = self.fieldids[(mdesc, field)] = cur.lastrowid
+        return fieldid
+
+    def add(self, ts, msg):
+        layout = self.layout.get(msg["mdesc"])
+        if layout is None or brownout(msg):    # Zeroes, not wind readings.
+            return
+        pending = self.pending
+        for key, fieldid in layout:
+            value = msg.get(key)
+            if value is None:
+                continue
+            value = float(getattr(value, "decimal_degree", value))
+            if value != value:  # NaN, no data.
+                continue
+            pending.append((ts, fieldid, value))
+
+        if len(pending) >= self.batchsize or time() - self.last_flush >= self.flush_after:
+            self.flush()
+
+    def handle(self, msg):
+        self.add(self.clock(), msg)
+        return msg
+
+    def flush(self):
+        self.last_flush = time()
+        if not self.pending:
+            return
+        db = self.db
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO samples (ts, field, value) VALUES (?, ?, ?)", self.pending)
+        db.execute("COMMIT")
+        self.n_rows += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def summary(self):
+        self.flush()
+        return "store: %i values written to %s" % (self.n_rows, self.path)
+
+    def _fields(self, mdesc, fields):
+        ids = []
+        for (m, f), fieldid in sorted(self.fieldids.items()):
+            if m == mdesc and (not fields or f in fields):
+                ids.append(fieldid)
+        if not ids:
+            raise ValueError("Nothing stored for %s %s" % (mdesc, ", ".join(fields or [])))
+        return ids
+
+    def timespan(self):
+        "(first, last) time stamp in the database, or (None, None)."
+        return self.db.execute("SELECT min(ts), max(ts) FROM samples").fetchone()
+
+    def query(self, mdesc, start, end, fields=None):
+        """
+        Values of mdesc between start and end.
+
+        Returns a list of (ts, field, value), sorted on time.
+        """
+        ids = self._fields(mdesc, fields)
+        sql = ("SELECT s.ts, f.field, s.value FROM samples s JOIN fields f ON f.id = s.field "
+               "WHERE s.field IN (%s) AND s.ts >= ? AND s.ts < ? ORDER BY s.ts, f.field"
+               % ", ".join("?" * len(ids)))
+        return self.db.execute(sql, ids + [start, end]).fetchall()
+
+    def aggregate(self, mdesc, start, end, period=60, fields=None):
+        """
+        Average, min, max and count of the values of mdesc per period seconds.
+
+        Returns a list of (period start, field, avg, min, max, count). For
+        angles the average is the mean direction (0-360), and min and max
+        are None: there is no smallest or largest direction.
+        """
+        ids = self._fields(mdesc, fields)
+        sql = ("SELECT CAST(s.ts / ? AS INTEGER) * ? AS bucket, f.field, "
+               "avg(s.value), min(s.value), max(s.value), count(*), "
+               "CASE WHEN f.field IN (%s) THEN sum(sind(s.value)) END, "
+               "CASE WHEN f.field IN (%s) THEN sum(cosd(s.value)) END "
+               "FROM samples s JOIN fields f ON f.id = s.field "
+               "WHERE s.field IN (%s) AND s.ts >= ? AND s.ts < ? "
+               "GROUP BY bucket, s.field ORDER BY bucket, f.field"
+               % (angles, angles, ", ".join("?" * len(ids))))
+        r = []
+        for row in self.db.execute(sql, [period, period] + ids + [start, end]):
+            if row[6] is None:
+                r.append(row[:6])
+            else:
+                r.append(row[:2] + (degrees(atan2(row[6], row[7])) % 360, None, None, row[5]))
+        return r
+
+
+class TestStore(unittest.TestCase):
+    def test_store(self):
+        db = store(":memory:", batchsize=3, clock=lambda: 0.0)
+        for ts in range(120):
+            db.add(1000.0 + ts, {"mdesc": "wsi0", "awa": Decimal(ts), "aws_lo": 2.0,
+                                 "aws_hi": Decimal(2)})
+            db.add(1000.0 + ts, {"mdesc": "dst200depth", "depth": float("NaN"), "stw": 1.0})
+        db.add(0.0, {"mdesc": "static1s", "xx": 1})
+        from .decode import FDXDecode
+        db.add(1200.0, FDXDecode(b"\x01\x04\x05\xff\xff\x00\x00\x00\x81"))
+        db.flush()
+        self.assertEqual(db.n_rows, 360)
+        self.assertEqual(db.timespan(), (1000.0, 1119.0))
+
+        rows = db.query("wsi0", 1010.0, 1012.0)
+        self.assertEqual(rows, [(1010.0, "awa", 10.0), (1010.0, "aws_lo", 2.0),
+                                (1011.0, "awa", 11.0), (1011.0, "aws_lo", 2.0)])
+        self.assertEqual(len(db.query("wsi0", 1010.0, 1012.0, fields=["awa"])), 2)
+
+        r = db.aggregate("wsi0", 0, 2000, period=60, fields=["awa"])
+        self.assertEqual(r[0][:2], (960, "awa"))
+        self.assertAlmostEqual(r[0][2], 9.5)
+        self.assertEqual(r[0][3:], (None, None, 20))
+        self.assertEqual(len(r), 3)
+        r = db.aggregate("wsi0", 0, 2000, period=60, fields=["aws_lo"])
+        self.assertEqual(r[0][2:], (2.0, 2.0, 2.0, 20))
+        self.assertIn("360 values", db.summary())
+
+        with self.assertRaises(ValueError):
+            db.query("gpspos", 0, 1, fields=["nosuchfield"])
+
+    def test_angles(self):
+        db = store(":memory:")
+        for ts, awa in enumerate([350.0, 20.0, 340.0, 30.0]):
+            db.add(float(ts), {"mdesc": "wsi0", "awa": awa, "aws_lo": 1.0, "aws_hi": 1.0})
+        db.flush()
+        (bucket, field, avg, low, high, count), = db.aggregate("wsi0", 0, 60, fields=["awa"])
+        self.assertAlmostEqual(avg, 5.0, places=6)     # Linear: 185.
+        self.assertEqual((low, high, count), (None, None, 4))
+
+    def test_parse_time(self):
+        with self.assertRaises(ValueError):
+            parse_time("14:00")
+        with self.assertRaises(ValueError):
+            parse_time("yesterday")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,11 +24,17 @@ class TestFDXRead(unittest.TestCase):
         raw = subprocess.check_output(["./fdxread", "--format", "raw", "dumps/wind-3.2kt_app_ca110grd.dump"])
         self.assertIn(b"depth", raw)
 
+        both = subprocess.check_output(["./fdxread", "--sink", "nmea0183", "--sink", "raw:stdout",
+                                        "dumps/wind-3.2kt_app_ca110grd.dump"])
+        self.assertIn(b"FVMWV", both)
+        self.assertIn(b"depth", both)
+
         # And an nxb file for completeness
-        # XXX: Disable this initially since it found an issue in decode.py.
-        if 0:
-            nmea2 = subprocess.check_output(["./fdxread", "dumps/nexusrace_save/QuickRec.nxb"])
-            self.assertIn(b"FVMWV", nmea2)
+        nmea2 = subprocess.check_output(["./fdxread", "dumps/nexusrace_save/QuickRec.nxb"],
+                                        stderr=subprocess.STDOUT)
+        self.assertIn(b"FVMWV", nmea2)
+        self.assertIn(b"frames not decoded", nmea2)
+        self.assertNotIn(b"No handler", nmea2.split(b"quarantine:")[0])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# .- coding: utf-8 -.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation version 2 of the License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#  Copyright (C) 2016-2017 Lasse Karstensen
+#
+"""
+GPX and KML track export.
+
+A day of racing is tens of thousands of GPS fixes, most of them on nearly
+straight lines. The track is simplified with Douglas-Peucker, run over
+windows of points as they arrive: a point is dropped if the track without
+it is never more than tolerance metres off. The number of points written
+then follows how much the boat turned, not how long it sailed, and only a
+window of points is held in memory.
+"""
+from __future__ import print_function
+
+import unittest
+from datetime import datetime
+from io import StringIO
+from math import cos, radians, sqrt
+from xml.sax.saxutils import escape
+
+from .interfaces import HEXinterface
+from .state import boatstate
+
+# Metres per degree latitude.
+METRES_PER_DEGREE = 1852.0 * 60
+
+
+class point(object):
+    __slots__ = ["lat", "lon", "time", "sog", "cog", "awa", "aws"]
+
+    def __init__(self, lat, lon, time=None, sog=None, cog=None, awa=None, aws=None):
+        self.lat = lat
+        self.lon = lon
+        self.time = time
+        self.sog = sog
+        self.cog = cog
+        self.awa = awa
+        self.aws = aws
+
+
+def _offset(p, a, b):
+    "Distance in metres from p to the line segment a-b."
+    # Local flat projection around a, fine at the scale of a window.
+    kx = METRES_PER_DEGREE * cos(radians(a.lat))
+    ky = METRES_PER_DEGREE
+    px, py = (p.lon - a.lon) * kx, (p.lat - a.lat) * ky
+    bx, by = (b.lon - a.lon) * kx, (b.lat - a.lat) * ky
+    seglen = bx * bx + by * by
+    if seglen == 0:
+        return sqrt(px * px + py * py)
+    t = max(0.0, min(1.0, (px * bx + py * by) / seglen))
+    dx, dy = px - t * bx, py - t * by
+    return sqrt(dx * dx + dy * dy)
+
+
+def douglas_peucker(points, tolerance):
+    "Indexes of the points to keep, in order. The end points are always kept."
+    if len(points) < 3:
+        return list(range(len(points)))
+    keep = set([0, len(points) - 1])
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        worst, worstidx = 0.0, None
+        a, b = points[first], points[last]
+        for idx in range(first + 1, last):
+            d = _offset(points[idx], a, b)
+            if d > worst:
+                worst, worstidx = d, idx
+        if worstidx is not None and worst > tolerance:
+            keep.add(worstidx)
+            stack.append((first, worstidx))
+            stack.append((worstidx, last))
+    return sorted(keep)
+
+
+class simplifier(object):
+    """
+    Streaming Douglas-Peucker over windows of points.
+
+    Points are given to add(), and the ones kept are passed to emit. The
+    last point of each window starts the next, so the track is continuous.
+    """
+    def __init__(self, emit, tolerance=5.0, window=500):
+        self.emit = emit
+        self.tolerance = tolerance
+        self.window = window
+        self.points = []
+        self.n_in = 0
+        self.n_out = 0
+
+    def add(self, p):
+        self.n_in += 1
+        if self.tolerance <= 0:
+            self.n_out += 1
+            self.emit(p)
+            return
+        self.points.append(p)
+        if len(self.points) >= self.window:
+            self._run(final=False)
+
+    def _run(self, final):
+        points = self.points
+        keep = douglas_peucker(points, self.tolerance)
+        if not final:
+            keep = keep[:-1]  # Starts the next window.
+        for idx in keep:
+            self.emit(points[idx])
+        self.n_out += len(keep)
+        self.points = [] if final else [points[-1]]
+
+    def close(self):
+        if self.points:
+            self._run(final=True)
+
+
+def _isotime(t):
+    return t.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class gpxwriter(object):
+    "Write a GPX 1.1 track, point by point. Speeds and wind are extensions."
+    def __init__(self, fp, name="fdxread"):
+        self.fp = fp
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<gpx version="1.1" creator="fdxread" xmlns="http://www.topografix.com/GPX/1/1" '
+                 'xmlns:fdx="https://github.com/lkarsten/fdxread">\n'
+                 '<trk><name>%s</name><trkseg>\n' % escape(name))
+
+    def add(self, p):
+        r = ['<trkpt lat="%.6f" lon="%.6f">' % (p.lat, p.lon)]
+        if p.time is not None:
+            r.append("<time>%s</time>" % _isotime(p.time))
+        ext = []
+        for key in ["sog", "cog", "awa", "aws"]:
+            value = getattr(p, key)
+            if value is not None:
+                ext.append("<fdx:%s>%.2f</fdx:%s>" % (key, value, key))
+        if ext:
+            r.append("<extensions>%s</extensions>" % "".join(ext))
+        r.append("</trkpt>\n")
+        self.fp.write("".join(r))
+
+    def close(self):
+        self.fp.write("</trkseg></trk>\n</gpx>\n")
+
+
+class kmlwriter(object):
+    "Write a KML LineString, point by point."
+    def __init__(self, fp, name="fdxread"):
+        self.fp = fp
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                 '<Document><name>%s</name><Placemark><name>Track</name>\n'
+                 '<LineString><tessellate>1</tessellate><coordinates>\n' % escape(name))
+
+    def add(self, p):
+        self.fp.write("%.6f,%.6f,0\n" % (p.lon, p.lat))
+
+    def close(self):
+        self.fp.write("</coordinates></LineString></Placemark></Document>\n</kml>\n")
+
+
+class trackbuilder(object):
+    """
+    Make track points from decoded messages.
+
+    A point is made for each gpspos, with time, speed and wind from the
+    latest values seen. Without GPS time, ts from the dump file is used
+    if it is absolute.
+    """
+    def __init__(self, emit):
+        self.emit = emit
+        self.state = boatstate(clock=lambda: 0.0)
+
+    def add(self, ts, msg):
+        self.state.update(msg)
+        if msg["mdesc"] != "gpspos":
+            return
+        state = self.state
+        pos = state.get("position")
+        if pos is None:
+            return
+        t = state.get("time")
+        if t is None and ts > 1e8:
+            t = datetime.utcfromtimestamp(ts)
+        self.emit(point(pos[0], pos[1], t, state.get("sog"), state.get("cog"),
+                        state.get("awa"), state.get("aws")))
+
+
+def export_track(inputs, output, to="gpx", tolerance=5.0):
+    "Write the track from the dump files in inputs to output. Returns (points in, points out)."
+    writerclass = {"gpx": gpxwriter, "kml": kmlwriter}[to]
+    with open(output, "w") as fp:
+        writer = writerclass(fp)
+        simple = simplifier(writer.add, tolerance=tolerance)
+        builder = trackbuilder(simple.add)
+        for inputfile in inputs:
+            reader = HEXinterface(inputfile)
+            for msg in reader.recvmsg():
+                builder.add(reader.ts, msg)
+        simple.close()
+        writer.close()
+    return (simple.n_in, simple.n_out)
+
+
+class TestTrack(unittest.TestCase):
+    def test_simplify(self):
+        kept = []
+        s = simplifier(kept.append, tolerance=5.0, window=50)
+        # North 0.001 degree (111 m) at a time, then east. A little noise.
+        for idx in range(200):
+            s.add(point(59.0 + 0.001 * idx, 10.0 + (0.00001 if idx % 2 and idx < 199 else 0)))
+        corner = 59.0 + 0.001 * 199
+        for idx in range(1, 200):
+            s.add(point(corner, 10.0 + 0.001 * idx))
+        s.close()
+        # The corner, the ends and at most one per window boundary.
+        self.assertIn((corner, 10.0), [(p.lat, p.lon) for p in kept])
+        self.assertLessEqual(len(kept), 3 + 399 // 49)
+        self.assertEqual((kept[0].lat, kept[-1].lon), (59.0, 10.199))
+        self.assertEqual(s.n_in, 399)
+
+    def test_brownout(self):
+        from .decode import FDXDecode
+        points = []
+        b = trackbuilder(points.append)
+        fix = {"mdesc": "gpspos", "lat": 59.8, "lon": 10.6}
+        brown = FDXDecode(b"\x01\x04\x05\xff\xff\x00\x00\x00\x81")
+        b.add(0.0, fix)
+        b.add(0.0, brown)
+        b.add(0.0, fix)
+        self.assertEqual([(p.awa, p.aws) for p in points], [(None, None), (None, None)])
+        fp = StringIO()
+        w = gpxwriter(fp)
+        w.add(points[1])
+        w.close()
+        self.assertNotIn("fdx:aw", fp.getvalue())
+
+        b.add(0.0, {"mdesc": "wsi0", "awa": 45.0, "aws_lo": 8.0, "aws_hi": 8.0})
+        b.add(0.0, brown)
+        b.add(0.0, fix)
+        self.assertEqual((points[2].awa, points[2].aws), (45.0, 8.0))
+
+    def test_writers(self):
+        p = point(59.8, 10.6, datetime(2016, 8, 24, 17, 5, 53), sog=5.1, cog=270.0)
+        fp = StringIO()
+        w = gpxwriter(fp)
+        w.add(p)
+        w.close()
+        self.assertIn('<trkpt lat="59.800000" lon="10.600000"><time>2016-08-24T17:05:53Z</time>'
+                      '<extensions><fdx:sog>5.10</fdx:sog><fdx:cog>270.00</fdx:cog>', fp.getvalue())
+        from xml.dom.minidom import parseString
+        parseString(fp.getvalue())
+
+        fp = StringIO()
+        w = kmlwriter(fp)
+        w.add(p)
+        w.close()
+        self.assertIn("10.600000,59.800000,0\n", fp.getvalue())
+        parseString(fp.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()